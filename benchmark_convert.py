@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+转换工具压测 / Converter Benchmark
+========================================================
+
+【功能说明 / Function Description】
+生成确定性的合成测试图片集（JPEG、WebP、GIF、BMP、TIFF，可配置尺寸、透明通道和调色板透明色，
+覆盖convert_to_png.py中RGB、RGBA、灰度、CMYK、调色板等各个分支），
+然后用线程池和进程池在不同的工作数下转换同一批图片，
+报告吞吐量（图片/秒、MB/秒）、每种格式的单张耗时p50/p95以及内存峰值（RSS），
+结果保存为JSON文件，可以和之前版本的结果文件比较。
+
+Generates a deterministic synthetic corpus (JPEG, WebP, GIF, BMP and TIFF with
+configurable sizes, alpha channels and palette transparency, covering the RGB,
+RGBA, grayscale, CMYK and palette branches of convert_to_png.py), converts it
+with thread and process pools at several worker counts, and reports
+throughput (images/sec, MB/sec), per-format p50/p95 latency and peak RSS. The
+results are saved as JSON and can be compared with a results file from an
+earlier version.
+
+【使用方法 / Usage】
+1. 设置下方的全局变量 / Set the global variables below:
+   - CORPUS_*: 图片数量、尺寸、格式、透明通道比例和随机种子 / Image count, sizes, formats, alpha ratios and seed
+   - MODES、WORKER_COUNTS: 要测试的并行方式和工作数 / Executor modes and worker counts to test
+   - COMPARE_WITH: 之前的结果文件，设置后打印速度对比 / Earlier results file to compare against
+2. 运行程序 / Run the program: python benchmark_convert.py
+
+【说明 / Notes】
+相同的种子和配置总是生成完全相同的图片，测试图片集保存在CORPUS_DIR中，配置不变时直接复用。
+转换会删除原文件，因此每次测试前把图片集复制到临时目录（复制不计入耗时）。
+每次测试在独立的子进程中运行，内存峰值互不影响；进程池模式另外报告工作进程中的最大内存峰值。
+
+The same seed and settings always produce identical images; the corpus is
+kept in CORPUS_DIR and reused while the settings are unchanged. Conversion
+deletes originals, so the corpus is copied to a temporary directory before
+every run (the copy is not timed). Every run happens in a fresh child process
+so peak RSS values are independent; process mode additionally reports the
+largest peak RSS among the worker processes.
+"""
+
+import concurrent.futures
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# ====================== 全局配置参数 ======================
+
+# 测试图片集：保存目录、数量、尺寸（按顺序循环使用）和随机种子
+CORPUS_DIR = "benchmark_corpus"
+CORPUS_COUNT = 60
+CORPUS_SIZES = ((640, 480), (1600, 1200), (3000, 2000))
+CORPUS_SEED = 1234
+# 包含的格式，按顺序循环使用
+CORPUS_FORMATS = ("JPEG", "WEBP", "GIF", "BMP", "TIFF")
+# 支持透明通道的格式（WebP、TIFF）中带透明通道的图片比例
+ALPHA_RATIO = 0.3
+# 调色板图片（GIF）中带透明色的比例
+PALETTE_TRANSPARENCY_RATIO = 0.5
+
+# 要测试的并行方式和工作数
+MODES = ("thread", "process")
+WORKER_COUNTS = (1, 2, 4)
+# PNG编码配置和长边上限，为None时使用convert_to_png.py中的设置
+ENCODE_PROFILE = None
+MAX_DIMENSION = None
+# 编解码引擎（"pillow"、"auto"、引擎名称或按格式的字典，参见convert_to_png.py），为None时使用convert_to_png.py中的设置；
+# 同时指定PNG编码引擎时使用选择结果的格式，如 {"decoders": {"WEBP": "opencv"}, "encoder": "opencv"}
+CODEC_BACKENDS = None
+
+# 测试结果保存为JSON文件，为None时只打印
+RESULTS_FILE = "benchmark_convert_results.json"
+# 之前版本的结果文件，设置后打印相同并行方式和工作数下的速度对比
+COMPARE_WITH = None
+
+# 每种格式可以生成的图片类型：(类型名称, 是否带透明通道)
+# 类型对应convert_to_png.normalize_mode()的分支：RGB、RGBA、LA、L、CMYK、P（有无透明色）
+VARIANTS = {
+    "JPEG": (("rgb", False), ("gray", False), ("cmyk", False)),
+    "WEBP": (("rgb", False), ("rgba", True)),
+    "GIF": (("palette", False), ("palette_transparent", True)),
+    "BMP": (("rgb", False), ("gray", False), ("palette", False)),
+    "TIFF": (("rgb", False), ("cmyk", False), ("palette", False), ("rgba", True), ("gray_alpha", True)),
+}
+EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "GIF": ".gif", "BMP": ".bmp", "TIFF": ".tif"}
+MANIFEST_FILE = "manifest.json"
+CORPUS_VERSION = 1  # 生成方式改变时增加，旧的图片集会重新生成
+
+
+# ====================== 测试数据 ======================
+
+def corpus_spec():
+    """决定图片集内容的配置，与保存的清单不同时重新生成"""
+    return {"version": CORPUS_VERSION, "count": CORPUS_COUNT, "sizes": [list(s) for s in CORPUS_SIZES],
+            "seed": CORPUS_SEED, "formats": list(CORPUS_FORMATS), "alpha_ratio": ALPHA_RATIO,
+            "palette_transparency_ratio": PALETTE_TRANSPARENCY_RATIO}
+
+
+def synthetic_image(rng, size):
+    """生成一张接近照片的RGB图片：放大的随机色块形成平滑的渐变，叠加全分辨率的细小噪声"""
+    from PIL import Image
+
+    width, height = size
+    coarse_size = (max(2, width // 16), max(2, height // 16))
+    coarse = Image.frombytes('RGB', coarse_size, rng.randbytes(coarse_size[0] * coarse_size[1] * 3))
+    coarse = coarse.resize(size, Image.BICUBIC)
+    grain = Image.frombytes('L', size, rng.randbytes(width * height)).convert('RGB')
+    return Image.blend(coarse, grain, 0.12)
+
+
+def alpha_mask(rng, size):
+    """透明度从一侧到另一侧渐变，并有一块完全透明的区域"""
+    from PIL import Image
+
+    mask = Image.linear_gradient('L').rotate(rng.choice((0, 90, 180, 270))).resize(size)
+    width, height = size
+    left, top = rng.randrange(width // 2), rng.randrange(height // 2)
+    mask.paste(0, (left, top, left + width // 4, top + height // 4))
+    return mask
+
+
+def render_variant(rng, size, variant):
+    """生成指定类型的图片，返回(图片, 保存参数)"""
+    img = synthetic_image(rng, size)
+    if variant == "rgb":
+        return img, {}
+    if variant == "gray":
+        return img.convert('L'), {}
+    if variant == "cmyk":
+        return img.convert('CMYK'), {}
+    if variant == "rgba":
+        img.putalpha(alpha_mask(rng, size))
+        return img, {}
+    if variant == "gray_alpha":
+        gray = img.convert('L')
+        gray.putalpha(alpha_mask(rng, size))  # L加上透明通道后为LA
+        return gray, {}
+    palette = img.quantize(colors=rng.choice((16, 64, 256)))
+    if variant == "palette_transparent":
+        return palette, {"transparency": 0}
+    return palette, {}
+
+
+def generate_corpus(directory):
+    """按当前配置生成确定性的测试图片集，返回清单；配置与已有的清单相同时直接读取"""
+    spec = corpus_spec()
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("spec") == spec and all(os.path.exists(os.path.join(directory, item["name"]))
+                                                for item in manifest["files"]):
+            return manifest
+        shutil.rmtree(directory)
+    os.makedirs(directory, exist_ok=True)
+
+    rng = random.Random(CORPUS_SEED)
+    files = []
+    for i in range(CORPUS_COUNT):
+        fmt = CORPUS_FORMATS[i % len(CORPUS_FORMATS)]
+        size = tuple(CORPUS_SIZES[(i // len(CORPUS_FORMATS)) % len(CORPUS_SIZES)])
+        opaque = [name for name, alpha in VARIANTS[fmt] if not alpha]
+        transparent = [name for name, alpha in VARIANTS[fmt] if alpha]
+        ratio = PALETTE_TRANSPARENCY_RATIO if fmt == "GIF" else ALPHA_RATIO
+        if transparent and rng.random() < ratio:
+            variant = rng.choice(transparent)
+        else:
+            variant = rng.choice(opaque)
+        img, params = render_variant(rng, size, variant)
+        name = f"{i + 1:04d}_{variant}{EXTENSIONS[fmt]}"
+        path = os.path.join(directory, name)
+        img.save(path, fmt, **params)
+        files.append({"name": name, "format": fmt, "variant": variant, "size": list(size),
+                      "bytes": os.path.getsize(path)})
+
+    manifest = {"spec": spec, "files": files}
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def summarize_corpus(manifest):
+    counts = {}
+    for item in manifest["files"]:
+        key = f"{item['format']}/{item['variant']}"
+        counts[key] = counts.get(key, 0) + 1
+    total = sum(item["bytes"] for item in manifest["files"])
+    return {"images": len(manifest["files"]), "mb": round(total / 1024 / 1024, 2), "variants": counts}
+
+
+# ====================== 测试 ======================
+
+def percentile(sorted_values, p):
+    """线性插值的百分位数，sorted_values为空时返回None"""
+    if not sorted_values:
+        return None
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    return statistics.quantiles(sorted_values, n=100, method='inclusive')[p - 1]
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """内存峰值（MB），Linux下ru_maxrss的单位为KB，macOS下为字节；RUSAGE_CHILDREN为已结束子进程中的最大值"""
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run_case(corpus_dir, manifest, work_dir, mode, workers, profile, max_dimension, codecs):
+    """在子进程中复制图片集并转换一次，返回统计结果"""
+    import convert_to_png
+    from trace_recorder import TraceRecorder
+
+    for item in manifest["files"]:
+        shutil.copyfile(os.path.join(corpus_dir, item["name"]), os.path.join(work_dir, item["name"]))
+    formats = {item["name"]: item["format"] for item in manifest["files"]}
+    input_bytes = sum(item["bytes"] for item in manifest["files"])
+
+    # 每张图片的耗时取自convert_image区间，进程池的区间由工作进程传回
+    tracer = TraceRecorder()
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        counts = convert_to_png.process_directory(work_dir, recursive=False, verbose=False, tracer=tracer,
+                                                  mode=mode, workers=workers, profile=profile,
+                                                  max_dimension=max_dimension, codecs=codecs)
+        wall = time.perf_counter() - start
+
+    latencies = {}
+    for event in tracer.events():
+        if event.get("ph") == "X" and event["name"] == "convert_image":
+            fmt = formats.get(os.path.basename(event["args"]["image"]))
+            latencies.setdefault(fmt, []).append(event["dur"] / 1000)
+    per_format = {}
+    for fmt, values in sorted(latencies.items()):
+        values.sort()
+        per_format[fmt] = {"images": len(values), "mean_ms": round(statistics.fmean(values), 2),
+                           "p50_ms": round(percentile(values, 50), 2), "p95_ms": round(percentile(values, 95), 2)}
+
+    return {
+        "mode": mode,
+        "workers": workers,
+        "images": counts["total"],
+        "succeeded": counts["successful"],
+        "failed": counts["failed"],
+        "seconds": round(wall, 3),
+        "images_per_sec": round(counts["successful"] / wall, 3) if wall > 0 else None,
+        "input_mb_per_sec": round(input_bytes / 1024 / 1024 / wall, 3) if wall > 0 else None,
+        "output_mb_per_sec": round(counts["output_bytes"] / 1024 / 1024 / wall, 3) if wall > 0 else None,
+        "output_mb": round(counts["output_bytes"] / 1024 / 1024, 2),
+        "encode_seconds": round(counts["encode_seconds"], 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "worker_peak_rss_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1) if mode == "process" else None,
+        "formats": per_format,
+    }
+
+
+def environment():
+    """记录在结果中的运行环境，比较不同版本的结果时参考"""
+    from PIL import __version__ as pillow_version
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count()
+    return {"commit": commit, "python": platform.python_version(), "pillow": pillow_version,
+            "platform": platform.platform(), "cpus": cpus, "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def print_table(results):
+    def fmt(value):
+        return "-" if value is None else f"{value:.2f}"
+
+    print(f"{'方式':>8} {'工作数':>6} {'成功':>5} {'失败':>5} {'图片/秒':>9} {'输入MB/秒':>10} {'输出MB/秒':>10} "
+          f"{'RSS(MB)':>9} {'工作进程RSS':>11}")
+    for r in results:
+        print(f"{r['mode']:>8} {r['workers']:>6} {r['succeeded']:>5} {r['failed']:>5} {fmt(r['images_per_sec']):>9} "
+              f"{fmt(r['input_mb_per_sec']):>10} {fmt(r['output_mb_per_sec']):>10} {fmt(r['peak_rss_mb']):>9} "
+              f"{fmt(r['worker_peak_rss_mb']):>11}")
+    print()
+    print(f"{'方式':>8} {'工作数':>6} {'格式':>6} {'张数':>5} {'平均(ms)':>9} {'p50(ms)':>9} {'p95(ms)':>9}")
+    for r in results:
+        for name, f in r["formats"].items():
+            print(f"{r['mode']:>8} {r['workers']:>6} {name:>6} {f['images']:>5} {f['mean_ms']:>9.1f} "
+                  f"{f['p50_ms']:>9.1f} {f['p95_ms']:>9.1f}")
+
+
+def compare(results, path):
+    """与之前的结果文件比较相同并行方式和工作数下的图片/秒"""
+    with open(path, 'r', encoding='utf-8') as f:
+        previous = json.load(f)
+    if previous.get("corpus", {}).get("spec") != corpus_spec():
+        print("注意: 之前的结果使用了不同的测试图片集配置，对比仅供参考")
+    before = {(r["mode"], r["workers"]): r for r in previous.get("results", [])}
+    commit = previous.get("environment", {}).get("commit")
+    print(f"与 {path}（{commit or '未知版本'}）对比:")
+    for r in results:
+        old = before.get((r["mode"], r["workers"]))
+        if old is None or not old.get("images_per_sec") or r["images_per_sec"] is None:
+            continue
+        ratio = r["images_per_sec"] / old["images_per_sec"]
+        print(f"  {r['mode']} x{r['workers']}: {old['images_per_sec']:.2f} -> {r['images_per_sec']:.2f} 图片/秒"
+              f"（{ratio:.2f}倍）")
+
+
+def main():
+    print(f"准备测试图片集: {CORPUS_DIR}")
+    manifest = generate_corpus(CORPUS_DIR)
+    summary = summarize_corpus(manifest)
+    print(f"图片集: {summary['images']} 张，{summary['mb']} MB，类型: {summary['variants']}")
+
+    results = []
+    # spawn保证每个子进程从空白状态开始，内存峰值只包含本次测试
+    context = multiprocessing.get_context("spawn")
+    for mode in MODES:
+        for workers in WORKER_COUNTS:
+            with tempfile.TemporaryDirectory() as work_dir:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    result = pool.submit(run_case, CORPUS_DIR, manifest, work_dir, mode, workers,
+                                         ENCODE_PROFILE, MAX_DIMENSION, CODEC_BACKENDS).result()
+            results.append(result)
+            print(f"{mode} x{workers}: {result['images_per_sec']} 图片/秒，{result['input_mb_per_sec']} MB/秒")
+
+    print()
+    print_table(results)
+    if COMPARE_WITH:
+        print()
+        compare(results, COMPARE_WITH)
+    if RESULTS_FILE:
+        data = {"environment": environment(), "corpus": dict(summary, spec=corpus_spec()),
+                "settings": {"encode_profile": ENCODE_PROFILE, "max_dimension": MAX_DIMENSION,
+                             "codec_backends": CODEC_BACKENDS},
+                "results": results}
+        with open(RESULTS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {RESULTS_FILE}")
+    return True
+
+
+if __name__ == "__main__":
+    if not main():
+        exit(1)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+描述程序压测工具 / Describer Benchmark
+========================================================
+
+【功能说明 / Function Description】
+在本机启动模拟星火服务（mock_spark_server.py），用DescribeEngine在不同并发数下描述同一批图片，
+报告每个并发数的吞吐量（图片/秒）、单次请求耗时的p50/p95/p99以及内存峰值（RSS），
+不消耗真实接口的配额，可以用来比较调度、压缩、预读取等改动前后的性能。
+
+Starts the local mock Spark server (mock_spark_server.py) and describes the
+same set of images with DescribeEngine at several concurrency levels. For
+every level it reports throughput (images/sec), p50/p95/p99 request latency
+and peak RSS, without spending real API quota, so scheduling, compression
+and prefetch changes can be compared before and after.
+
+【使用方法 / Usage】
+1. 设置下方的全局变量 / Set the global variables below:
+   - IMAGE_DIR: 测试图片目录，为None时生成随机图片 / Image folder; None generates random images
+   - CONCURRENCY_LEVELS: 要测试的并发数 / Concurrency levels to test
+   - MOCK_*: 模拟服务的延迟、输出速度、错误率和限流 / Latency, token rate, errors and throttling of the mock server
+2. 运行程序 / Run the program: python benchmark_describe.py
+
+【说明 / Notes】
+每个并发数在独立的子进程中运行，内存峰值互不影响；模拟服务运行在主进程中。
+Every concurrency level runs in a fresh child process so peak RSS values are
+independent; the mock server runs in the parent process.
+"""
+
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from describe_engine import DescribeEngine, DescribeJob
+from mock_spark_server import MockSparkConfig, MockSparkServer
+from rate_control import AdaptiveRateController
+from retry_policy import RetryPolicy
+from spark_client import SparkImageClient
+
+# ====================== 全局配置参数 ======================
+
+# 测试图片目录，为None时在临时目录中生成IMAGE_COUNT张随机图片
+IMAGE_DIR = None
+IMAGE_COUNT = 48
+IMAGE_SIZE = (1600, 1200)
+
+# 要测试的并发数
+CONCURRENCY_LEVELS = (1, 2, 4, 8, 16)
+
+# 是否在上传前压缩图片（需要Pillow）
+COMPRESS_PAYLOAD = True
+
+# 模拟服务：首帧延迟分布（"fixed"、"uniform"、"lognormal"）、中位数和离散程度（秒）
+MOCK_LATENCY = "lognormal"
+MOCK_LATENCY_MEDIAN = 0.5
+MOCK_LATENCY_SPREAD = 0.4
+# 模拟服务：输出速度（词/秒）和每个回答的词数
+MOCK_TOKEN_RATE = 300.0
+MOCK_ANSWER_WORDS = 120
+# 模拟服务：随机错误率和错误码
+MOCK_ERROR_RATE = 0.0
+MOCK_ERROR_CODES = (10013,)
+# 模拟服务：并发上限（超过时返回10110）和每秒请求数上限（超过时返回11202），None表示不限制
+MOCK_MAX_CONCURRENCY = None
+MOCK_QPS = None
+
+# 测试结果保存为JSON文件，为None时只打印
+RESULTS_FILE = "benchmark_results.json"
+
+
+# ====================== 测试数据 ======================
+
+def generate_images(directory, count, size):
+    """生成count张随机噪声和色块组成的JPEG图片，返回路径列表"""
+    from PIL import Image
+
+    paths = []
+    for i in range(count):
+        # 噪声使JPEG难以压缩，接近真实照片的大小
+        img = Image.effect_noise(size, 40 + i % 40).convert('RGB')
+        img.paste((i * 37 % 256, i * 91 % 256, i * 53 % 256), (0, 0, size[0] // 3, size[1] // 3))
+        path = os.path.join(directory, f"{i + 1}.jpg")
+        img.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def list_images(directory):
+    extensions = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(extensions))
+
+
+def percentile(sorted_values, p):
+    """线性插值的百分位数，sorted_values为空时返回None"""
+    if not sorted_values:
+        return None
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    return statistics.quantiles(sorted_values, n=100, method='inclusive')[p - 1]
+
+
+def peak_rss_mb():
+    """当前进程的内存峰值（MB），Linux下ru_maxrss的单位为KB，macOS下为字节"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+# ====================== 测试 ======================
+
+def run_level(url, image_paths, concurrency, output_dir, compress):
+    """在子进程中以固定并发数描述所有图片，返回统计结果"""
+    client = SparkImageClient("mock-app", "mock-key", "mock-secret", url,
+                              connect_timeout=10, first_token_timeout=30, total_timeout=120)
+    controller = AdaptiveRateController(initial=concurrency, minimum=concurrency, maximum=concurrency)
+    compressor = None
+    if compress:
+        from image_payload import PayloadCompressor
+
+        compressor = PayloadCompressor()
+    engine = DescribeEngine(client, controller, retry_policy=RetryPolicy(max_attempts=3, base_delay=0.1, max_delay=1.0),
+                            compressor=compressor)
+    jobs = [DescribeJob(path, os.path.join(output_dir, os.path.basename(path) + ".txt"), "describe")
+            for path in image_paths]
+
+    start = time.monotonic()
+    engine.run_sync(jobs)
+    wall = time.monotonic() - start
+
+    latencies = sorted(job.elapsed for job in jobs if job.ok)
+    succeeded = len(latencies)
+    return {
+        "concurrency": concurrency,
+        "images": len(jobs),
+        "succeeded": succeeded,
+        "failed": len(jobs) - succeeded,
+        "requests": sum(job.attempts for job in jobs),
+        "seconds": round(wall, 3),
+        "images_per_sec": round(succeeded / wall, 3) if wall > 0 else None,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "prefetch_peak_mb": round(engine.prefetch_peak / (1024 * 1024), 1),
+    }
+
+
+def print_table(results):
+    def fmt(value):
+        return "-" if value is None else f"{value:.3f}"
+
+    print(f"{'并发':>6} {'成功':>6} {'失败':>6} {'请求':>6} {'图片/秒':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'RSS(MB)':>9}")
+    for r in results:
+        print(f"{r['concurrency']:>6} {r['succeeded']:>6} {r['failed']:>6} {r['requests']:>6} "
+              f"{fmt(r['images_per_sec']):>9} {fmt(r['p50']):>8} {fmt(r['p95']):>8} {fmt(r['p99']):>8} "
+              f"{r['peak_rss_mb']:>9.1f}")
+
+
+def main():
+    config = MockSparkConfig(latency=MOCK_LATENCY, latency_median=MOCK_LATENCY_MEDIAN,
+                             latency_spread=MOCK_LATENCY_SPREAD, token_rate=MOCK_TOKEN_RATE,
+                             answer_words=MOCK_ANSWER_WORDS, error_rate=MOCK_ERROR_RATE,
+                             error_codes=MOCK_ERROR_CODES, max_concurrency=MOCK_MAX_CONCURRENCY, qps=MOCK_QPS)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if IMAGE_DIR is None:
+            print(f"生成 {IMAGE_COUNT} 张 {IMAGE_SIZE[0]}x{IMAGE_SIZE[1]} 测试图片...")
+            image_paths = generate_images(workdir, IMAGE_COUNT, IMAGE_SIZE)
+        else:
+            image_paths = list_images(IMAGE_DIR)
+        if not image_paths:
+            print("错误: 没有找到测试图片")
+            return False
+
+        results = []
+        # spawn保证每个子进程从空白状态开始，内存峰值只包含本次测试
+        context = multiprocessing.get_context("spawn")
+        with MockSparkServer(config) as server:
+            print(f"模拟服务: {server.url}")
+            for concurrency in CONCURRENCY_LEVELS:
+                output_dir = os.path.join(workdir, f"out-{concurrency}")
+                os.makedirs(output_dir)
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    result = pool.submit(run_level, server.url, image_paths, concurrency, output_dir,
+                                         COMPRESS_PAYLOAD).result()
+                results.append(result)
+                print(f"并发 {concurrency}: {result['images_per_sec']} 图片/秒")
+            server_stats = dict(server.stats, errors={str(k): v for k, v in server.stats["errors"].items()})
+
+    print()
+    print_table(results)
+    print(f"模拟服务统计: {server_stats}")
+    if RESULTS_FILE:
+        with open(RESULTS_FILE, 'w', encoding='utf-8') as f:
+            json.dump({"config": vars(config), "compress_payload": COMPRESS_PAYLOAD,
+                       "images": len(image_paths), "results": results, "server": server_stats},
+                      f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {RESULTS_FILE}")
+    return True
+
+
+if __name__ == "__main__":
+    # 设置通过上方的全局变量修改，不接受命令行参数，避免如--help意外启动完整测试
+    if len(sys.argv) > 1:
+        print(__doc__)
+        print(f"错误: 不支持的参数 {' '.join(sys.argv[1:])}，请修改文件中的全局变量")
+        exit(2)
+    if not main():
+        exit(1)
@@ -29,7 +29,8 @@ you can use this tool to batch delete text files.
 
 4. 程序将 / The program will:
    - 删除指定文件夹中的所有.txt文件 / Delete all .txt files in the specified folders
-   - 删除进度记录文件，使得下次运行描述生成工具时重新开始 / Delete progress record files to restart from the beginning next time
+   - 删除进度记录文件并清除任务台账中的记录，使得下次运行描述生成工具时重新开始 / Delete progress record files and
+     clear the job ledger entries to restart from the beginning next time
 
 【文件夹结构 / Folder Structure】
 程序会处理以下结构中的文件 / The program processes files in the following structure:
@@ -53,11 +54,17 @@ picture/
 - 删除操作不可撤销，请谨慎确认 / Deletion operations cannot be undone, please confirm carefully
 - 如果指定的文件夹不存在，程序会提示错误 / If the specified folder does not exist, the program will display an error
 - 可以反复运行此程序，不会有副作用 / This program can be run repeatedly without side effects
+- 描述缓存文件(describe_cache.db)不会被删除，重新生成时相同图片和提示词会直接使用缓存 / The description
+  cache (describe_cache.db) is kept, so regenerating with the same images and prompt reuses cached results
 """
 
+import glob
 import os
 import shutil
 
+from job_ledger import JobLedger
+from output_store import open_output_store, OUTPUT_JSONL, OUTPUT_SQLITE
+
 # ====================== 全局配置参数 ======================
 
 # 目标文件夹，当CLEAN_ALL_FOLDERS=0时生效
@@ -69,16 +76,30 @@ CLEAN_ALL_FOLDERS = 0
 # 基础目录，所有图片文件夹的上级目录
 BASE_DIR = "picture"
 
-# 进度文件名
+# 进度文件名（旧版本遗留的进度文件也会被删除）
 PROGRESS_FILE = "progress.txt"
 FOLDERS_PROGRESS_FILE = "folders_progress.txt"
 
+# 任务台账文件名，与generate_picture_describe.py中的JOB_LEDGER_FILE一致；
+# 工作进程模式下的台账（describe_jobs.<WORKER_ID>.db）也会被清除
+JOB_LEDGER_FILE = "describe_jobs.db"
+
+# 分片存储目录（OUTPUT_MODE为"jsonl"或"sqlite"时描述保存在这里），位于BASE_DIR下
+OUTPUT_STORE_DIR = "descriptions"
+
 
 # ====================== 函数定义 ======================
 
+def list_ledger_files():
+    """返回BASE_DIR下的所有任务台账文件（包括各工作进程的台账，不包括-wal/-shm文件）"""
+    base, ext = os.path.splitext(JOB_LEDGER_FILE)
+    return sorted(glob.glob(os.path.join(glob.escape(BASE_DIR), glob.escape(base) + "*" + ext)))
+
+
 def list_all_folders():
     """获取BASE_DIR下的所有文件夹"""
-    return [f for f in os.listdir(BASE_DIR) if os.path.isdir(os.path.join(BASE_DIR, f))]
+    return [f for f in os.listdir(BASE_DIR) if os.path.isdir(os.path.join(BASE_DIR, f))
+            and not f.startswith('.') and f != OUTPUT_STORE_DIR]
 
 
 def clean_folder(folder_name, is_single_mode=False):
@@ -119,6 +140,28 @@ def clean_folder(folder_name, is_single_mode=False):
             os.remove(progress_path)
             print(f"已删除进度文件: {progress_path}")
 
+        # 在分片存储中追加该文件夹的删除记录（如果存在）
+        store_dir = os.path.join(BASE_DIR, OUTPUT_STORE_DIR)
+        if os.path.isdir(store_dir):
+            for output_format in (OUTPUT_JSONL, OUTPUT_SQLITE):
+                store = open_output_store(store_dir, output_format, writer_id="clean")
+                try:
+                    keys = store.keys(folder_name)
+                    store.delete(keys)
+                finally:
+                    store.close()
+                if keys:
+                    print(f"已从分片存储中删除 {len(keys)} 条描述: {folder_name}")
+
+        # 清除所有任务台账中该文件夹的记录（如果存在）；通过SQLite删除，-wal/-shm中的记录一并清除
+        for ledger_path in list_ledger_files():
+            ledger = JobLedger(ledger_path)
+            try:
+                ledger.reset_folder(folder_name)
+            finally:
+                ledger.close()
+            print(f"已清除任务台账记录: {folder_name} ({os.path.basename(ledger_path)})")
+
         return count, True
     except Exception as e:
         print(f"清除文件夹 '{folder_name}' 时出错: {e}")
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+图片编解码引擎 / Image Codec Backends
+========================================================
+
+【功能说明 / Function Description】
+convert_to_png.py默认用Pillow解码原图和编码PNG。对某些格式（如大TIFF、WebP），
+libvips（pyvips）或OpenCV解码和编码更快、占用内存更少。这里为这些库提供统一的接口，
+每种源格式可以使用不同的解码引擎，PNG编码也可以选择引擎；
+引擎可以在配置中指定，也可以在启动时用开头的几张图片测试后自动选择。
+
+convert_to_png.py decodes sources and encodes PNG with Pillow by default. For
+some formats (such as large TIFF or WebP) libvips (pyvips) or OpenCV decode
+and encode faster with less memory. This module gives those libraries a common
+interface: every source format can use its own decoder, and the PNG encoder
+can be chosen as well, either by config or by a startup micro-benchmark on
+the first images.
+
+【输出一致性 / Identical Output】
+- 是否保留透明通道（RGBA或RGB）总是由Pillow读取的文件头决定，与convert_to_png.normalize_mode()相同
+  / Whether alpha is kept (RGBA or RGB) is always decided from the header Pillow reads,
+  exactly like convert_to_png.normalize_mode()
+- 其它引擎只处理声明支持的格式和模式组合（如不处理CMYK、16位、多帧图片），其它情况交给Pillow
+  / Other engines only take the format and mode combinations they declare (no CMYK,
+  16-bit or multi-frame images, for example); everything else goes to Pillow
+- 自动选择时，引擎的解码结果和编码后重新读取的像素必须与Pillow完全相同，否则不会被选择
+  / When choosing automatically, an engine's decoded pixels and the pixels read back from
+  its PNG must match Pillow exactly, otherwise it is not chosen
+
+【使用方法 / Usage】
+    selection = choose_backends(sample_paths, {"compress_level": 6})
+    decoder = get_backend(selection["decoders"].get("TIFF", PILLOW))
+
+【说明 / Notes】
+- pyvips需要系统中安装libvips，OpenCV需要opencv-python（或opencv-python-headless）和numpy
+  / pyvips needs libvips installed on the system; OpenCV needs opencv-python
+  (or opencv-python-headless) and numpy
+- 没有安装的引擎自动跳过 / Engines that are not installed are skipped
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+from convert_to_png import normalize_mode, normalized_mode
+
+PILLOW = "pillow"
+OPENCV = "opencv"
+VIPS = "vips"
+BACKEND_NAMES = (PILLOW, OPENCV, VIPS)
+
+
+def _read_source(source):
+    """文件路径或文件对象 -> 字节"""
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return f.read()
+    source.seek(0)
+    return source.read()
+
+
+class PillowBackend(object):
+    """Pillow引擎，支持所有格式，其它引擎不支持的情况都由它处理"""
+
+    name = PILLOW
+
+    def supports(self, header):
+        return True
+
+    def decode(self, source, mode):
+        img = Image.open(source)
+        img.load()
+        return normalize_mode(img)
+
+    def can_encode(self, params):
+        return True
+
+    def encode(self, img, target_path, params):
+        img.save(target_path, 'PNG', **params)
+
+
+class OpenCVBackend(object):
+    """OpenCV引擎：解码JPEG、WebP、TIFF、BMP中的8位图片，编码PNG"""
+
+    name = OPENCV
+    # 源格式 -> 支持的Pillow模式；OpenCV读取带透明通道的TIFF时像素与Pillow不同，因此不处理
+    DECODE_MODES = {
+        "JPEG": ('L', 'RGB'),
+        "WEBP": ('RGB', 'RGBA'),
+        "TIFF": ('L', 'RGB'),
+        "BMP": ('RGB',),
+    }
+
+    def __init__(self):
+        import cv2
+        import numpy
+
+        self._cv2 = cv2
+        self._np = numpy
+
+    def supports(self, header):
+        return header.mode in self.DECODE_MODES.get(header.format, ()) and getattr(header, "n_frames", 1) == 1
+
+    def decode(self, source, mode):
+        cv2, np = self._cv2, self._np
+        buffer = np.frombuffer(_read_source(source), dtype=np.uint8)
+        # IMREAD_UNCHANGED保留透明通道且不按EXIF旋转，与Pillow相同
+        array = cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+        if array is None or array.dtype != np.uint8:
+            raise ValueError("OpenCV无法解码为8位图片")
+        if array.ndim == 2:
+            array = cv2.cvtColor(array, cv2.COLOR_GRAY2RGB)
+        elif array.shape[2] == 4:
+            array = cv2.cvtColor(array, cv2.COLOR_BGRA2RGBA if mode == 'RGBA' else cv2.COLOR_BGRA2RGB)
+        else:
+            array = cv2.cvtColor(array, cv2.COLOR_BGR2RGB)
+        if mode == 'RGBA' and array.shape[2] == 3:
+            array = cv2.cvtColor(array, cv2.COLOR_RGB2RGBA)
+        return Image.fromarray(array, mode)
+
+    def can_encode(self, params):
+        return set(params) <= {"compress_level"}
+
+    def encode(self, img, target_path, params):
+        cv2, np = self._cv2, self._np
+        array = np.asarray(img)
+        array = cv2.cvtColor(array, cv2.COLOR_RGBA2BGRA if img.mode == 'RGBA' else cv2.COLOR_RGB2BGR)
+        ok, data = cv2.imencode('.png', array, [cv2.IMWRITE_PNG_COMPRESSION, params.get("compress_level", 6)])
+        if not ok:
+            raise ValueError("OpenCV编码PNG失败")
+        # imwrite不支持部分系统上的非ASCII路径，自己写文件
+        with open(target_path, 'wb') as f:
+            f.write(data.tobytes())
+
+
+class VipsBackend(object):
+    """libvips引擎：解码JPEG、WebP、TIFF中的8位图片，编码PNG"""
+
+    name = VIPS
+    # 带透明通道的TIFF有预乘和非预乘两种，统一交给Pillow处理
+    DECODE_MODES = {
+        "JPEG": ('L', 'RGB'),
+        "WEBP": ('RGB', 'RGBA'),
+        "TIFF": ('L', 'RGB'),
+    }
+
+    def __init__(self):
+        import pyvips
+
+        self._vips = pyvips
+
+    def supports(self, header):
+        return header.mode in self.DECODE_MODES.get(header.format, ()) and getattr(header, "n_frames", 1) == 1
+
+    def decode(self, source, mode):
+        if isinstance(source, str):
+            image = self._vips.Image.new_from_file(source, access="sequential")
+        else:
+            image = self._vips.Image.new_from_buffer(_read_source(source), "", access="sequential")
+        if image.format != "uchar":
+            raise ValueError("libvips无法解码为8位图片")
+        if image.bands in (1, 2):
+            image = image.colourspace("srgb")  # 灰度复制为三个通道，与Pillow的L -> RGB相同
+        if mode == 'RGB' and image.bands == 4:
+            image = image.extract_band(0, n=3)
+        elif mode == 'RGBA' and image.bands == 3:
+            image = image.bandjoin(255)
+        return Image.frombytes(mode, (image.width, image.height), image.write_to_memory())
+
+    def can_encode(self, params):
+        return set(params) <= {"compress_level"}
+
+    def encode(self, img, target_path, params):
+        image = self._vips.Image.new_from_memory(img.tobytes(), img.width, img.height, len(img.mode), "uchar")
+        image.pngsave(target_path, compression=params.get("compress_level", 6))
+
+
+_FACTORIES = {PILLOW: PillowBackend, OPENCV: OpenCVBackend, VIPS: VipsBackend}
+_instances = {}  # 名称 -> 引擎实例，未安装时为None
+_lock = threading.Lock()
+
+
+def get_backend(name):
+    """返回名称对应的引擎，未安装时返回None；每个进程中只创建一次"""
+    with _lock:
+        if name not in _instances:
+            if name not in _FACTORIES:
+                raise ValueError(f"未知的编解码引擎: {name}")
+            try:
+                _instances[name] = _FACTORIES[name]()
+            except (ImportError, OSError):  # OSError: 如pyvips找不到libvips
+                _instances[name] = None
+        return _instances[name]
+
+
+def available_backends():
+    """已安装的引擎名称"""
+    return [name for name in BACKEND_NAMES if get_backend(name) is not None]
+
+
+def resolve_backends(decoders=PILLOW, encoder=PILLOW, params=None):
+    """把配置转换为引擎选择，未安装或不支持当前编码参数的引擎改用Pillow
+
+    参数:
+        decoders: 引擎名称（所有格式使用同一个引擎）或 源格式 -> 引擎名称 的字典
+        encoder: PNG编码引擎名称
+        params: PNG保存参数
+
+    返回:
+        dict: {"decoders": {源格式: 引擎名称}, "encoder": 引擎名称}
+    """
+    if isinstance(decoders, str):
+        backend = get_backend(decoders)
+        formats = getattr(backend, "DECODE_MODES", {})
+        decoders = {fmt: decoders for fmt in formats}
+    selection = {"decoders": {}, "encoder": PILLOW}
+    for fmt, name in decoders.items():
+        if name != PILLOW and get_backend(name) is not None:
+            selection["decoders"][fmt.upper()] = name
+    backend = get_backend(encoder) if encoder != PILLOW else None
+    if backend is not None and backend.can_encode(params or {}):
+        selection["encoder"] = encoder
+    return selection
+
+
+def _timed(function, rounds):
+    """多次运行取最短时间，返回(秒, 最后一次的结果)"""
+    best = None
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _same_pixels(a, b):
+    return a.mode == b.mode and a.size == b.size and a.tobytes() == b.tobytes()
+
+
+def choose_backends(sample_paths, params, candidates=None, rounds=2, verbose=True):
+    """用样本图片测试已安装的引擎，每种源格式选择解码最快的一个，再选择编码PNG最快的一个
+
+    只有解码结果（以及编码后重新读取的像素）与Pillow完全相同的引擎才会被选择；样本中没有的格式使用Pillow。
+
+    参数:
+        sample_paths: 样本图片路径
+        params: PNG保存参数
+        candidates: 参与测试的引擎名称，为空时测试所有已安装的引擎
+        rounds: 每个测试运行的次数（取最短时间）
+
+    返回:
+        dict: {"decoders": {源格式: 引擎名称}, "encoder": 引擎名称}，与resolve_backends()相同
+    """
+    names = [name for name in (candidates or BACKEND_NAMES) if get_backend(name) is not None]
+    if PILLOW not in names:
+        names.insert(0, PILLOW)
+    selection = {"decoders": {}, "encoder": PILLOW}
+    if len(names) == 1:
+        return selection
+
+    # 按源格式分组，用Pillow得到参考结果和耗时 / Group by source format; decode and time the Pillow reference
+    samples = {}
+    pillow = get_backend(PILLOW)
+    for path in sample_paths:
+        try:
+            with Image.open(path) as header:
+                fmt, mode = header.format, normalized_mode(header)
+                supported = [name for name in names if get_backend(name).supports(header)]
+            seconds, reference = _timed(lambda: pillow.decode(path, mode), rounds)
+        except Exception:
+            continue
+        samples.setdefault(fmt, []).append((path, mode, supported, reference, seconds))
+
+    decoded = []
+    for fmt, items in sorted(samples.items()):
+        decoded.extend(item[3] for item in items)
+        # 每个引擎只在它支持的样本上计时，与Pillow在相同样本上的耗时比较
+        # Each engine is timed on the samples it supports and compared with Pillow on the same samples
+        ratios = {}
+        for name in names:
+            if name == PILLOW:
+                continue
+            backend = get_backend(name)
+            total = baseline = 0.0
+            for path, mode, supported, reference, pillow_seconds in items:
+                if name not in supported:
+                    continue
+                try:
+                    seconds, img = _timed(lambda: backend.decode(path, mode), rounds)
+                    same = _same_pixels(img, reference)
+                except Exception:
+                    same = False
+                if not same:
+                    if verbose:
+                        print(f"  {fmt} {name}: 解码结果与Pillow不同，不使用 / Output differs from Pillow, skipped")
+                    baseline = 0.0
+                    break
+                total += seconds
+                baseline += pillow_seconds
+            if baseline > 0:
+                ratios[name] = total / baseline
+        best = min(ratios, key=ratios.get) if ratios else None
+        if best is not None and ratios[best] >= 1.0:
+            best = None
+        if verbose:
+            timings = "，".join(f"{name} {ratio:.2f}倍耗时" for name, ratio in ratios.items()) or "没有其它引擎支持"
+            print(f"  {fmt} 解码（相对Pillow）: {timings} -> {best or PILLOW} / {fmt} decode -> {best or PILLOW}")
+        if best is not None:
+            selection["decoders"][fmt] = best
+
+    # PNG编码：写入临时文件，用Pillow读回并比较像素 / PNG encode: write a temp file and compare after reading back
+    encoders = [name for name in names if get_backend(name).can_encode(params)]
+    if decoded and len(encoders) > 1:
+        totals = {}
+        with tempfile.TemporaryDirectory() as directory:
+            target = os.path.join(directory, "sample.png")
+            for name in encoders:
+                backend = get_backend(name)
+                total = 0.0
+                for img in decoded:
+                    try:
+                        seconds, _ = _timed(lambda: backend.encode(img, target, params), rounds)
+                        with Image.open(target) as written:
+                            written.load()
+                            same = _same_pixels(written, img)
+                    except Exception:
+                        same = False
+                    if not same:
+                        if verbose:
+                            print(f"  PNG {name}: 编码结果与Pillow不同，不使用 / Output differs from Pillow, skipped")
+                        total = None
+                        break
+                    total += seconds
+                if total is not None:
+                    totals[name] = total
+        # 所有引擎（包括Pillow，如遇到不常见的模式）都没有通过读回检查时仍使用Pillow
+        selection["encoder"] = min(totals, key=totals.get) if totals else PILLOW
+        if verbose:
+            timings = "，".join(f"{name} {seconds * 1000:.1f} 毫秒" for name, seconds in totals.items()) or "没有引擎通过检查"
+            print(f"  PNG编码: {timings} -> {selection['encoder']} / PNG encode -> {selection['encoder']}")
+    return selection
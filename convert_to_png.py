@@ -29,10 +29,22 @@ and preserves the original transparency channel of the image (if it exists) afte
    - 显示转换进度和结果统计 / Display conversion progress and result statistics
 
 【主要特点 / Main Features】
-- 多线程并行处理，加速转换过程 / Multi-threaded parallel processing to accelerate conversion
+- 多线程或多进程并行处理，加速转换过程 / Multi-threaded or multi-process parallel processing to accelerate conversion
+- 边遍历目录边提交任务，同时进行中的任务数有上限，百万级文件的目录也不会占用大量内存
+  / Files are submitted while the directory is walked, with a bounded number of tasks in flight,
+  so trees with millions of files do not blow up memory
 - 支持递归处理子目录中的图片 / Support recursive processing of images in subdirectories
 - 智能保留透明通道 / Intelligently preserve transparency channels
 - 自动删除已转换的原始文件 / Automatically delete converted original files
+- 可选的PNG编码配置（ENCODE_PROFILE）：fastest、balanced、smallest，或按吞吐量目标自动选择的auto
+  / Selectable PNG encode profiles (ENCODE_PROFILE): fastest, balanced, smallest, or auto picked by a throughput target
+- 可选的长边上限（MAX_DIMENSION），JPEG在DCT域直接缩小解码，其它格式用reduce()快速缩小
+  / Optional long edge limit (MAX_DIMENSION): JPEG is downscaled in the DCT domain while decoding, other formats use reduce()
+- 可选的编解码引擎（CODEC_BACKENDS）：按格式使用OpenCV或pyvips解码、编码PNG，或测试后自动选择，输出与Pillow相同
+  / Optional codec engines (CODEC_BACKENDS): OpenCV or pyvips per format for decoding and PNG encoding, or chosen
+  automatically by a benchmark, with output identical to Pillow
+- 可选的阶段耗时追踪（TRACE_FILE），输出可在Perfetto中打开的Chrome trace文件
+  / Optional stage tracing (TRACE_FILE) written as a Chrome trace that opens in Perfetto
 
 【支持的图片格式 / Supported Image Formats】
 - jpg, jpeg / JPEG format
@@ -48,18 +60,293 @@ and preserves the original transparency channel of the image (if it exists) afte
 - 需要安装PIL/Pillow库 / PIL/Pillow library needs to be installed
 """
 
+import contextlib
+import io
+import itertools
 import os
 import sys
+import time
 from pathlib import Path
 import shutil
 from PIL import Image
 import concurrent.futures
 
-def convert_image_to_png(source_path, verbose=True):
+# 并行方式 / Parallelism
+# "thread": 线程池（默认）; "process": 进程池，PNG压缩和模式转换主要消耗CPU，多核机器上更快
+# "thread": thread pool (default); "process": process pool, faster on multi-core machines
+# because PNG compression and mode conversion are mostly CPU-bound
+EXECUTOR_MODE = "thread"
+MAX_WORKERS = None  # 工作线程/进程数，None时自动选择 / Number of workers, chosen automatically when None
+CHUNK_SIZE = None  # 进程池模式下每个任务包含的图片数，None时自动选择 / Images per task in process mode, automatic when None
+MAX_IN_FLIGHT = None  # 同时提交的任务数上限，None时为工作数的2倍 / Max tasks in flight, twice the workers when None
+
+# PNG编码配置 / PNG encode profiles
+# Pillow不能选择PNG行过滤方式，配置通过zlib压缩级别和optimize控制
+# Pillow does not expose the PNG row filter choice, so profiles use the zlib level and optimize
+PNG_PROFILES = {
+    "fastest": {"compress_level": 1},  # 最快，文件稍大 / Fastest, slightly larger files
+    "balanced": {"compress_level": 6},  # Pillow的默认值 / Pillow's default
+    "smallest": {"optimize": True, "compress_level": 9},  # 最小，最慢 / Smallest, slowest
+}
+# "fastest"、"balanced"、"smallest"，或"auto": 用开头的几张图片测试，选择满足速度目标的最小输出
+# "fastest", "balanced", "smallest", or "auto": benchmark the first images and pick the smallest output meeting the target
+ENCODE_PROFILE = "balanced"
+AUTO_TARGET_MPIXELS = 20.0  # "auto"时每个工作线程/进程的编码速度目标（百万像素/秒） / Encode target per worker (megapixels/s)
+AUTO_SAMPLE_IMAGES = 3  # "auto"时测试的图片数 / Images benchmarked by "auto"
+AUTO_LEVELS = (1, 2, 3, 4, 6, 9)  # "auto"时比较的zlib压缩级别 / zlib levels compared by "auto"
+
+# 解码时缩小 / Downscale while decoding
+# 设置后长边超过该像素数的图片按比例缩小到该尺寸：JPEG用draft()在DCT域直接按1/2、1/4、1/8解码，
+# 其它格式解码后先用reduce()按整数倍缩小，最后再精确缩放。原文件会被删除，缩小后无法恢复原始分辨率
+# When set, images whose long edge exceeds this many pixels are scaled to fit: JPEG uses draft() to decode
+# at 1/2, 1/4 or 1/8 scale in the DCT domain, other formats are reduce()d by an integer factor after
+# decoding and then resized exactly. Originals are deleted, so the full resolution cannot be recovered
+MAX_DIMENSION = None
+
+# 编解码引擎 / Codec backends
+# "pillow": 只使用Pillow（默认）; "auto": 用开头的几张图片测试已安装的引擎（Pillow、OpenCV、pyvips），
+# 每种源格式选择解码最快且结果与Pillow完全相同的引擎，PNG编码同样如此;
+# 也可以指定一个引擎名称，或按格式指定的字典，如 {"TIFF": "vips", "WEBP": "opencv"}
+# "pillow": Pillow only (default); "auto": benchmark the installed engines (Pillow, OpenCV, pyvips) on the
+# first images and pick, per source format, the fastest decoder whose output matches Pillow exactly, and
+# likewise for PNG encoding; or give one engine name, or a per-format dict such as {"TIFF": "vips", "WEBP": "opencv"}
+CODEC_BACKENDS = "pillow"
+PNG_ENCODER = "pillow"  # PNG编码引擎，CODEC_BACKENDS为"auto"时自动选择 / PNG encoder, chosen automatically with "auto"
+CODEC_SAMPLE_IMAGES = 8  # "auto"时测试的图片数 / Images benchmarked by "auto"
+
+# 阶段耗时追踪 / Stage tracing
+# 设置文件名（如"convert_trace.json"）后记录每个阶段、每张图片的耗时
+# Set a file name (such as "convert_trace.json") to record per-stage, per-image spans
+TRACE_FILE = None
+PROFILE_SLOWEST = 0  # 为最慢的多少张图片保存cProfile结果 / Save cProfile results for the N slowest images
+MEMORY_SLOWEST = 0  # 为最慢的多少张图片保存tracemalloc快照 / Save tracemalloc snapshots for the N slowest images
+
+def _span(tracer, name, path=None, profile=False):
+    """
+    未启用追踪时返回空的上下文 / Return an empty context when tracing is off
+    """
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.span(name, "convert", image=path, profile=profile)
+
+class EncodeStats(object):
+    """
+    PNG编码的耗时和输出大小统计 / Encode time and output size statistics
+    """
+    def __init__(self):
+        self.images = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def add(self, seconds, size):
+        self.images += 1
+        self.seconds += seconds
+        self.bytes += size
+
+    def merge(self, other):
+        self.images += other.images
+        self.seconds += other.seconds
+        self.bytes += other.bytes
+
+    def summary(self):
+        if not self.images:
+            return "没有编码图片 / No images encoded"
+        return (f"编码 {self.images} 张，耗时 {self.seconds:.2f} 秒（平均 {self.seconds / self.images * 1000:.1f} 毫秒/张），"
+                f"输出 {self.bytes / 1024 / 1024:.1f} MB（平均 {self.bytes / self.images / 1024:.0f} KB/张） "
+                f"/ Encoded {self.images} images in {self.seconds:.2f}s, {self.bytes / 1024 / 1024:.1f} MB written")
+
+def encode_params(profile=None):
+    """
+    返回编码配置对应的PNG保存参数，profile可以是配置名称或参数字典；"auto"需要先由choose_auto_params()测试
+    Return PNG save parameters for a profile name or parameter dict; "auto" must be resolved by choose_auto_params() first
+    """
+    profile = profile or ENCODE_PROFILE
+    if isinstance(profile, dict):
+        return profile
+    if profile == "auto":
+        return PNG_PROFILES["balanced"]  # 单独转换一张图片时不测试 / Single conversions skip the benchmark
+    if profile not in PNG_PROFILES:
+        raise ValueError(f"未知的编码配置: {profile} / Unknown encode profile")
+    return PNG_PROFILES[profile]
+
+def normalized_mode(img):
+    """
+    规范化后的模式：有透明通道时为RGBA，否则为RGB（只读取文件头中的信息，不需要解码）
+    Normalized mode: RGBA when the image has transparency, otherwise RGB (header info only, no decode needed)
+    """
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        return 'RGBA'
+    return 'RGB'
+
+def normalize_mode(img):
+    """
+    有透明通道时转换为RGBA，否则转换为RGB / Convert to RGBA when the image has transparency, otherwise to RGB
+    """
+    # 保留透明通道，否则转换为RGB / Preserve transparency channel, otherwise convert to RGB
+    return img.convert(normalized_mode(img))
+
+def fit_size(size, max_dimension):
+    """
+    按比例缩小到长边不超过max_dimension的尺寸，不需要缩小时返回None
+    Scale a size so the long edge fits max_dimension, or None when no downscale is needed
+    """
+    width, height = size
+    if not max_dimension or max(width, height) <= max_dimension:
+        return None
+    scale = max_dimension / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def draft_for_size(img, target):
+    """
+    在load()之前调用：JPEG按不小于目标的最小1/2、1/4、1/8比例解码，其它格式不变；返回是否启用了draft
+    Call before load(): JPEG decodes at the smallest 1/2, 1/4 or 1/8 scale not below the target; other formats are untouched.
+    Returns whether a draft scale was applied
+    """
+    if target is None or img.format != 'JPEG':
+        return False
+    # draft()只能选择Pillow支持的解码模式，保持原模式 / Keep the source mode, draft() only changes the scale here
+    return img.draft(img.mode, target) is not None
+
+def shrink_to_size(img, target):
+    """
+    在load()之后调用：先用reduce()按整数倍快速缩小，再用LANCZOS精确缩放到目标尺寸
+    Call after load(): reduce() by an integer factor first, then resize exactly to the target with LANCZOS
+    """
+    if target is None or img.size == target:
+        return img
+    factor = min(img.width // target[0], img.height // target[1])
+    if factor >= 2:
+        # 保留至少2倍的余量给LANCZOS，避免整数缩小带来锯齿 / Leave 2x headroom for LANCZOS to avoid aliasing
+        factor = max(1, factor // 2)
+        if factor >= 2:
+            img = img.reduce(factor)
+    if img.size != target:
+        img = img.resize(target, Image.LANCZOS)
+    return img
+
+def choose_auto_params(sample_paths, target_mpixels=None, levels=None, verbose=True):
+    """
+    在内存中用不同的zlib级别编码样本图片，返回满足速度目标的级别中输出最小的保存参数
+    Encode the sample images in memory at each zlib level and return the smallest output that meets the speed target
+    """
+    target_mpixels = target_mpixels or AUTO_TARGET_MPIXELS
+    levels = levels or AUTO_LEVELS
+    images = []
+    for path in sample_paths:
+        try:
+            with Image.open(path) as img:
+                images.append(normalize_mode(img))
+        except Exception:
+            continue
+    if not images:
+        return PNG_PROFILES["balanced"]
+    pixels = sum(img.width * img.height for img in images)
+    best = None
+    for level in levels:
+        start = time.perf_counter()
+        size = 0
+        for img in images:
+            buffer = io.BytesIO()
+            img.save(buffer, 'PNG', compress_level=level)
+            size += buffer.tell()
+        speed = pixels / 1e6 / max(time.perf_counter() - start, 1e-9)
+        if verbose:
+            print(f"  zlib级别 {level}: {speed:.1f} 百万像素/秒，{size / 1024:.0f} KB / level {level}: {speed:.1f} MP/s")
+        # 达到目标的级别中选输出最小的；都达不到时选最快的 / Smallest among levels meeting the target, else the fastest
+        meets = speed >= target_mpixels
+        key = (meets, -size if meets else speed)
+        if best is None or key > best[0]:
+            best = (key, level)
+    return {"compress_level": best[1]}
+
+def _decoder_for(img, codecs):
+    """
+    返回为该图片格式选择的非Pillow解码引擎，没有或不支持该图片时返回None
+    Return the non-Pillow decoder chosen for the image's format, or None when there is none or it can't take the image
+    """
+    name = codecs["decoders"].get(img.format) if codecs else None
+    if name is None:
+        return None
+    from codec_backends import get_backend  # 仅在启用其它引擎时需要 / Only needed with other engines
+    backend = get_backend(name)
+    return backend if backend is not None and backend.supports(img) else None
+
+def _encoder_for(codecs, params):
+    """
+    返回选择的非Pillow PNG编码引擎，没有时返回None / Return the chosen non-Pillow PNG encoder, or None
+    """
+    name = codecs.get("encoder") if codecs else None
+    if not name or name == "pillow":
+        return None
+    from codec_backends import get_backend
+    backend = get_backend(name)
+    return backend if backend is not None and backend.can_encode(params) else None
+
+def decode_image(source, tracer=None, max_dimension=None, path=None, codecs=None):
+    """
+    打开、解码并规范化图片（有透明通道时为RGBA，否则为RGB），需要时缩小到长边上限；转换和融合描述共用
+    Open, decode and normalize an image (RGBA with transparency, otherwise RGB), shrinking it to the long edge
+    limit when needed; shared by conversion and the fused describe mode
+
+    source: 文件路径或文件对象（如io.BytesIO） / File path or file object (such as io.BytesIO)
+    path: 追踪中记录的图片路径，为空时使用source / Image path recorded in spans, source when empty
+    codecs: 编解码引擎选择（参见codec_backends），为空时只使用Pillow / Codec selection (see codec_backends), Pillow only when empty
+    返回 / Returns: (图片, 原始尺寸, 解码尺寸, 是否使用了JPEG draft) / (image, original size, decoded size, JPEG draft used)
+    """
+    path = path or (source if isinstance(source, str) else None)
+    # 打开图片 / Open the image
+    with _span(tracer, "open", path):
+        img = Image.open(source)
+    
+    # 需要缩小时，JPEG直接按较小的比例解码 / When downscaling, JPEG decodes straight at a smaller scale
+    original_size = img.size
+    target = fit_size(original_size, max_dimension)
+    
+    # 不需要缩小时可以使用其它解码引擎，透明通道的处理仍由文件头决定
+    # Other decoders are used when no downscale is needed; alpha handling is still decided from the header
+    decoder = _decoder_for(img, codecs) if target is None else None
+    if decoder is not None:
+        try:
+            with _span(tracer, "decode", path):
+                decoded = decoder.decode(source, normalized_mode(img))
+            img.close()
+            return decoded, original_size, decoded.size, False
+        except Exception:
+            pass  # 交给Pillow解码并报告错误 / Fall back to Pillow, which reports any error
+    drafted = draft_for_size(img, target)
+    
+    # 解码像素数据 / Decode pixel data
+    with _span(tracer, "decode", path):
+        img.load()
+    decoded_size = img.size
+    
+    # 如果图片有透明通道，保留它；否则转换为RGB / If image has transparency, preserve it; otherwise convert to RGB
+    with _span(tracer, "convert_mode", path):
+        img = normalize_mode(img)
+    
+    # 缩小到长边上限 / Shrink to the long edge limit
+    if target is not None:
+        with _span(tracer, "downscale", path):
+            img = shrink_to_size(img, target)
+    return img, original_size, decoded_size, drafted
+
+def convert_image_to_png(source_path, verbose=True, tracer=None, params=None, stats=None, max_dimension=None,
+                         codecs=None):
     """
     将单个图片转换为PNG格式
     Convert a single image to PNG format
+
+    tracer: TraceRecorder实例，为空时不记录耗时 / TraceRecorder instance, no spans are recorded when empty
+    params: PNG保存参数，为空时使用ENCODE_PROFILE / PNG save parameters, ENCODE_PROFILE when empty
+    stats: EncodeStats实例，记录编码耗时和输出大小 / EncodeStats instance recording encode time and output size
+    max_dimension: 长边的像素上限，为空时使用MAX_DIMENSION / Long edge limit in pixels, MAX_DIMENSION when empty
+    codecs: 编解码引擎选择（参见codec_backends），为空时只使用Pillow / Codec selection (see codec_backends), Pillow only when empty
     """
+    with _span(tracer, "convert_image", source_path, profile=True):
+        return _convert_image_to_png(source_path, verbose, tracer, params or encode_params(), stats,
+                                     max_dimension or MAX_DIMENSION, codecs)
+
+def _convert_image_to_png(source_path, verbose, tracer, params, stats, max_dimension, codecs):
     try:
         # 检查源文件是否存在 / Check if source file exists
         if not os.path.exists(source_path):
@@ -76,29 +363,38 @@ def convert_image_to_png(source_path, verbose=True):
                 print(f"文件已经是PNG格式: {source_path} / File is already in PNG format")
             return True, "已经是PNG格式 / Already PNG"
             
-        # 打开图片 / Open the image
-        img = Image.open(source_path)
-        
-        # 如果图片有透明通道，保留它；否则转换为RGB / If image has transparency, preserve it; otherwise convert to RGB
-        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-            # 保留透明通道 / Preserve transparency channel
-            img = img.convert('RGBA')
-        else:
-            # 转换为RGB / Convert to RGB
-            img = img.convert('RGB')
+        # 打开、解码并规范化图片 / Open, decode and normalize the image
+        img, original_size, decoded_size, drafted = decode_image(source_path, tracer, max_dimension, codecs=codecs)
+        if img.size != original_size:
+            if verbose:
+                print(f"  缩小: {original_size[0]}x{original_size[1]} -> {img.width}x{img.height}"
+                      f"（解码尺寸 {decoded_size[0]}x{decoded_size[1]}{'，JPEG draft' if drafted else ''}） / Downscaled")
             
         # 保存为PNG / Save as PNG
-        img.save(target_path, 'PNG')
+        encoder = _encoder_for(codecs, params)
+        with _span(tracer, "encode", source_path):
+            start = time.perf_counter()
+            if encoder is not None:
+                encoder.encode(img, target_path, params)
+            else:
+                img.save(target_path, 'PNG', **params)
+            encode_seconds = time.perf_counter() - start
         
         # 验证转换是否成功 / Verify if conversion was successful
-        if os.path.exists(target_path) and os.path.getsize(target_path) > 0:
+        with _span(tracer, "verify", source_path):
+            size = os.path.getsize(target_path) if os.path.exists(target_path) else 0
+        if size > 0:
+            if stats is not None:
+                stats.add(encode_seconds, size)
             if verbose:
-                print(f"✓ 转换成功: {source_path} -> {target_path} / Conversion successful")
+                print(f"✓ 转换成功: {source_path} -> {target_path}（编码 {encode_seconds * 1000:.1f} 毫秒，"
+                      f"{size / 1024:.0f} KB） / Conversion successful")
                 
             # 如果源文件不是PNG文件，可以选择删除它 / If source file is not a PNG file, optionally delete it
             if Path(source_path).suffix.lower() != '.png':
                 try:
-                    os.remove(source_path)
+                    with _span(tracer, "delete", source_path):
+                        os.remove(source_path)
                     if verbose:
                         print(f"  已删除原文件 / Original file deleted")
                 except Exception as e:
@@ -116,68 +412,202 @@ def convert_image_to_png(source_path, verbose=True):
             print(f"✗ 处理图片时出错: {source_path} - {str(e)} / Error processing image")
         return False, f"错误: {str(e)} / Error: {str(e)}"
 
-def process_directory(directory_path, recursive=True, verbose=True):
+# 图片文件扩展名 / Image file extensions
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff', '.tif'}
+
+def select_codecs(codecs, params, sample_paths=(), verbose=True):
+    """
+    把编解码引擎配置转换为选择结果（可以传给工作进程），只使用Pillow时返回None
+    Turn a codec config into a selection (picklable for worker processes); None when only Pillow is used
+
+    codecs: "pillow"、"auto"、引擎名称、源格式 -> 引擎名称的字典，或已经选择好的结果
+            / "pillow", "auto", an engine name, a source format -> engine dict, or an existing selection
+    """
+    if isinstance(codecs, dict) and "decoders" in codecs:
+        return codecs
+    if codecs in (None, "pillow") and PNG_ENCODER == "pillow":
+        return None  # 不导入其它引擎 / Don't import other engines
+    import codec_backends
+    if codecs == "auto":
+        if verbose:
+            print(f"测试编解码引擎（已安装: {', '.join(codec_backends.available_backends())}） / Benchmarking codec engines")
+        selection = codec_backends.choose_backends(sample_paths, params, verbose=verbose)
+    else:
+        selection = codec_backends.resolve_backends(codecs or "pillow", PNG_ENCODER, params)
+        if verbose:
+            # 未安装的引擎改用Pillow / Engines that are not installed fall back to Pillow
+            print(f"已安装的编解码引擎: {', '.join(codec_backends.available_backends())} / Installed codec engines")
+    if verbose:
+        decoders = ", ".join(f"{fmt}: {name}" for fmt, name in sorted(selection["decoders"].items())) or "pillow"
+        print(f"解码引擎: {decoders}，PNG编码引擎: {selection['encoder']} / Decoders and PNG encoder")
+    if not selection["decoders"] and selection["encoder"] == "pillow":
+        return None
+    return selection
+
+def iter_image_files(directory_path, recursive=True, tracer=None):
+    """
+    边遍历目录边逐个返回图片文件路径，不在内存中保存完整列表
+    Lazily yield image file paths while walking the directory, without holding the full list
+    """
+    for root, dirs, files in os.walk(directory_path):
+        with _span(tracer, "scan", root):
+            found = [os.path.join(root, file) for file in files
+                     if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS]
+        yield from found
+        
+        # 如果不递归，则在第一层后停止 / If not recursive, stop after the first level
+        if not recursive:
+            break
+
+def default_workers(mode):
+    """
+    自动选择工作线程/进程数 / Choose the number of workers automatically
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))  # 只计算本进程可以使用的CPU / Only CPUs this process may use
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    if mode == "process":
+        return cpus
+    # 线程模式下解码和编码的一部分时间会释放GIL / Decode and encode release the GIL part of the time
+    return min(10, cpus * 2)
+
+def _convert_chunk(paths, verbose, params, trace_origin=None, max_dimension=None, codecs=None):
+    """
+    在工作进程中转换一组图片，返回每张图片的结果、追踪事件和编码统计
+    Convert a chunk of images in a worker process, returning each result, the trace events and encode statistics
+    """
+    tracer = None
+    if trace_origin is not None:
+        from trace_recorder import TraceRecorder
+        tracer = TraceRecorder(origin=trace_origin)
+    stats = EncodeStats()
+    results = [convert_image_to_png(path, verbose, tracer, params, stats, max_dimension, codecs) for path in paths]
+    return results, tracer.events() if tracer is not None else None, stats
+
+def _convert_chunk_in_thread(paths, verbose, params, tracer, max_dimension=None, codecs=None):
+    """
+    在线程池中转换一组图片，追踪事件直接记录到共享的tracer中
+    Convert a chunk of images in the thread pool; spans go straight to the shared tracer
+    """
+    stats = EncodeStats()
+    return ([convert_image_to_png(path, verbose, tracer, params, stats, max_dimension, codecs) for path in paths],
+            None, stats)
+
+def _bounded_completions(executor, tasks, max_in_flight):
+    """
+    逐个提交任务，进行中的任务达到上限时等待其中一个完成；按完成顺序返回Future
+    Submit tasks one by one, waiting for one to finish whenever the limit is reached; yield futures as they complete
+    """
+    pending = set()
+    for task in tasks:
+        pending.add(executor.submit(*task))
+        if len(pending) >= max_in_flight:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            yield from done
+    yield from concurrent.futures.as_completed(pending)
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def process_directory(directory_path, recursive=True, verbose=True, tracer=None, mode=None, workers=None,
+                      chunk_size=None, max_in_flight=None, profile=None, max_dimension=None, codecs=None):
     """
     处理目录中的所有图片
     Process all images in a directory
+
+    tracer: TraceRecorder实例，为空时不记录耗时 / TraceRecorder instance, no spans are recorded when empty
+    mode: "thread"或"process"，为空时使用EXECUTOR_MODE / "thread" or "process", EXECUTOR_MODE when empty
+    workers: 工作线程/进程数，为空时使用MAX_WORKERS或自动选择 / Number of workers, MAX_WORKERS or automatic when empty
+    chunk_size: 进程池模式下每个任务包含的图片数 / Images per task in process mode
+    max_in_flight: 同时提交的任务数上限 / Max tasks in flight
+    profile: PNG编码配置名称或保存参数，为空时使用ENCODE_PROFILE / Encode profile name or save parameters, ENCODE_PROFILE when empty
+    max_dimension: 长边的像素上限，为空时使用MAX_DIMENSION / Long edge limit in pixels, MAX_DIMENSION when empty
+    codecs: 编解码引擎配置（同CODEC_BACKENDS）或codec_backends返回的选择，为空时使用CODEC_BACKENDS
+            / Codec config (like CODEC_BACKENDS) or a selection from codec_backends, CODEC_BACKENDS when empty
+
+    返回 / Returns: 统计信息字典，目录不存在时为None / Statistics dict, None when the directory doesn't exist
     """
     # 确保目录存在 / Ensure directory exists
     if not os.path.exists(directory_path) or not os.path.isdir(directory_path):
         print(f"错误: 目录不存在: {directory_path} / Error: Directory doesn't exist")
         return
-        
-    # 图片文件扩展名 / Image file extensions
-    image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff', '.tif'}
     
-    # 收集要处理的文件 / Collect files to process
-    image_files = []
-    
-    # 遍历目录 / Traverse directory
-    for root, dirs, files in os.walk(directory_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            extension = os.path.splitext(file)[1].lower()
-            
-            # 检查是否是图片文件 / Check if it's an image file
-            if extension in image_extensions:
-                image_files.append(file_path)
-                
-        # 如果不递归，则在第一层后停止 / If not recursive, stop after the first level
-        if not recursive:
-            break
+    mode = mode or EXECUTOR_MODE
+    if mode not in ("thread", "process"):
+        raise ValueError(f"未知的并行方式: {mode} / Unknown executor mode")
+    workers = workers or MAX_WORKERS or default_workers(mode)
+    # 进程池按组提交，减少进程间通信；线程池逐张提交 / Chunks reduce IPC in process mode; threads take one image per task
+    chunk_size = chunk_size or CHUNK_SIZE or (8 if mode == "process" else 1)
+    max_in_flight = max_in_flight or MAX_IN_FLIGHT or workers * 2
+    max_dimension = max_dimension or MAX_DIMENSION
     
     # 统计信息 / Statistics
-    total_images = len(image_files)
+    total_images = 0
     successful = 0
     failed = 0
     skipped = 0
     
     if verbose:
-        print(f"\n找到 {total_images} 个图片文件 / Found {total_images} image files")
-    
-    # 使用线程池加速处理 / Use thread pool to speed up processing
-    with concurrent.futures.ThreadPoolExecutor(max_workers=min(10, os.cpu_count() * 2)) as executor:
-        # 创建转换任务 / Create conversion tasks
-        future_to_path = {
-            executor.submit(convert_image_to_png, path, verbose): path 
-            for path in image_files
-        }
-        
+        print(f"\n使用{'进程' if mode == 'process' else '线程'}池，{workers} 个工作{'进程' if mode == 'process' else '线程'} "
+              f"/ Using a {mode} pool with {workers} workers")
+    
+    # 边遍历目录边提交任务 / Submit tasks while walking the directory
+    paths = iter_image_files(directory_path, recursive, tracer)
+    profile = profile or ENCODE_PROFILE
+    codecs = codecs or CODEC_BACKENDS
+    sample = []
+    if profile == "auto" or codecs == "auto":
+        # 用开头的几张图片测试，之后放回待处理的图片中 / Benchmark on the first images, then put them back
+        sample = list(itertools.islice(paths, max(AUTO_SAMPLE_IMAGES, CODEC_SAMPLE_IMAGES)))
+        paths = itertools.chain(sample, paths)
+    if profile == "auto":
+        if verbose:
+            print(f"测试编码速度（目标 {AUTO_TARGET_MPIXELS:g} 百万像素/秒） / Benchmarking encode speed")
+        params = choose_auto_params(sample[:AUTO_SAMPLE_IMAGES], verbose=verbose)
+    else:
+        params = encode_params(profile)
+    if verbose:
+        print(f"编码配置: {profile} {params} / Encode profile")
+        if max_dimension:
+            print(f"长边上限: {max_dimension} 像素 / Max dimension")
+    codecs = select_codecs(codecs, params, sample[:CODEC_SAMPLE_IMAGES], verbose)
+    encode_stats = EncodeStats()
+    
+    chunks = _chunks(paths, chunk_size)
+    if mode == "process":
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        # 工作进程的追踪事件使用同一个时间起点，合并到主进程的trace中 / Worker spans share the parent's time origin
+        trace_origin = tracer.origin if tracer is not None else None
+        tasks = ((_convert_chunk, chunk, verbose, params, trace_origin, max_dimension, codecs) for chunk in chunks)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        tasks = ((_convert_chunk_in_thread, chunk, verbose, params, tracer, max_dimension, codecs) for chunk in chunks)
+    
+    with executor:
         # 处理结果 / Process results
-        for i, future in enumerate(concurrent.futures.as_completed(future_to_path), 1):
-            path = future_to_path[future]
-            success, message = future.result()
-            
-            if success:
-                if "已经是PNG格式" in message:
-                    skipped += 1
+        for future in _bounded_completions(executor, tasks, max_in_flight):
+            results, events, stats = future.result()
+            encode_stats.merge(stats)
+            if events:
+                tracer.merge(events)
+            for success, message in results:
+                total_images += 1
+                if success:
+                    if "已经是PNG格式" in message:
+                        skipped += 1
+                    else:
+                        successful += 1
                 else:
-                    successful += 1
-            else:
-                failed += 1
+                    failed += 1
                 
             if verbose:
-                print(f"进度: {i}/{total_images} ({i/total_images*100:.1f}%) / Progress")
+                print(f"进度: 已处理 {total_images} 张 / Progress: {total_images} processed")
     
     # 显示最终统计 / Show final statistics
     print("\n转换完成! / Conversion completed!")
@@ -185,6 +615,9 @@ def process_directory(directory_path, recursive=True, verbose=True):
     print(f"成功转换: {successful} / Successfully converted")
     print(f"已是PNG格式: {skipped} / Already PNG")
     print(f"转换失败: {failed} / Failed")
+    print(encode_stats.summary())
+    return {"total": total_images, "successful": successful, "skipped": skipped, "failed": failed,
+            "encode_seconds": encode_stats.seconds, "output_bytes": encode_stats.bytes}
 
 def main():
     """
@@ -209,7 +642,18 @@ def main():
             return
     
     # 处理目录 / Process directory
-    process_directory(picture_dir, recursive=True)
+    tracer = None
+    if TRACE_FILE:
+        from trace_recorder import TraceRecorder  # 仅在启用追踪时需要 / Only needed when tracing
+        tracer = TraceRecorder(profile_slowest=PROFILE_SLOWEST, memory_slowest=MEMORY_SLOWEST)
+    try:
+        process_directory(picture_dir, recursive=True, tracer=tracer)
+    finally:
+        if tracer is not None:
+            slowest_dir = tracer.save(TRACE_FILE)
+            print(f"追踪文件已保存: {TRACE_FILE}（可在 https://ui.perfetto.dev 中打开） / Trace saved")
+            if slowest_dir:
+                print(f"最慢图片的分析结果: {slowest_dir} / Profiles of the slowest images")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+图片描述缓存 / Image Description Cache
+========================================================
+
+【功能说明 / Function Description】
+按内容寻址的持久化描述缓存。缓存键由图片字节的哈希、渲染后的提示词
+以及模型参数（gen_params中的chat设置）共同计算得到，
+因此不同文件夹中完全相同的图片、或重新生成相同提示词的描述时，
+都可以直接命中缓存而不再调用接口。修改提示词或模型参数后会自动失效。
+
+A persistent, content-addressed description cache. The key is computed from
+the hash of the image bytes, the rendered prompt and the model parameters (the
+chat settings of gen_params), so byte-identical images in different folders,
+or re-running the same prompt, hit the cache without an API call. Changing the
+prompt or the model parameters naturally produces new keys.
+
+【淘汰策略 / Eviction Policy】
+- max_age: 超过指定秒数的条目会被删除 / Entries older than max_age seconds are removed
+- max_entries: 条目数超过上限时按最近访问时间淘汰 / Least recently used entries are
+  removed once the entry count exceeds max_entries
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+def image_digest(image_data):
+    """计算图片字节的sha256摘要"""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """分块计算图片文件的sha256摘要，不把整个文件读入内存"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_cache_key(digest, prompt, model_signature):
+    """由图片摘要、提示词和模型参数计算缓存键
+
+    参数:
+        digest: image_digest()或file_digest()的结果
+        prompt: 渲染后的提示词
+        model_signature: 模型参数的字符串表示，见SparkImageClient.model_signature()
+    """
+    h = hashlib.sha256()
+    for part in (digest, prompt, model_signature):
+        h.update(part.encode('utf-8'))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class DescriptionCache(object):
+    """基于SQLite的描述缓存，可以被多个线程同时使用
+
+    参数:
+        path: 缓存数据库文件路径
+        max_entries: 条目数上限，为None时不限制
+        max_age: 条目最长保留时间（秒），为None时不限制
+        evict_every: 每写入多少条执行一次淘汰
+    """
+
+    def __init__(self, path, max_entries=None, max_age=None, evict_every=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS descriptions ("
+            " key TEXT PRIMARY KEY,"
+            " result TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_descriptions_accessed ON descriptions(accessed)")
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key):
+        """查询缓存，未命中或已过期时返回None"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT result, created FROM descriptions WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.max_age is not None and now - row[1] > self.max_age):
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE descriptions SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, result):
+        """写入缓存"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO descriptions (key, result, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, result, now, now))
+            self._conn.commit()
+            self._puts_since_evict += 1
+            need_evict = self._puts_since_evict >= self.evict_every
+        if need_evict:
+            self.evict()
+
+    def evict(self):
+        """按年龄和条目数上限淘汰缓存，返回删除的条目数"""
+        removed = 0
+        with self._lock:
+            self._puts_since_evict = 0
+            if self.max_age is not None:
+                cur = self._conn.execute("DELETE FROM descriptions WHERE created < ?", (time.time() - self.max_age,))
+                removed += cur.rowcount
+            if self.max_entries is not None:
+                cur = self._conn.execute(
+                    "DELETE FROM descriptions WHERE key IN ("
+                    " SELECT key FROM descriptions ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,))
+                removed += cur.rowcount
+            self._conn.commit()
+        return removed
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM descriptions").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
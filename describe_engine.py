@@ -0,0 +1,801 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+并发描述引擎 / Concurrent Description Engine
+========================================================
+
+【功能说明 / Function Description】
+基于asyncio的图片描述调度器，同时保持最多N个描述请求在进行中。
+每张图片对应一个DescribeJob，读取图片、调用接口、写入同名.txt文件
+都在该任务自身的状态内完成，互不干扰。
+
+An asyncio based scheduler for image descriptions that keeps up to N describe
+requests in flight. Each image is represented by a DescribeJob; reading the
+image, calling the API and writing the same-named .txt file all happen within
+that job's own state.
+
+并发数由AdaptiveRateController动态控制：成功时增加，限流时降低，
+持续失败时熔断暂停。失败的任务按RetryPolicy指数退避后重新排队，不会写入空结果；
+最终失败的任务写入死信文件，之后可以重放。
+
+The number of requests in flight is driven by an AdaptiveRateController: it
+grows on success, shrinks on throttling and pauses on sustained failures.
+Failed jobs are queued again after the RetryPolicy's exponential backoff
+instead of writing an empty result; jobs that finally fail are written to the
+dead-letter log for a later replay.
+
+如果提供了DescriptionCache，命中缓存的图片直接写入结果而不调用接口；
+同一缓存键的请求正在进行时，其它相同任务会等待它的结果，而不是重复请求。
+
+When a DescriptionCache is given, cache hits are written without calling the
+API, and jobs whose cache key is already in flight wait for that request's
+result instead of sending a duplicate.
+
+如果提供了PayloadCompressor，图片在上传前会被缩小并重新编码到设定的字节预算以内。
+
+When a PayloadCompressor is given, images are downsized and re-encoded to the
+configured byte budget before upload.
+
+请求在网络上进行时，预读取线程池提前读取并压缩后面的图片，预读取的数据总量按字节数限制
+（而不是按图片数量），超大的图片不预读取，发送时从磁盘流式读取；描述文件由单独的写入线程保存，
+请求线程和并发名额在收到结果后立即释放。
+
+While requests are on the wire, a prefetch thread pool reads and compresses the
+upcoming images. Prefetched data is bounded by a byte budget rather than an
+item count; images larger than the budget are not prefetched and are streamed
+from disk when sent. Description files are written by a separate writer stage,
+so request threads and concurrency slots are freed as soon as a result arrives.
+
+如果提供了输出存储（JsonlOutputStore / SqliteOutputStore），描述追加写入分片存储而不是.txt文件。
+
+When an output store (JsonlOutputStore / SqliteOutputStore) is given,
+descriptions are appended to its shards instead of .txt files.
+
+如果提供了LeaseManager，每个任务在处理前先认领租约，已被其它工作进程认领的任务直接跳过。
+
+When a LeaseManager is given, each job claims a lease before it is processed;
+jobs claimed by another worker are skipped.
+
+如果提供了DescribeMetrics，每次请求的连接耗时、首个结果耗时、总耗时、上传字节数和错误码都会被记录，
+运行期间还提供队列长度、进行中的请求数等实时数值。
+
+When a DescribeMetrics is given, the connect time, time to first token, total
+latency, uploaded bytes and error code of every request are recorded, and
+queue depth, in-flight requests and similar live values are exposed during a run.
+
+如果提供了HedgePolicy，请求超过延迟阈值仍未完成时再发送一个相同的请求，采用先成功的一个；
+如果提供了AnswerBudget，每次请求按提示词中的字数要求设置max_tokens，描述超出字数后提前关闭连接。
+
+When a HedgePolicy is given, a duplicate request is sent once a request runs
+past the latency threshold and the first success wins. When an AnswerBudget is
+given, max_tokens follows the length asked for in the prompt and the connection
+is closed early once the description exceeds it.
+
+如果提供了FusedConverter，图片在内存中解码和规范化后直接上传（可以是JPEG、WebP、TIFF等原始图片），
+不需要先用convert_to_png.py转换；PNG文件可以在后台同时写出。
+
+When a FusedConverter is given, images are decoded and normalized in memory and
+uploaded directly (raw JPEG, WebP, TIFF and so on), without converting them with
+convert_to_png.py first; the PNG file can be written in the background.
+
+如果提供了TraceRecorder，每张图片的读取、压缩、连接、上传、等待首个结果、接收和写文件都记录为耗时区间。
+
+When a TraceRecorder is given, reading, compression, connect, upload, waiting
+for the first token, streaming and file writes are recorded as spans per image.
+
+【使用方法 / Usage】
+    engine = DescribeEngine(client, AdaptiveRateController(initial=2, maximum=8))
+    engine.run_sync(jobs, on_done=callback)
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import os
+import time
+
+from describe_cache import file_digest, image_digest, make_cache_key
+from rate_control import AdaptiveRateController, classify_outcome
+from retry_policy import RetryPolicy
+from spark_client import CancelToken, RequestMetrics, SparkCancelledError
+
+
+class DescribeJob(object):
+    """单张图片的描述任务"""
+
+    def __init__(self, image_path, output_file, prompt):
+        self.image_path = image_path
+        self.output_file = output_file
+        self.prompt = prompt
+        self.result = None  # 成功时为描述文本
+        self.error = None  # 失败时为异常对象
+        self.elapsed = 0.0  # 本次任务耗时（秒）
+        self.attempts = 0  # 已发送请求的次数
+        self.outcome = None  # 最近一次请求的结果类别（OUTCOME_*）
+        self.cache_key = None  # 描述缓存键
+        self.cached = False  # 结果是否来自缓存或同键的其它请求
+        self.image_data = None  # 需要在内存中上传的图片字节（如压缩后的图片），为空时直接从文件流式上传
+        self.loaded = False  # 是否已读取图片并查询缓存
+        self.claimed = False  # 是否已认领租约
+        self.skipped = False  # 是否因为已被其它工作进程认领或完成而跳过
+        self.reserved = 0  # 占用的预读取字节数
+        self.request_stats = None  # 最近一次请求的测量值（RequestMetrics），仅在启用指标时记录
+
+    @property
+    def ok(self):
+        return self.error is None and self.result is not None
+
+
+class _ByteBudget(object):
+    """预读取字节预算，acquire在事件循环中等待，release可以在任意线程中调用"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._loop = asyncio.get_running_loop()
+        self._waiter = None
+
+    async def acquire(self, n):
+        while self.used + n > self.limit and self.used > 0:
+            self._waiter = self._loop.create_future()
+            await self._waiter
+        self.used += n
+        self.peak = max(self.peak, self.used)
+
+    def release(self, n):
+        self._loop.call_soon_threadsafe(self._release, n)
+
+    def _release(self, n):
+        self.used -= n
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+class DescribeEngine(object):
+    """并发描述引擎
+
+    参数:
+        client: SparkImageClient实例
+        controller: AdaptiveRateController实例，为空时使用默认参数
+        retry_policy: RetryPolicy实例，决定失败的请求是否重新排队以及等待多久
+        cache: DescriptionCache实例，为空时不使用缓存
+        compressor: PayloadCompressor实例，为空时上传原始图片
+        dead_letter: DeadLetterLog实例，最终失败的任务写入其中，为空时不记录
+        lease: LeaseManager实例，多个工作进程共享同一批图片时使用，为空时不认领
+        job_key: 根据任务返回其键（租约和输出存储使用）的函数，各工作进程必须一致，默认为图片路径
+        store: JsonlOutputStore或SqliteOutputStore实例，为空时把描述写入与图片同名的.txt文件
+        prefetch_bytes: 预读取的图片数据总量上限（字节），为0时不预读取
+        prefetch_workers: 预读取（读取、压缩图片）的线程数
+        writer_workers: 保存描述文件的线程数
+        metrics: DescribeMetrics实例，为空时不记录请求指标
+        max_pending: 已从任务来源取出但尚未结束的任务数上限，为None时不限制；
+                     任务来源需要尽量晚地决定下一个任务时（如公平调度）使用
+        hedge: HedgePolicy实例，为空时不发送对冲请求
+        answer_budget: AnswerBudget实例，为空时使用模型参数中的max_tokens且不截断描述
+        tracer: TraceRecorder实例，为空时不记录各阶段的耗时
+        converter: FusedConverter实例，为空时直接上传图片文件（需要先转换为支持的格式）
+    """
+
+    def __init__(self, client, controller=None, retry_policy=None, cache=None, compressor=None,
+                 dead_letter=None, lease=None, job_key=None, store=None, prefetch_bytes=64 * 1024 * 1024,
+                 prefetch_workers=4, writer_workers=1, metrics=None, max_pending=None, hedge=None,
+                 answer_budget=None, tracer=None, converter=None):
+        self.client = client
+        self.controller = controller or AdaptiveRateController()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.dead_letter = dead_letter
+        self.lease = lease
+        self.job_key = job_key or (lambda job: job.image_path)
+        self.store = store
+        self.cache = cache
+        self.compressor = compressor
+        self.prefetch_bytes = prefetch_bytes
+        self.prefetch_workers = prefetch_workers
+        self.writer_workers = writer_workers
+        self.metrics = metrics
+        self.max_pending = max_pending
+        self.hedge = hedge
+        self.answer_budget = answer_budget
+        self.tracer = tracer
+        self.converter = converter
+        self._trace_starts = {}  # id(任务) -> 取出任务的时间（perf_counter）
+        self._pending_slots = None
+        self._hedger = None
+        self._hedge_releases = set()  # 归还对冲请求名额的任务
+        self.prefetch_peak = 0  # 最近一次运行中预读取数据的峰值（字节）
+        self._budget = None
+        self._writer = None
+        self._in_flight = {}  # 缓存键 -> (正在进行的请求的Future, 发送该请求的任务)
+        self._on_start = None
+        self._on_finish = None
+        self.callback_errors = 0  # 任务结束时回调出错的次数
+        self.last_callback_error = None  # 最近一次回调出错的异常
+
+    def _model_signature(self):
+        signature = self.client.model_signature()
+        if self.compressor is not None:
+            signature += "\n" + self.compressor.signature()
+        if self.answer_budget is not None:
+            signature += "\n" + self.answer_budget.signature()
+        if self.converter is not None:
+            signature += "\n" + self.converter.signature()
+        return signature
+
+    def _span(self, name, job=None, profile=False, **args):
+        """记录一个阶段的耗时区间，未启用追踪时返回空的上下文"""
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.span(name, "describe", image=job.image_path if job is not None else None,
+                                profile=profile, **args)
+
+    def _trace_request(self, job, stats, start, **args):
+        """根据请求的测量值记录连接、上传、等待首个结果和接收结果的区间，start为请求开始的perf_counter值"""
+        marks = [("connect", stats.connect_seconds), ("upload", stats.upload_seconds),
+                 ("first_token", stats.first_token_seconds), ("stream", stats.total_seconds)]
+        previous = 0.0
+        for name, seconds in marks:
+            if seconds is None:
+                continue
+            self.tracer.add_span(name, "describe", start + previous, start + seconds, job.image_path, **args)
+            previous = seconds
+
+    def _load(self, job, read=False):
+        """在线程池中执行：查询缓存，命中时直接写入结果，否则准备好上传的图片数据
+
+        不压缩也不预读取(read=False)时图片不会整个读入内存，发送时通过mmap分段编码。
+        融合转换时原图只从磁盘读取一次，解码后的图片直接用于上传和后台写出PNG。
+        """
+        job.loaded = True
+        digest = None
+        if self.compressor is not None or self.converter is not None or read:
+            with self._span("read", job):
+                with open(job.image_path, 'rb') as f:
+                    job.image_data = f.read()
+            if self.compressor is not None or self.cache is not None or self.converter is not None:
+                with self._span("digest", job):
+                    digest = image_digest(job.image_data)
+        elif self.cache is not None:
+            with self._span("digest", job):
+                digest = file_digest(job.image_path)
+        if self.cache is not None:
+            with self._span("cache_lookup", job):
+                job.cache_key = make_cache_key(digest, job.prompt, self._model_signature())
+                result = self.cache.get(job.cache_key)
+            if result is not None:
+                source = job.image_data
+                self._save(job, result)
+                job.cached = True
+                if self.converter is not None:
+                    # 命中缓存时只有写出PNG需要解码，在写出线程中进行
+                    self.converter.write_later(job.image_path, source)
+                return
+        if self.converter is not None:
+            self._convert(job, digest)
+        elif self.compressor is not None:
+            with self._span("compress", job, profile=True):
+                job.image_data = self.compressor.prepare(job.image_data, digest)
+
+    def _convert(self, job, digest):
+        """融合转换：解码原图，压缩或编码为PNG作为上传数据，并提交后台写出PNG"""
+        source = job.image_data
+        with self._span("convert", job, profile=True):
+            img = self.converter.decode(source)
+        png = None
+        if self.compressor is not None:
+            with self._span("compress", job, profile=True):
+                job.image_data = self.compressor.prepare_image(img, digest)
+        else:
+            with self._span("encode", job, profile=True):
+                job.image_data = png = self.converter.encode(img)
+        self.converter.write_later(job.image_path, source, img, png)
+
+    def _recheck_cache(self, job):
+        """在线程池中执行：发送请求前再次查询缓存，命中时保存结果并返回True"""
+        result = self.cache.get(job.cache_key)
+        if result is None:
+            return False
+        self._save(job, result)
+        job.cached = True
+        return True
+
+    def _save(self, job, result):
+        if self.store is not None:
+            self.store.put(self.job_key(job), result)
+            if self.lease is not None:
+                # 释放租约之前写入磁盘，其它工作进程认领后refresh()就能看到这条记录
+                self.store.flush()
+        elif job.output_file is not None:
+            with open(job.output_file, 'w') as f:
+                f.write(result)
+        job.result = result
+        self._release(job)
+
+    def _store(self, job):
+        """在写入线程中执行：保存描述文件并写入缓存"""
+        try:
+            with self._span("write", job):
+                if job.claimed and not self.lease.holds(self.job_key(job)):
+                    # 租约已被其它工作进程接手，由它写出结果，这里只保留缓存
+                    job.skipped = True
+                    self._release(job)
+                else:
+                    self._save(job, job.result)
+                if job.cache_key is not None:
+                    self.cache.put(job.cache_key, job.result)
+        except Exception as e:
+            job.error = e
+            job.result = None
+
+    async def _write(self, job):
+        if job.ok:
+            await asyncio.get_running_loop().run_in_executor(self._writer, self._store, job)
+
+    def _preload(self, job):
+        """在预读取线程池中执行：认领租约，读取并准备图片数据"""
+        with self._span("prefetch", job):
+            self._preload_job(job)
+
+    def _preload_job(self, job):
+        try:
+            if self.lease is not None and not self._claim(job):
+                job.skipped = True
+                self._release(job)
+                return
+            self._load(job, read=True)
+        except Exception:
+            self._release(job)  # 由worker重新读取并报告错误
+            return
+        # 压缩后的数据通常比文件小，多预留的字节立即归还
+        actual = len(job.image_data) if job.image_data is not None else 0
+        if actual < job.reserved:
+            self._budget.release(job.reserved - actual)
+            job.reserved = actual
+
+    @staticmethod
+    def _next_job(source):
+        """在输入线程中执行：取出下一个任务（可能阻塞，如等待新图片），没有更多任务时返回None"""
+        return next(source, None)
+
+    async def _feed(self, jobs, queue, feeder, executor):
+        """输入阶段：依次取出任务放入队列
+
+        启用预读取时按顺序读取后面的图片，预读取的字节数超过预算时等待前面的请求完成。
+        """
+        loop = asyncio.get_running_loop()
+        loading = set()
+        source = iter(jobs)
+        while True:
+            if self._pending_slots is not None:
+                await self._pending_slots.acquire()
+            job = await loop.run_in_executor(feeder, self._next_job, source)
+            if job is None:
+                break
+            if self.metrics is not None:
+                self.metrics.add_jobs(1)
+            if self.tracer is not None:
+                self._trace_starts[id(job)] = time.perf_counter()
+            if self._budget is None:
+                queue.put_nowait(job)
+                continue
+            try:
+                size = await loop.run_in_executor(executor, os.path.getsize, job.image_path)
+            except OSError:
+                size = None
+            if size is None or size > self.prefetch_bytes:
+                queue.put_nowait(job)  # 无法预读取或超出预算的图片在发送时从磁盘流式读取
+                continue
+            await self._budget.acquire(size)
+            job.reserved = size
+            future = loop.run_in_executor(executor, self._preload, job)
+            future.add_done_callback(lambda f, job=job: queue.put_nowait(job))
+            loading.add(future)
+            future.add_done_callback(loading.discard)
+        if loading:
+            await asyncio.gather(*loading)
+
+    def _claim(self, job):
+        """在线程池中执行：认领租约，返回是否需要处理该任务"""
+        if not self.lease.try_claim(self.job_key(job)):
+            return False
+        job.claimed = True
+        # 认领前其它工作进程可能已经完成了这张图片
+        if self._is_done(job):
+            self._unclaim(job)
+            return False
+        return True
+
+    def _is_done(self, job):
+        if self.store is not None:
+            # 其它工作进程写入的记录不在打开存储时建立的索引中，先读取它们新追加的记录
+            self.store.refresh(self.job_key(job))
+            return self.job_key(job) in self.store
+        if job.output_file is None:
+            return False
+        return os.path.exists(job.output_file) and os.path.getsize(job.output_file) > 0
+
+    def _unclaim(self, job):
+        if job.claimed:
+            self.lease.release(self.job_key(job))
+            job.claimed = False
+
+    def _finish(self, job, on_done):
+        """任务结束：释放租约并通知回调
+
+        回调等出错时记录在callback_errors中，不向上抛出：on_finish和任务名额总是归还，worker继续处理后面的任务。
+        """
+        try:
+            try:
+                self._report(job, on_done)
+            finally:
+                if self._on_finish is not None:
+                    self._on_finish(job)
+        except Exception as e:
+            self.callback_errors += 1
+            self.last_callback_error = e
+        finally:
+            if self._pending_slots is not None:
+                self._pending_slots.release()
+
+    def _report(self, job, on_done):
+        if self.lease is not None:
+            self._unclaim(job)
+        if self.metrics is not None:
+            self.metrics.job_finished(job)
+        if self.tracer is not None:
+            start = self._trace_starts.pop(id(job), None)
+            if start is not None:
+                result = "skipped" if job.skipped else ("ok" if job.ok else "failed")
+                self.tracer.add_async_span("job", "describe", id(job), start, time.perf_counter(), job.image_path,
+                                           result=result, attempts=job.attempts, cached=job.cached)
+        if on_done is not None and not job.skipped:
+            on_done(job)
+
+    def _release(self, job):
+        """释放任务持有的图片数据，再次处理时重新读取"""
+        job.image_data = None
+        job.loaded = False
+        if job.reserved:
+            self._budget.release(job.reserved)
+            job.reserved = 0
+
+    def _call(self, job, stats=None, cancel=None):
+        """在线程池中执行：发送一次请求并返回描述"""
+        image = job.image_data if job.image_data is not None else job.image_path
+        limits = self.answer_budget.limits(job.prompt) if self.answer_budget is not None else {}
+        return self.client.describe_image(image, job.prompt, metrics=stats, cancel=cancel, **limits)
+
+    def _process(self, job):
+        """在线程池中执行：调用接口，结果由写入阶段保存"""
+        start = time.monotonic()
+        job.attempts += 1
+        job.error = None
+        traced = time.perf_counter()
+        try:
+            job.request_stats = RequestMetrics() if self.metrics is not None or self.tracer is not None else None
+            with self._span("request", job, profile=True, attempt=job.attempts):
+                job.result = self._call(job, job.request_stats)
+        except Exception as e:
+            job.error = e
+        finally:
+            job.elapsed = time.monotonic() - start
+            if self.tracer is not None:
+                self._trace_request(job, job.request_stats, traced)
+        return job
+
+    def _attempt(self, job, stats, cancel, hedged=False):
+        """在线程池中执行：对冲模式下的一次请求，返回 (描述, 异常)，不修改任务"""
+        traced = time.perf_counter()
+        try:
+            with self._span("request", job, profile=True, attempt=job.attempts, hedged=hedged):
+                return self._call(job, stats, cancel), None
+        except Exception as e:
+            return None, e
+        finally:
+            if self.tracer is not None:
+                self._trace_request(job, stats, traced, hedged=hedged)
+
+    async def _process_hedged(self, job, executor):
+        """发送请求，超过HedgePolicy的延迟阈值仍未完成时再发送一个相同的请求
+
+        对冲请求占用自己的并发名额，没有空闲名额时不发送；结束时按它自己的结果归还名额
+        （胜出或被取消时不再调整并发，胜出的结果由任务的名额记录）。
+        采用先成功的结果，另一个请求立即取消；两个都失败时使用首个请求的错误。
+        """
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        job.attempts += 1
+        job.error = None
+        attempts = {}  # Future -> (RequestMetrics, CancelToken, 是否为对冲请求)
+        hedge_epoch = None
+
+        def launch(pool, hedged):
+            stats, cancel = RequestMetrics(), CancelToken()
+            attempts[loop.run_in_executor(pool, self._attempt, job, stats, cancel, hedged)] = (stats, cancel, hedged)
+
+        launch(executor, False)
+        pending = set(attempts)
+        delay = self.hedge.delay()
+        if delay is not None:
+            _, pending = await asyncio.wait(pending, timeout=delay)
+            if pending:
+                hedge_epoch = self.controller.try_acquire()
+            if hedge_epoch is not None:
+                if self.hedge.try_hedge():
+                    launch(self._hedger, True)
+                    pending = {f for f in attempts if not f.done()}
+                else:
+                    await self.controller.release(hedge_epoch, None)
+                    hedge_epoch = None
+        winner = None
+        try:
+            while winner is None:
+                for future in attempts:
+                    if future.done() and future.result()[1] is None:
+                        winner = future
+                        break
+                else:
+                    if not pending:
+                        winner = next(f for f, value in attempts.items() if not value[2])
+                        break
+                    _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for future, (_, cancel, hedged) in attempts.items():
+                if future is not winner:
+                    cancel.cancel()
+                if hedged:
+                    future.add_done_callback(
+                        lambda f: self._release_hedge(hedge_epoch, f, f is winner))
+        job.result, job.error = winner.result()
+        stats, _, hedged = attempts[winner]
+        job.elapsed = time.monotonic() - start
+        job.request_stats = stats
+        if job.error is None:
+            self.hedge.record(stats.total_seconds)
+        if len(attempts) > 1:
+            if hedged and job.error is None:
+                self.hedge.record_win()
+            # 对冲的代价：另一个请求重复上传的图片和它已经收到的描述
+            loser = next(f for f in attempts if f is not winner)
+            loser.add_done_callback(lambda f: self._hedge_finished(job, attempts[f][0], stats, hedged))
+
+    def _release_hedge(self, epoch, future, won):
+        """对冲请求结束时归还它的并发名额"""
+        error = None if future.cancelled() else future.result()[1]
+        cancelled = future.cancelled() or isinstance(error, SparkCancelledError)
+        outcome = None if won or cancelled else classify_outcome(error)
+        task = asyncio.get_running_loop().create_task(self.controller.release(epoch, outcome))
+        self._hedge_releases.add(task)
+        task.add_done_callback(self._hedge_releases.discard)
+
+    def _hedge_finished(self, job, loser_stats, winner_stats, hedge_won):
+        if self.metrics is None:
+            return
+        result = "won" if hedge_won and job.error is None else ("lost" if job.error is None else "failed")
+        prompt_tokens = loser_stats.prompt_tokens or winner_stats.prompt_tokens or 0
+        self.metrics.observe_hedge(result, prompt_tokens + loser_stats.completion_token_cost())
+
+    async def _request(self, job, executor):
+        """发送请求，返回是否需要重新排队"""
+        loop = asyncio.get_running_loop()
+        epoch = await self.controller.acquire()
+        try:
+            if self._on_start is not None:
+                self._on_start(job)
+            if self.hedge is not None:
+                await self._process_hedged(job, executor)
+            else:
+                await loop.run_in_executor(executor, self._process, job)
+        finally:
+            job.outcome = classify_outcome(job.error)
+            await self.controller.release(epoch, job.outcome)
+            if self.metrics is not None and job.request_stats is not None:
+                self.metrics.observe_request(job.request_stats, job.outcome)
+
+        # 限流、配额不足、超时等请求没有得到结果，退避后重新排队
+        requeue = self.retry_policy.should_retry(job.outcome, job.attempts)
+        if not requeue:
+            self._release(job)
+            if job.error is not None and self.dead_letter is not None:
+                self.dead_letter.append(job)
+        return requeue
+
+    async def _handle(self, job, executor):
+        """处理一个任务
+
+        返回:
+            str: "done"表示任务结束，"requeue"表示需要重新排队，
+                 "follow"表示同一缓存键已有请求在进行，需要等待其结果
+        """
+        loop = asyncio.get_running_loop()
+        if job.skipped:
+            return "done"
+        if self.lease is not None and not job.claimed:
+            try:
+                claimed = await loop.run_in_executor(executor, self._claim, job)
+            except OSError as e:
+                job.error = e
+                return "done"
+            if not claimed:
+                job.skipped = True
+                return "done"
+        # 预读取时命中缓存的任务已经保存了结果（_save会把loaded重置为False），不再重新读取
+        if not job.loaded and not job.cached:
+            try:
+                await loop.run_in_executor(executor, self._load, job)
+            except Exception as e:
+                job.error = e
+                return "done"
+        if job.cached:
+            return "done"
+        if job.cache_key is None:
+            if await self._request(job, executor):
+                return "requeue"
+            await self._write(job)
+            return "done"
+
+        # 合并相同的请求：同一个缓存键同时只发送一个请求
+        entry = self._in_flight.get(job.cache_key)
+        if entry is None:
+            # 预读取时查询的缓存可能已经过时：同键的请求在此期间完成时直接复用其结果
+            try:
+                cached = await loop.run_in_executor(executor, self._recheck_cache, job)
+            except Exception as e:
+                job.error = e
+                return "done"
+            if cached:
+                return "done"
+            entry = self._in_flight.get(job.cache_key)
+        if entry is not None and entry[1] is not job:
+            return "follow"
+        if entry is None:
+            entry = (loop.create_future(), job)
+            self._in_flight[job.cache_key] = entry
+        future = entry[0]
+
+        if await self._request(job, executor):
+            return "requeue"  # 保留Future，其它相同任务继续等待本任务的重试
+        await self._write(job)
+        del self._in_flight[job.cache_key]
+        if job.ok:
+            future.set_result(job.result)
+        else:
+            future.set_exception(job.error)
+            future.exception()  # 标记异常已被读取，避免没有等待者时出现警告
+        return "done"
+
+    async def _follow(self, job, future, queue, executor, on_done):
+        """等待同一缓存键的请求结束，成功时复用其结果，失败时重新排队自己发送请求
+
+        不占用worker，避免所有worker都在等待一个还在队列中的重试请求。
+        """
+        try:
+            try:
+                result = await asyncio.shield(future)
+            except Exception:
+                queue.put_nowait(job)
+                return
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(self._writer, self._save, job, result)
+                job.cached = True
+            except Exception as e:
+                job.error = e
+            self._finish(job, on_done)
+        finally:
+            queue.task_done()
+
+    async def _requeue_later(self, job, queue):
+        """等待退避时间后把任务放回队列"""
+        try:
+            await asyncio.sleep(self.retry_policy.delay(job.attempts))
+            queue.put_nowait(job)
+        finally:
+            queue.task_done()
+
+    async def _worker(self, queue, executor, on_done, background):
+        while True:
+            job = await queue.get()
+            state = "done"
+            task = None
+            try:
+                try:
+                    state = await self._handle(job, executor)
+                except Exception as e:
+                    # 回调（如on_start写入任务台账）或死信记录出错时任务失败，worker继续运行
+                    job.error = e
+                    job.result = None
+                    self._release(job)
+                    if job.cache_key is not None:
+                        entry = self._in_flight.get(job.cache_key)
+                        if entry is not None and entry[1] is job:
+                            del self._in_flight[job.cache_key]
+                            entry[0].set_exception(e)
+                            entry[0].exception()
+                    state = "done"
+                if state == "requeue":
+                    # 由_requeue_later负责调用task_done，退避期间不占用worker
+                    task = asyncio.create_task(self._requeue_later(job, queue))
+                elif state == "follow":
+                    # 由_follow负责调用task_done
+                    future = self._in_flight[job.cache_key][0]
+                    task = asyncio.create_task(self._follow(job, future, queue, executor, on_done))
+                else:
+                    self._finish(job, on_done)
+            finally:
+                if task is not None:
+                    background.add(task)
+                    task.add_done_callback(background.discard)
+                else:
+                    queue.task_done()
+
+    async def run(self, jobs, on_done=None, on_start=None):
+        """并发处理所有任务，返回任务列表（每个任务带有result或error）
+
+        参数:
+            jobs: DescribeJob的可迭代对象
+            on_done: 每个任务完成时调用的回调，参数为DescribeJob
+            on_start: 每次真正发送请求前调用的回调，参数为DescribeJob
+        """
+        jobs = list(jobs)
+        await self._run(jobs, min(self.controller.maximum, max(len(jobs), 1)), on_done, on_start)
+        return jobs
+
+    async def run_stream(self, jobs, on_done=None, on_start=None, on_finish=None):
+        """处理一个惰性的任务来源，任务一边产生一边处理，不保留处理过的任务
+
+        jobs在单独的线程中迭代，可以是阻塞的迭代器（如等待新图片的队列），返回None或结束时停止；
+        取消本协程后迭代器也应尽快结束，否则线程池会等待它返回。结果通过on_done获取。
+
+        参数:
+            on_finish: 每个任务结束时在on_done之后调用，被跳过的任务也会调用（如用于归还调度名额）
+        """
+        await self._run(jobs, self.controller.maximum, on_done, on_start, on_finish)
+
+    async def _run(self, jobs, worker_count, on_done, on_start, on_finish=None):
+        self._on_start = on_start
+        self._on_finish = on_finish
+        self._pending_slots = asyncio.Semaphore(self.max_pending) if self.max_pending else None
+        queue = asyncio.Queue()
+        self._budget = _ByteBudget(self.prefetch_bytes) if self.prefetch_bytes else None
+
+        # 使用独立的线程池，避免受默认线程池大小限制；实际并发由controller控制
+        background = set()  # 等待退避的任务和等待相同请求结果的任务
+        # 输入线程可能阻塞在等待新任务上，结束时不等待它，由任务来源自己结束
+        feeder = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.controller.maximum) as executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.prefetch_workers) as prefetcher, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.writer_workers) as writer, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.controller.maximum) as hedger:
+            self._writer = writer
+            self._hedger = hedger  # 对冲请求使用单独的线程，不占用首个请求的线程
+            if self.metrics is not None:
+                self.metrics.attach(queue_depth=queue.qsize, in_flight=lambda: self.controller.in_flight,
+                                    concurrency_limit=lambda: self.controller.limit,
+                                    prefetch_bytes=lambda: self._budget.used if self._budget is not None else 0)
+            feed = asyncio.create_task(self._feed(jobs, queue, feeder, prefetcher))
+            workers = [asyncio.create_task(self._worker(queue, executor, on_done, background))
+                       for _ in range(worker_count)]
+            try:
+                await feed
+                await queue.join()
+            finally:
+                tasks = [feed] + workers + list(background)
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                feeder.shutdown(wait=False)
+                if self.metrics is not None:
+                    self.metrics.detach()
+        if self._budget is not None:
+            self.prefetch_peak = self._budget.peak
+
+    def run_sync(self, jobs, on_done=None, on_start=None):
+        """同步入口，供脚本直接调用"""
+        return asyncio.run(self.run(jobs, on_done=on_done, on_start=on_start))
+
+    def run_stream_sync(self, jobs, on_done=None, on_start=None, on_finish=None):
+        """run_stream的同步入口"""
+        asyncio.run(self.run_stream(jobs, on_done=on_done, on_start=on_start, on_finish=on_finish))
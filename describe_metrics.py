@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+描述请求指标与状态端点 / Describe Metrics and Status Endpoint
+========================================================
+
+【功能说明 / Function Description】
+汇总每次描述请求的测量值（连接耗时、首个结果耗时、总耗时、上传字节数、返回字符数、错误码），
+以直方图和计数器的形式保存，并通过本地HTTP端点以Prometheus文本格式提供，
+同时给出队列长度、进行中的请求数、吞吐量和预计剩余时间，便于观察长时间运行的任务。
+token计数器按用途统计配额消耗，包括对冲请求重复消耗的token和提前关闭连接时截掉的内容。
+
+Aggregates the measurements of every describe request (connect time, time to
+first token, total latency, bytes uploaded, characters received, error codes)
+into histograms and counters, and serves them on a local HTTP endpoint in the
+Prometheus text format together with queue depth, in-flight requests,
+throughput and ETA, so long runs can be watched without reading the log.
+Token counters break down the quota spent, including the tokens duplicated by
+hedged requests and the text discarded when a connection is closed early.
+
+【使用方法 / Usage】
+    metrics = DescribeMetrics()
+    server = MetricsServer(metrics, port=9108).start()
+    engine = DescribeEngine(client, controller, metrics=metrics)
+    ...
+    curl http://127.0.0.1:9108/metrics
+"""
+
+import bisect
+import collections
+import http.server
+import threading
+import time
+
+from spark_client import estimate_tokens
+
+# 直方图的桶上限
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+BYTES_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+CHARS_BUCKETS = (100, 250, 500, 1000, 2000, 4000)
+
+# 吞吐量按最近多少秒内完成的任务计算
+THROUGHPUT_WINDOW = 60.0
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram(object):
+    """累计直方图，格式与Prometheus的histogram相同"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个为+Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, help_text):
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum:g}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+def _render_counter(name, help_text, label, values):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+    for key in sorted(values, key=str):
+        lines.append(f'{name}{{{label}="{key}"}} {values[key]}')
+    return lines
+
+
+def _render_gauge(name, help_text, value):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value:g}"]
+
+
+class DescribeMetrics(object):
+    """描述请求的指标汇总，可以在多个线程中同时使用
+
+    DescribeEngine在每次请求结束时调用observe_request()，每个任务结束时调用job_finished()；
+    运行期间通过attach()提供队列长度、进行中的请求数等实时数值。
+
+    参数:
+        clock: 时间函数，用于计算吞吐量
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.connect_seconds = Histogram(SECONDS_BUCKETS)
+        self.first_token_seconds = Histogram(SECONDS_BUCKETS)
+        self.request_seconds = Histogram(SECONDS_BUCKETS)
+        self.upload_bytes = Histogram(BYTES_BUCKETS)
+        self.response_chars = Histogram(CHARS_BUCKETS)
+        self.requests = collections.Counter()  # 请求结果类别 -> 次数
+        self.errors = collections.Counter()  # 错误码（或异常类型） -> 次数
+        self.jobs = collections.Counter()  # 任务结果（ok、failed、skipped） -> 数量
+        # 用途（prompt、completion、hedge、discarded） -> token数，discarded是completion中被截掉的部分
+        self.tokens = collections.Counter()
+        self.hedges = collections.Counter()  # 对冲结果（won、lost、failed） -> 次数
+        self.early_closed = 0  # 达到字数上限后提前关闭连接的请求数
+        self.jobs_total = 0  # 已提交给引擎的任务数
+        self._finished = collections.deque()  # 最近完成的任务的时间
+        self._sources = {}
+
+    def attach(self, **sources):
+        """设置实时数值的来源函数：queue_depth、in_flight、concurrency_limit、prefetch_bytes"""
+        with self._lock:
+            self._sources.update(sources)
+
+    def detach(self):
+        with self._lock:
+            self._sources = {}
+
+    def add_jobs(self, count):
+        with self._lock:
+            self.jobs_total += count
+
+    def observe_request(self, stats, outcome):
+        """记录一次请求的测量值
+
+        参数:
+            stats: spark_client.RequestMetrics
+            outcome: 请求结果类别（OUTCOME_*）
+        """
+        with self._lock:
+            self.requests[outcome] += 1
+            if stats.connect_seconds is not None:
+                self.connect_seconds.observe(stats.connect_seconds)
+            if stats.first_token_seconds is not None:
+                self.first_token_seconds.observe(stats.first_token_seconds)
+            if stats.total_seconds is not None:
+                self.request_seconds.observe(stats.total_seconds)
+            if stats.bytes_sent:
+                self.upload_bytes.observe(stats.bytes_sent)
+            if stats.ok:
+                self.response_chars.observe(stats.chars_received)
+            else:
+                self.errors[stats.error_code if stats.error_code is not None else stats.error_type] += 1
+            if stats.prompt_tokens:
+                self.tokens["prompt"] += stats.prompt_tokens
+            if stats.chars_received:
+                self.tokens["completion"] += stats.completion_token_cost()
+            if stats.early_closed:
+                self.early_closed += 1
+            if stats.discarded_chars:
+                # 截掉的内容也已经生成并计费
+                self.tokens["discarded"] += estimate_tokens(stats.discarded_chars)
+
+    def observe_hedge(self, result, tokens):
+        """记录一次对冲：result为won（对冲请求先成功）、lost（首个请求先成功）或failed，tokens为另一个请求消耗的token数"""
+        with self._lock:
+            self.hedges[result] += 1
+            self.tokens["hedge"] += tokens
+
+    def job_finished(self, job):
+        """记录一个任务结束（成功、失败或因其它工作进程已处理而跳过）"""
+        result = "skipped" if job.skipped else ("ok" if job.ok else "failed")
+        with self._lock:
+            self.jobs[result] += 1
+            self._finished.append(self._clock())
+
+    def throughput(self):
+        """最近THROUGHPUT_WINDOW秒内每秒完成的任务数"""
+        with self._lock:
+            now = self._clock()
+            while self._finished and now - self._finished[0] > THROUGHPUT_WINDOW:
+                self._finished.popleft()
+            if not self._finished:
+                return 0.0
+            # 运行不足一个窗口时按第一个任务完成以来的时间计算
+            span = min(THROUGHPUT_WINDOW, max(now - self._finished[0], 1.0))
+            return len(self._finished) / span
+
+    def remaining(self):
+        with self._lock:
+            return max(self.jobs_total - sum(self.jobs.values()), 0)
+
+    def eta(self):
+        """按当前吞吐量估计剩余任务的完成时间（秒），无法估计时返回None"""
+        rate = self.throughput()
+        remaining = self.remaining()
+        if remaining == 0:
+            return 0.0
+        return remaining / rate if rate > 0 else None
+
+    def _source(self, name):
+        source = self._sources.get(name)
+        try:
+            return float(source()) if source is not None else 0.0
+        except Exception:
+            return 0.0
+
+    def render(self):
+        """返回Prometheus文本格式的所有指标"""
+        throughput = self.throughput()
+        eta = self.eta()
+        remaining = self.remaining()
+        with self._lock:
+            lines = []
+            lines += self.connect_seconds.render("describe_connect_seconds", "Time to open the websocket connection.")
+            lines += self.first_token_seconds.render("describe_first_token_seconds",
+                                                     "Time from request start to the first response frame.")
+            lines += self.request_seconds.render("describe_request_seconds", "Total request latency.")
+            lines += self.upload_bytes.render("describe_upload_bytes", "Request bytes uploaded.")
+            lines += self.response_chars.render("describe_response_chars", "Characters in the description.")
+            lines += _render_counter("describe_requests_total", "Requests by outcome.", "outcome", self.requests)
+            lines += _render_counter("describe_errors_total", "Failed requests by error code.", "code", self.errors)
+            lines += _render_counter("describe_jobs_finished_total", "Finished jobs by result.", "result", self.jobs)
+            lines += _render_counter("describe_tokens_total",
+                                     "Tokens spent by kind; discarded is the part of completion cut at the word budget.",
+                                     "kind", self.tokens)
+            lines += _render_counter("describe_hedges_total", "Hedged requests by result.", "result", self.hedges)
+            lines += ["# HELP describe_early_closed_total Requests closed early at the word budget.",
+                      "# TYPE describe_early_closed_total counter", f"describe_early_closed_total {self.early_closed}"]
+            lines += _render_gauge("describe_jobs_total", "Jobs submitted in this run.", self.jobs_total)
+            lines += _render_gauge("describe_jobs_remaining", "Jobs not finished yet.", remaining)
+            lines += _render_gauge("describe_queue_depth", "Jobs ready to be sent.", self._source("queue_depth"))
+            lines += _render_gauge("describe_in_flight", "Requests in flight.", self._source("in_flight"))
+            lines += _render_gauge("describe_concurrency_limit", "Current concurrency limit.",
+                                   self._source("concurrency_limit"))
+            lines += _render_gauge("describe_prefetch_bytes", "Bytes held by prefetched images.",
+                                   self._source("prefetch_bytes"))
+            lines += _render_gauge("describe_throughput_jobs_per_second",
+                                   f"Jobs finished per second over the last {THROUGHPUT_WINDOW:g} seconds.", throughput)
+            # 无法估计时输出NaN，符合Prometheus文本格式
+            lines += _render_gauge("describe_eta_seconds", "Estimated seconds until all jobs finish.",
+                                   float("nan") if eta is None else eta)
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer(object):
+    """在后台线程中提供/metrics端点的HTTP服务
+
+    参数:
+        metrics: DescribeMetrics实例
+        host: 监听地址，默认只监听本机
+        port: 监听端口，0表示自动选择
+    """
+
+    def __init__(self, metrics, host="127.0.0.1", port=9108):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._httpd = None
+        self._thread = None
+
+    def _handler(self):
+        metrics = self.metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # 不在屏幕上输出访问日志
+
+        return Handler
+
+    def start(self):
+        self._httpd = http.server.ThreadingHTTPServer((self.host, self.port), self._handler())
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
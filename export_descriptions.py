@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+描述导出工具 / Description Exporter
+========================================================
+
+【功能说明 / Function Description】
+图片描述生成工具使用分片存储（OUTPUT_MODE为"jsonl"或"sqlite"）时，描述保存在
+BASE_DIR/descriptions中的分片文件里。这个程序把它们导出为与图片同名的.txt文件，
+得到与OUTPUT_MODE = "txt"相同的目录结构。
+
+When the description generator uses a sharded output store (OUTPUT_MODE "jsonl"
+or "sqlite"), descriptions are kept in shard files under BASE_DIR/descriptions.
+This program exports them as .txt files named after the images, producing the
+same layout as OUTPUT_MODE = "txt".
+
+【使用方法 / Usage】
+1. 设置下方的全局变量 / Set the global variables below:
+   - OUTPUT_MODE: 与生成描述时的设置一致（"jsonl"或"sqlite"）/ Same as used for generation ("jsonl" or "sqlite")
+   - TARGET_FOLDER: 只导出该文件夹，为None时导出所有文件夹 / Only export this folder; None exports all folders
+   - OVERWRITE_EXISTING: 是否覆盖已存在的.txt文件 / Whether existing .txt files are overwritten
+
+2. 运行程序 / Run the program: python export_descriptions.py
+"""
+
+import os
+
+from output_store import export_sidecars, open_output_store
+
+# ====================== 全局配置参数 ======================
+
+# 基础目录，所有图片文件夹的上级目录
+BASE_DIR = "picture"
+
+# 分片存储的格式和目录，与generate_picture_describe.py中的设置一致
+OUTPUT_MODE = "jsonl"
+OUTPUT_STORE_DIR = "descriptions"
+
+# 只导出该文件夹，为None时导出所有文件夹
+TARGET_FOLDER = None
+
+# 是否覆盖已存在的.txt文件
+OVERWRITE_EXISTING = False
+
+
+# ====================== 主函数 ======================
+
+def main():
+    """主函数，根据全局变量设置导出描述"""
+    store_dir = os.path.join(BASE_DIR, OUTPUT_STORE_DIR)
+    if not os.path.isdir(store_dir):
+        print(f"错误: 存储目录 '{store_dir}' 不存在，请检查 BASE_DIR 和 OUTPUT_STORE_DIR 变量设置")
+        return False
+
+    print("===== 图片描述导出工具 =====")
+    print(f"存储目录: {store_dir} ({OUTPUT_MODE})")
+    # 导出只读取存储，不会追加记录
+    store = open_output_store(store_dir, OUTPUT_MODE, writer_id="export")
+    try:
+        print(f"存储中共有 {len(store)} 条描述")
+        written, skipped = export_sidecars(store, BASE_DIR, folder=TARGET_FOLDER, overwrite=OVERWRITE_EXISTING)
+    finally:
+        store.close()
+    print(f"导出完成! 写入 {written} 个.txt文件，跳过已存在的 {skipped} 个")
+    return True
+
+
+if __name__ == "__main__":
+    if not main():
+        exit(1)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+文件夹索引 / Folder Index
+========================================================
+
+【功能说明 / Function Description】
+用一次os.scandir遍历建立文件夹的内存索引（图片、描述文件、大小、修改时间），
+文件命名检查、是否已完成、断点位置、图片排序等判断都查询这个索引，
+不再对同一个文件夹反复调用listdir，也不再逐个打开所有.txt文件。
+索引可以保存到磁盘，下次运行时只重新扫描修改时间发生变化的文件夹。
+
+Builds an in-memory index of a folder (images, description sidecars, sizes
+and modification times) with a single os.scandir pass. Filename checks,
+completion checks, the resume position and image ordering all query this index
+instead of listing the folder repeatedly and opening every .txt file. The index
+can be persisted so the next run only rescans folders whose mtime changed.
+
+【说明 / Notes】
+- 描述文件是否有效按文件大小判断：大小为0视为无效；很小的文件会读取内容，
+  只包含空白字符时视为无效 / Sidecar validity is decided by size: empty files are
+  invalid, and very small files are read so whitespace-only content is invalid
+- 文件夹的修改时间只在新建、删除、重命名文件时改变，本程序自己写入的描述文件会直接更新索引
+  / A folder's mtime only changes when entries are created, deleted or renamed;
+  descriptions written by this program update the index directly
+"""
+
+import json
+import os
+
+IMAGE_EXTENSIONS = ('.png', '.webp', '.jpeg', '.jpg')
+SIDECAR_EXTENSION = '.txt'
+SMALL_SIDECAR_SIZE = 64  # 不超过该大小的描述文件需要读取内容判断是否只有空白字符
+INDEX_VERSION = 1
+
+
+def image_sort_key(filename):
+    """图片排序规则：纯数字文件名按数值排序并排在前面，其它按字母表顺序排序"""
+    base_name = os.path.splitext(filename)[0]
+    if base_name.isdigit():
+        return (0, int(base_name))
+    return (1, base_name.lower())
+
+
+def _sidecar_is_valid(path, size):
+    if size <= 0:
+        return False
+    if size > SMALL_SIDECAR_SIZE:
+        return True
+    try:
+        with open(path, 'r') as f:
+            return len(f.read().strip()) > 0
+    except OSError:
+        return False
+
+
+class FolderIndex(object):
+    """单个文件夹的索引
+
+    属性:
+        folder_path: 文件夹路径
+        mtime_ns: 扫描时文件夹的修改时间
+        images: 图片文件名 -> (大小, 修改时间)
+        sidecars: 描述文件的基本文件名（不带扩展名） -> 是否有效
+    """
+
+    def __init__(self, folder_path, mtime_ns=0, images=None, sidecars=None):
+        self.folder_path = folder_path
+        self.mtime_ns = mtime_ns
+        self.images = images or {}
+        self.sidecars = sidecars or {}
+        self._sorted = None
+
+    @classmethod
+    def scan(cls, folder_path, extensions=IMAGE_EXTENSIONS):
+        """用一次scandir遍历建立索引
+
+        extensions: 作为图片的扩展名（小写）"""
+        extensions = tuple(extensions)
+        mtime_ns = os.stat(folder_path).st_mtime_ns
+        images = {}
+        sidecars = {}
+        with os.scandir(folder_path) as it:
+            for entry in it:
+                name = entry.name
+                lower = name.lower()
+                if lower.endswith(extensions):
+                    st = entry.stat()
+                    images[name] = (st.st_size, st.st_mtime_ns)
+                elif name.endswith(SIDECAR_EXTENSION):
+                    sidecars[name[:-len(SIDECAR_EXTENSION)]] = _sidecar_is_valid(entry.path, entry.stat().st_size)
+        return cls(folder_path, mtime_ns, images, sidecars)
+
+    def sorted_images(self):
+        """按排序规则返回所有图片文件名"""
+        if self._sorted is None:
+            self._sorted = sorted(self.images, key=image_sort_key)
+        return self._sorted
+
+    def has_valid_sidecar(self, image_file):
+        """图片是否有对应的非空描述文件"""
+        return self.sidecars.get(os.path.splitext(image_file)[0], False)
+
+    def pending_images(self):
+        """返回没有有效描述文件的图片（按排序规则）"""
+        return [f for f in self.sorted_images() if not self.has_valid_sidecar(f)]
+
+    def is_completed(self):
+        """所有图片是否都有有效的描述文件"""
+        return all(self.has_valid_sidecar(f) for f in self.images)
+
+    def last_processed(self):
+        """返回排序最靠后的已处理图片的基本文件名，没有时返回None"""
+        for image_file in reversed(self.sorted_images()):
+            if self.has_valid_sidecar(image_file):
+                return os.path.splitext(image_file)[0]
+        return None
+
+    def non_numeric_files(self, limit=5):
+        """返回最多limit个非纯数字命名的图片文件"""
+        result = []
+        for image_file in self.images:
+            if not os.path.splitext(image_file)[0].isdigit():
+                result.append(image_file)
+                if len(result) >= limit:
+                    break
+        return result
+
+    def record_sidecar(self, output_file, valid=True):
+        """本程序写入描述文件后更新索引"""
+        base_name = os.path.splitext(os.path.basename(output_file))[0]
+        self.sidecars[base_name] = valid
+
+    def to_dict(self):
+        return {
+            "mtime_ns": self.mtime_ns,
+            "images": {name: list(meta) for name, meta in self.images.items()},
+            "sidecars": self.sidecars,
+        }
+
+    @classmethod
+    def from_dict(cls, folder_path, data):
+        images = {name: tuple(meta) for name, meta in data["images"].items()}
+        return cls(folder_path, data["mtime_ns"], images, data["sidecars"])
+
+
+class FolderIndexStore(object):
+    """保存在磁盘上的文件夹索引集合
+
+    参数:
+        path: 索引文件路径，为None时只在内存中缓存
+        extensions: 作为图片的扩展名，与保存的索引不同时重新扫描所有文件夹
+    """
+
+    def __init__(self, path=None, extensions=IMAGE_EXTENSIONS):
+        self.path = path
+        self.extensions = tuple(extensions)
+        self._folders = {}
+        self._dirty = False
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                saved_extensions = tuple(data.get("extensions", IMAGE_EXTENSIONS))
+                if data.get("version") == INDEX_VERSION and saved_extensions == self.extensions:
+                    self._folders = data.get("folders", {})
+            except (OSError, ValueError):
+                self._folders = {}  # 索引文件损坏时重新扫描
+
+    def get(self, folder_path):
+        """返回文件夹索引；文件夹修改时间没有变化时直接使用保存的索引，否则重新扫描"""
+        key = os.path.abspath(folder_path)
+        cached = self._folders.get(key)
+        if isinstance(cached, FolderIndex):
+            return cached
+        mtime_ns = os.stat(folder_path).st_mtime_ns
+        if cached is not None and cached.get("mtime_ns") == mtime_ns:
+            index = FolderIndex.from_dict(folder_path, cached)
+        else:
+            index = FolderIndex.scan(folder_path, self.extensions)
+            self._dirty = True
+        self._folders[key] = index
+        return index
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def save(self):
+        """把索引写入磁盘（先写临时文件再替换，避免中断时损坏）"""
+        if not self.path or not self._dirty:
+            return
+        folders = {}
+        for key, value in self._folders.items():
+            if isinstance(value, FolderIndex):
+                # 保留扫描时的修改时间：扫描之后有新建文件的文件夹下次会重新扫描
+                value = value.to_dict()
+            folders[key] = value
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": INDEX_VERSION, "extensions": list(self.extensions), "folders": folders}, f,
+                      ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+跨文件夹公平调度 / Fair-Share Folder Scheduler
+========================================================
+
+【功能说明 / Function Description】
+把所有文件夹的待处理图片交给同一个并发池，按权重公平地轮流处理，而不是一个文件夹处理完
+再处理下一个，大文件夹不会让后面的文件夹一直等待。
+
+Feeds the pending images of all folders into one shared worker pool and
+interleaves them by weight instead of finishing one folder before starting
+the next, so one huge folder no longer starves the folders behind it.
+
+【调度规则 / Scheduling Rules】
+1. 优先级：有待处理图片的高优先级文件夹总是先于低优先级文件夹
+   / Priority: a folder with a higher priority always goes before lower ones while it has pending images
+2. 前N张（first_n）：同一优先级中，先处理每个文件夹的前N张图片，再继续处理更深的图片
+   / First N: within one priority, the first N images of every folder go before any deeper image
+3. 加权公平队列（按开始时间的公平排队）：同一层级中，每个文件夹分到的图片数与权重成正比
+   / Weighted fair queuing (start-time fair queuing): within one level every folder gets
+   a share of the images proportional to its weight
+4. 每个文件夹的并发上限：达到上限的文件夹暂时跳过，其它文件夹继续处理
+   / Per-folder concurrency caps: a folder at its cap is skipped while the others continue
+
+"进行中"从任务被取出开始计算，到引擎调用done()为止（包括预读取、排队和重试等待）。
+A job counts as in flight from the moment it is taken until the engine calls
+done(), including prefetch, queueing and retry backoff.
+"""
+
+import collections
+import threading
+
+
+class _FolderQueue(object):
+    def __init__(self, name, jobs, weight, priority, max_in_flight):
+        if weight <= 0:
+            raise ValueError("weight 必须大于0")
+        self.name = name
+        self.jobs = collections.deque(jobs)
+        self.weight = weight
+        self.priority = priority
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.dispatched = 0
+        self.remaining = len(self.jobs)  # 尚未结束的任务数
+        self.last_finish = 0.0  # 上一个任务的虚拟结束时间
+
+    def eligible(self):
+        return self.jobs and (self.max_in_flight is None or self.in_flight < self.max_in_flight)
+
+
+class FairScheduler(object):
+    """跨文件夹的公平调度器
+
+    迭代调度器得到下一个应处理的任务；所有文件夹都没有可以取出的任务时阻塞等待done()，
+    全部任务都取出且调用了close()后迭代结束。可以直接作为DescribeEngine.run_stream的任务来源。
+
+    参数:
+        first_n: 先处理每个文件夹的前多少张图片，为None时不分层
+    """
+
+    def __init__(self, first_n=None):
+        self.first_n = first_n
+        self._folders = {}
+        self._job_folder = {}  # id(任务) -> 文件夹名称
+        self._virtual_time = 0.0
+        self._closed = False
+        self._stopped = False
+        self._cond = threading.Condition()
+
+    def add_folder(self, name, jobs, weight=1.0, priority=0, max_in_flight=None):
+        """加入一个文件夹的任务（按处理顺序排列）
+
+        参数:
+            name: 文件夹名称
+            jobs: 任务列表
+            weight: 权重，同一层级中分到的图片数与权重成正比
+            priority: 优先级，数值越大越先处理
+            max_in_flight: 该文件夹同时进行中的任务数上限，为None时不限制
+        """
+        with self._cond:
+            if name in self._folders:
+                raise ValueError(f"文件夹已存在: {name}")
+            folder = _FolderQueue(name, jobs, weight, priority, max_in_flight)
+            # 新加入的文件夹从当前虚拟时间开始，不能积累之前的份额
+            folder.last_finish = self._virtual_time
+            self._folders[name] = folder
+            for job in folder.jobs:
+                self._job_folder[id(job)] = name
+            self._cond.notify_all()
+
+    def close(self):
+        """不再加入新的文件夹，所有任务取出后迭代结束"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stop(self):
+        """立即结束迭代，剩余的任务不再取出"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def folder_of(self, job):
+        return self._job_folder.get(id(job))
+
+    def _select(self):
+        """选出下一个取任务的文件夹：优先级、是否已超过前N张、虚拟结束时间"""
+        best = None
+        best_key = None
+        for folder in self._folders.values():
+            if not folder.eligible():
+                continue
+            start = max(self._virtual_time, folder.last_finish)
+            deep = self.first_n is not None and folder.dispatched >= self.first_n
+            key = (-folder.priority, deep, start + 1.0 / folder.weight, folder.name)
+            if best_key is None or key < best_key:
+                best, best_key = folder, key
+        return best
+
+    def next_job(self):
+        """返回下一个任务，没有更多任务时返回None；所有文件夹都达到并发上限时等待"""
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                folder = self._select()
+                if folder is not None:
+                    start = max(self._virtual_time, folder.last_finish)
+                    folder.last_finish = start + 1.0 / folder.weight
+                    self._virtual_time = start
+                    folder.in_flight += 1
+                    folder.dispatched += 1
+                    return folder.jobs.popleft()
+                if self._closed and not any(folder.jobs for folder in self._folders.values()):
+                    return None
+                self._cond.wait()
+
+    def __iter__(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            yield job
+
+    def done(self, job):
+        """任务结束（成功、失败或被跳过）时调用，返回该文件夹的所有任务是否都已结束"""
+        with self._cond:
+            folder = self._folders.get(self._job_folder.pop(id(job), None))
+            if folder is None:
+                return False
+            folder.in_flight -= 1
+            folder.remaining -= 1
+            self._cond.notify_all()
+            return folder.remaining == 0
+
+    def stats(self):
+        """返回每个文件夹的 (已取出, 进行中, 未结束) 数量"""
+        with self._cond:
+            return {name: (f.dispatched, f.in_flight, f.remaining) for name, f in self._folders.items()}
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+融合转换 / Fused In-Memory Conversion
+========================================================
+
+【功能说明 / Function Description】
+不需要先运行convert_to_png.py：描述引擎读取原始图片（JPEG、WebP、TIFF、BMP、GIF等）后，
+用与convert_to_png.py相同的解码和规范化步骤（透明通道保留为RGBA，否则为RGB，可选的长边上限）
+在内存中得到图片，直接交给上传压缩或编码为PNG上传，中间不在磁盘上写入和重新读取PNG文件。
+
+No need to run convert_to_png.py first: after the describe engine reads a raw
+image (JPEG, WebP, TIFF, BMP, GIF and so on), the same decode and normalize
+steps as convert_to_png.py (transparency kept as RGBA, otherwise RGB, optional
+long edge limit) produce the image in memory, which goes straight to payload
+compression or is encoded as PNG for upload. No intermediate PNG is written
+to disk and read back.
+
+写出PNG文件是可选的，在单独的后台线程中进行，不占用请求的并发名额；
+未启用上传压缩时上传的就是这份PNG数据，写文件时直接复用，不会再编码一次。
+可以选择在PNG写出后删除原文件，与convert_to_png.py的结果相同。
+
+Writing the PNG file is optional and happens on a separate background thread
+without holding a request slot. When payload compression is off, the uploaded
+bytes are that PNG and are reused for the file instead of encoding twice. The
+original can optionally be deleted once the PNG is written, matching the
+result of convert_to_png.py.
+
+【使用方法 / Usage】
+    with FusedConverter(write_png=True) as converter:
+        engine = DescribeEngine(client, controller, converter=converter)
+        engine.run_sync(jobs)
+"""
+
+import concurrent.futures
+import io
+import os
+import threading
+from pathlib import Path
+
+from convert_to_png import decode_image, encode_params, IMAGE_EXTENSIONS
+
+# 融合转换可以直接描述的图片扩展名（convert_to_png.py支持的所有格式）
+FUSED_EXTENSIONS = tuple(sorted(IMAGE_EXTENSIONS))
+
+
+class FusedConverter(object):
+    """在内存中解码和规范化图片，可选地在后台写出PNG文件，可以被多个线程同时使用
+
+    参数:
+        write_png: 是否在后台写出与原图同名的.png文件
+        delete_original: 写出PNG后是否删除原文件（仅在write_png时有效）
+        profile: PNG编码配置名称或保存参数（参见convert_to_png.PNG_PROFILES），为空时使用convert_to_png.ENCODE_PROFILE
+        max_dimension: 长边的像素上限，为空时不缩小
+        writer_workers: 写出PNG的线程数
+        max_pending_writes: 等待写出的图片数上限，达到上限时解码线程等待，避免已解码的图片堆积在内存中
+    """
+
+    def __init__(self, write_png=False, delete_original=False, profile=None, max_dimension=None,
+                 writer_workers=1, max_pending_writes=8):
+        self.write_png = write_png
+        self.delete_original = delete_original
+        self.params = encode_params(profile)
+        self.max_dimension = max_dimension
+        self.written = 0  # 已写出的PNG文件数
+        self.failed = 0  # 写出失败的文件数
+        self.last_error = None  # 最近一次写出失败的异常
+        self._outputs = set()  # 本程序写出的PNG文件路径
+        self._slots = threading.BoundedSemaphore(max_pending_writes)
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=writer_workers, thread_name_prefix="png-writer") if write_png else None
+
+    def signature(self):
+        """长边上限会改变上传的图片，因此参与缓存键的计算"""
+        return f"fused:{self.max_dimension or 0}"
+
+    def decode(self, data):
+        """解码并规范化图片字节，返回PIL图片"""
+        return decode_image(io.BytesIO(data), max_dimension=self.max_dimension)[0]
+
+    def encode(self, img):
+        """在内存中编码为PNG，返回字节"""
+        buffer = io.BytesIO()
+        img.save(buffer, 'PNG', **self.params)
+        return buffer.getvalue()
+
+    def write_later(self, source_path, data, img=None, png=None):
+        """提交后台写出任务（未启用write_png或原图已经是PNG时不做任何事）
+
+        参数:
+            source_path: 原图路径
+            data: 原图字节，没有已解码的图片时在写出线程中解码
+            img: 已解码并规范化的图片
+            png: 已编码的PNG字节，有时直接写入文件
+        """
+        if not self.write_png or Path(source_path).suffix.lower() == '.png':
+            return
+        self._slots.acquire()
+        try:
+            self._executor.submit(self._write, source_path, data, img, png)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _write(self, source_path, data, img, png):
+        target_path = str(Path(source_path).with_suffix('.png'))
+        tmp_path = target_path + ".tmp"
+        try:
+            if png is None:
+                png = self.encode(img if img is not None else self.decode(data))
+            # 先写临时文件再替换，中断时不会留下不完整的PNG
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, target_path)
+            with self._lock:
+                self._outputs.add(os.path.abspath(target_path))
+                self.written += 1
+            if self.delete_original:
+                os.remove(source_path)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+                self.last_error = e
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        finally:
+            self._slots.release()
+
+    def is_output(self, path):
+        """是否为本程序写出的PNG文件（监视模式下不作为新图片处理）"""
+        with self._lock:
+            return os.path.abspath(path) in self._outputs
+
+    def close(self):
+        """等待所有PNG写出完成"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
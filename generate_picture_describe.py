@@ -22,12 +22,13 @@ English descriptions and saves them as text files with the same name.
    - PROCESS_ALL_FOLDERS: 是否处理所有文件夹 / Whether to process all folders
      - True: 处理所有文件夹 / Process all folders
      - False: 只处理CURRENT_FOLDER指定的文件夹 / Only process the folder specified by CURRENT_FOLDER
+   - MAX_CONCURRENCY: 同时进行中的描述请求数量上限，实际并发会根据限流情况自动调整 / Upper bound of describe requests in flight, adjusted automatically on throttling
 
 2. 运行程序 / Run the program: python generate_picture_describe.py
 
 3. 程序将 / The program will:
    - 读取图片文件夹中的图片（按文件名排序）/ Read images from the folder (sorted by filename)
-   - 调用讯飞星火API识别图片内容 / Call Xunfei Spark API to recognize image content
+   - 并发调用讯飞星火API识别图片内容 / Call Xunfei Spark API concurrently to recognize image content
    - 生成对应的英文描述，保存为同名的.txt文件 / Generate corresponding English descriptions and save as .txt files
    - 处理过程会显示在屏幕上 / The processing progress will be displayed on screen
 
@@ -59,333 +60,463 @@ For consistent processing order, it's recommended to use pure numeric naming (li
 The program will automatically detect file naming patterns and provide appropriate prompts
 
 【断点续传 / Resume Function】
-如果程序中断，再次运行时会自动从上次处理的地方继续，
+每张图片的处理状态记录在任务台账（BASE_DIR/describe_jobs.db）中。
+如果程序中断，再次运行时会自动处理所有尚未完成的图片（包括之前失败的图片），
 不会重复处理已经生成描述的图片。
 
-If the program is interrupted, it will automatically continue from where it left off when run again,
-without reprocessing images that have already been described.
+The state of every image is recorded in the job ledger (BASE_DIR/describe_jobs.db).
+If the program is interrupted, the next run automatically processes every unfinished image
+(including images that failed before), without reprocessing images that have already been described.
+
+【重试与死信 / Retries and Dead Letters】
+超时、限流等失败的请求按指数退避（带随机抖动）自动重试；
+重试次数用尽或因内容被拒绝的图片记录在死信文件（BASE_DIR/dead_letters.jsonl）中，
+设置REPLAY_DEAD_LETTERS = True后运行程序会只重放这些图片。
+
+Requests that fail because of timeouts, throttling and similar errors are retried
+automatically with jittered exponential backoff. Images that run out of attempts or
+are rejected because of their content are recorded in the dead-letter file
+(BASE_DIR/dead_letters.jsonl); with REPLAY_DEAD_LETTERS = True the program only
+replays those images.
+
+【多机协作 / Multiple Workers】
+多台机器通过共享文件系统（如NFS）处理同一个BASE_DIR时，设置WORKER_MODE：
+  - "shard": 按图片相对路径的哈希固定分片，每个工作进程设置不同的SHARD_INDEX
+  - "lease": 处理前在BASE_DIR/.leases中认领租约，崩溃的工作进程的租约过期后由其它进程接手
+也可以用环境变量DESCRIBE_WORKER_MODE、DESCRIBE_SHARD_INDEX、DESCRIBE_SHARD_COUNT、DESCRIBE_WORKER_ID设置。
+工作进程模式下台账、索引、缓存和死信文件按WORKER_ID分别保存，避免多台机器同时写同一个SQLite文件。
+
+When several machines process the same BASE_DIR over a shared filesystem such as
+NFS, set WORKER_MODE:
+  - "shard": fixed shards by a hash of each image's relative path; give every worker a different SHARD_INDEX
+  - "lease": claim a lease in BASE_DIR/.leases before describing an image; leases of crashed
+    workers expire and are taken over by the others
+The environment variables DESCRIBE_WORKER_MODE, DESCRIBE_SHARD_INDEX, DESCRIBE_SHARD_COUNT and
+DESCRIBE_WORKER_ID can be used as well. In worker mode the ledger, index, cache and dead-letter
+files are kept per WORKER_ID, so hosts never write the same SQLite file.
+
+【融合转换 / Fused Conversion】
+设置FUSED_CONVERT = True后不需要先运行convert_to_png.py：JPEG、WebP、TIFF、BMP、GIF等原始图片
+在内存中解码和规范化后直接上传，一次运行完成描述；FUSED_WRITE_PNG = True时在后台同时写出PNG文件。
+
+With FUSED_CONVERT = True there is no need to run convert_to_png.py first: raw
+JPEG, WebP, TIFF, BMP, GIF and similar images are decoded and normalized in
+memory and uploaded directly, so a tree is described in one pass; with
+FUSED_WRITE_PNG = True the PNG files are written in the background as well.
 
 【注意事项 / Notes】
-- 图片文件必须是支持的格式: PNG, WEBP, JPEG, JPG / Image files must be in supported formats
+- 图片文件必须是支持的格式: PNG, WEBP, JPEG, JPG（融合转换时还支持TIFF、BMP、GIF）
+  / Image files must be in supported formats (TIFF, BMP and GIF as well with fused conversion)
 - 图片文件可以是任意名称，会按照名称排序处理 / Image files can have any name and will be processed in order by name
 - 需要连接网络访问星火AI服务 / Internet connection is required to access the Xunfei Spark AI service
 """
 
-import _thread as thread
-import base64
-import datetime
-import hashlib
-import hmac
-import json
-from urllib.parse import urlparse
-import ssl
-from datetime import datetime
-from time import mktime
-from urllib.parse import urlencode
-from wsgiref.handlers import format_date_time
-import websocket  # 使用websocket_client
+import contextlib
 import os
-import time
 
-# 全局配置参数
-appid = "3c571b44"  # 填写控制台中获取的 APPID 信息
-api_secret = "NmNjZWZmYWE1YTFiODYyYmMwZTRiMDI0"  # 填写控制台中获取的 APISecret 信息
-api_key = "797b6f8d7ba5f1fe84e345a57a32385a"  # 填写控制台中获取的 APIKey 信息
-imageunderstanding_url = "wss://spark-api.cn-huabei-1.xf-yun.com/v2.1/image"  # 云端环境的服务地址
+from describe_cache import DescriptionCache
+from describe_engine import DescribeEngine, DescribeJob
+from describe_metrics import DescribeMetrics, MetricsServer
+from folder_index import FolderIndex, FolderIndexStore, IMAGE_EXTENSIONS
+from folder_scheduler import FairScheduler
+from hedge_policy import HedgePolicy
+from image_describer import DEFAULT_URL, ENV_API_KEY, ENV_API_SECRET, ENV_APPID, ENV_URL
+from image_watcher import ImageWatcher
+from job_ledger import JobLedger
+from output_store import open_output_store, OUTPUT_TXT
+from rate_control import AdaptiveRateController, CircuitBreaker
+from retry_policy import DeadLetterLog, RetryPolicy
+from spark_client import AnswerBudget, SparkImageClient
+from trace_recorder import TraceRecorder
+from work_lease import default_worker_id, in_shard, LeaseManager
+
+# 全局配置参数（鉴权信息也可以通过环境变量SPARK_APPID、SPARK_API_SECRET、SPARK_API_KEY、SPARK_IMAGE_URL设置）
+appid = os.environ.get(ENV_APPID) or "3c571b44"  # 填写控制台中获取的 APPID 信息
+api_secret = os.environ.get(ENV_API_SECRET) or "NmNjZWZmYWE1YTFiODYyYmMwZTRiMDI0"  # 填写控制台中获取的 APISecret 信息
+api_key = os.environ.get(ENV_API_KEY) or "797b6f8d7ba5f1fe84e345a57a32385a"  # 填写控制台中获取的 APIKey 信息
+imageunderstanding_url = os.environ.get(ENV_URL) or DEFAULT_URL  # 云端环境的服务地址
 
 # 全局变量控制文件夹和处理
 CURRENT_FOLDER = "厨房"  # 当前处理的文件夹，仅在单文件夹模式有效
 PROCESS_ALL_FOLDERS = True  # 设为True时处理所有文件夹，设为False时只处理CURRENT_FOLDER
 BASE_DIR = "picture"  # 基础目录，所有图片文件夹的上级目录
-FOLDERS_PROGRESS_FILE = "folders_progress.txt"  # 记录已处理的文件夹
+JOB_LEDGER_FILE = "describe_jobs.db"  # 任务台账（SQLite），记录每张图片的处理状态，位于BASE_DIR下
+LEDGER_MAX_ATTEMPTS = 20  # 一张图片累计发送请求达到该次数后不再自动处理（可通过死信重放）
+
+# 描述的保存方式
+OUTPUT_MODE = OUTPUT_TXT  # "txt": 每张图片一个同名.txt文件; "jsonl"/"sqlite": 追加写入BASE_DIR/OUTPUT_STORE_DIR中的分片文件
+OUTPUT_STORE_DIR = "descriptions"  # 分片存储目录，位于BASE_DIR下，可以用export_descriptions.py导出为.txt文件
+OUTPUT_STORE_SHARDS = 16  # 分片文件数量
+OUTPUT_FSYNC_EVERY = 100  # 每写入多少条描述同步一次磁盘
+
+# 文件夹索引：一次扫描记录图片和描述文件，保存后下次只重新扫描有变化的文件夹
+PERSIST_FOLDER_INDEX = True  # 是否把索引保存到磁盘
+FOLDER_INDEX_FILE = ".folder_index.json"  # 索引文件，位于BASE_DIR下
+
+# 并发控制（AIMD自适应：成功时逐步增加并发，限流时减半）
+MAX_CONCURRENCY = 8  # 同时进行中的描述请求数量上限
+MIN_CONCURRENCY = 1  # 并发数下限
+INITIAL_CONCURRENCY = 2  # 初始并发数
+BREAKER_FAILURE_THRESHOLD = 5  # 连续失败多少次后熔断，暂停所有请求
+BREAKER_OPEN_SECONDS = 30  # 熔断后首次暂停的时间（秒），连续熔断时翻倍
+QUOTA_PAUSE_SECONDS = 300  # 遇到配额耗尽错误码时暂停的时间（秒）
+
+# 超时与重试（超时参数为None时不限制）
+CONNECT_TIMEOUT = 10  # 建立连接的超时时间（秒）
+FIRST_TOKEN_TIMEOUT = 30  # 发送图片后等待第一段描述的超时时间（秒）
+TOTAL_TIMEOUT = 120  # 单次请求的总超时时间（秒）
+RETRY_MAX_ATTEMPTS = 5  # 每张图片在一次运行中的最大尝试次数
+RETRY_BASE_DELAY = 2  # 第一次重试前的基础等待时间（秒），之后每次翻倍
+RETRY_MAX_DELAY = 120  # 重试等待时间上限（秒）
+DEAD_LETTER_FILE = "dead_letters.jsonl"  # 最终失败的图片记录，位于BASE_DIR下
+REPLAY_DEAD_LETTERS = False  # 设为True时只重放死信文件中的图片
+
+# 长尾延迟与token用量
+HEDGE_PERCENTILE = None  # 设置（如0.95）后，请求耗时超过最近成功请求的该分位数时再发送一个相同的请求，采用先成功的一个
+HEDGE_MAX_RATIO = 0.05  # 对冲请求数占全部请求数的比例上限（对冲会重复消耗上传图片的token）
+HEDGE_MIN_SAMPLES = 20  # 至少有多少个成功请求的耗时后才开始对冲
+ANSWER_BUDGET = False  # 设为True后按提示词中的字数要求（如"100-150个单词"）设置max_tokens，描述超出后在句末截断并提前关闭连接
+ANSWER_MARGIN = 1.3  # 允许描述超出提示词字数要求的比例
+
+# 流水线：请求进行时预读取并压缩后面的图片，描述文件由写入线程保存
+PREFETCH_BYTES = 64 * 1024 * 1024  # 预读取的图片数据总量上限（字节），为0时不预读取
+PREFETCH_WORKERS = 4  # 预读取线程数
+WRITER_WORKERS = 1  # 保存描述文件的线程数
+
+# 多机协作（多个工作进程通过共享文件系统处理同一个BASE_DIR）
+WORKER_MODE = os.environ.get("DESCRIBE_WORKER_MODE") or None  # None: 单个进程; "shard": 固定分片; "lease": 租约认领
+WORKER_ID = os.environ.get("DESCRIBE_WORKER_ID") or default_worker_id()  # 工作进程标识，默认为 主机名-进程号
+SHARD_COUNT = int(os.environ.get("DESCRIBE_SHARD_COUNT", 1))  # 分片总数（"shard"模式）
+SHARD_INDEX = int(os.environ.get("DESCRIBE_SHARD_INDEX", 0))  # 本工作进程负责的分片编号，从0开始（"shard"模式）
+LEASE_DIR = ".leases"  # 租约目录，位于BASE_DIR下（"lease"模式）
+LEASE_TTL = 120  # 租约有效期（秒），崩溃的工作进程的租约在此之后被接手
+LEASE_HEARTBEAT = 30  # 刷新租约的间隔（秒）
+
+# 描述缓存（按图片内容、提示词和模型参数缓存描述，相同图片不再重复请求）
+USE_DESCRIPTION_CACHE = True  # 是否启用描述缓存
+DESCRIPTION_CACHE_FILE = "describe_cache.db"  # 缓存数据库文件，位于BASE_DIR下
+CACHE_MAX_ENTRIES = 500000  # 缓存条目上限，超过后按最近访问时间淘汰
+CACHE_MAX_AGE_DAYS = 180  # 缓存条目最长保留天数
+
+# 近似重复图片分组（需要安装Pillow和numpy）
+GROUP_NEAR_DUPLICATES = False  # 是否只描述每组近似重复图片中的一张，其它图片复制其描述
+NEAR_DUPLICATE_THRESHOLD = 4  # 感知哈希的汉明距离阈值，越大越宽松
+
+# 上传前压缩图片（需要安装Pillow），超出预算的图片会在内存中缩小并重新编码
+COMPRESS_PAYLOAD = False  # 是否启用上传压缩（会把图片重新编码为有损格式，默认上传原图）
+PAYLOAD_MAX_BYTES = 1024 * 1024  # 单张图片上传的字节预算（base64之前）
+PAYLOAD_MAX_EDGE = 1600  # 上传图片的最长边（像素）
+PAYLOAD_FORMATS = ('JPEG',)  # 依次尝试的编码格式，可选 'JPEG'、'WEBP'
+
+# 融合转换配置（需要Pillow）
+FUSED_CONVERT = False  # 设为True时直接描述原始图片（convert_to_png.py支持的所有格式），在内存中解码后上传，不需要先转换
+FUSED_WRITE_PNG = False  # 融合转换时是否在后台写出同名的PNG文件
+FUSED_DELETE_ORIGINAL = False  # 写出PNG后是否删除原文件（与convert_to_png.py的结果相同）
+FUSED_MAX_DIMENSION = None  # 解码时的长边上限（像素），参见convert_to_png.py的MAX_DIMENSION
+FUSED_ENCODE_PROFILE = "fastest"  # 上传和写出PNG使用的编码配置，参见convert_to_png.py的PNG_PROFILES
+
+# 处理所有文件夹时的调度方式
+SCHEDULER = "sequential"  # "sequential": 按名称顺序逐个处理文件夹; "fair": 所有文件夹共享同一个并发池，按权重轮流处理
+FOLDER_WEIGHTS = {}  # 文件夹名称 -> 权重（默认1），"fair"模式下分到的请求数与权重成正比
+FOLDER_PRIORITIES = {}  # 文件夹名称 -> 优先级（默认0），优先级高的文件夹有待处理图片时总是先处理
+FOLDER_MAX_CONCURRENCY = {}  # 文件夹名称 -> 该文件夹同时处理的图片数上限
+DEFAULT_FOLDER_MAX_CONCURRENCY = None  # 未在FOLDER_MAX_CONCURRENCY中设置的文件夹的上限，None表示不限制
+FIRST_N_PER_FOLDER = None  # 设置后先处理每个文件夹的前N张图片，所有文件夹都处理完前N张后再继续
+
+# 监视模式：常驻运行，先处理已有的未完成图片，之后只描述新建或被修改的图片
+WATCH_MODE = False  # 设为True时进入监视模式（按Ctrl+C退出）
+WATCH_SETTLE_SECONDS = 2  # 图片最后一次变化后保持不变多少秒才认为写入完成
+WATCH_POLL_INTERVAL = 5  # inotify不可用时轮询扫描的间隔（秒）
+WATCH_USE_INOTIFY = True  # 设为False时总是使用轮询
+
+# 指标与状态端点
+METRICS_PORT = None  # 设置端口（如9108）后在 http://METRICS_HOST:端口/metrics 提供Prometheus格式的请求指标、队列长度和预计剩余时间
+METRICS_HOST = "127.0.0.1"  # 指标端点的监听地址
+TRACE_FILE = None  # 设置文件名（如"describe_trace.json"）后记录每个阶段、每张图片的耗时，保存在BASE_DIR下，可在Perfetto中打开
+PROFILE_SLOWEST = 0  # 为最慢的多少张图片的请求和压缩保存cProfile结果（保存在trace文件旁的 _slowest 目录中）
+MEMORY_SLOWEST = 0  # 为最慢的多少张图片保存tracemalloc内存快照
+PRINT_DESCRIPTIONS = True  # 是否在屏幕上打印每张图片的描述；长时间运行时可关闭，进度通过指标端点查看
 
 # 提示词作为全局变量
 PROMPT_TEMPLATE = "对下面图片进行描述（使用英文回答）,自然语言的形式列出,不要分点列出,内容要求精简一些,对于图片的的描述一定要准确,这张图片的主题是{folder_name}, 给你举个例子：A pristine hallway with a white ceiling, walls, and doors, featuring grey tiled flooring and black door handles. Linear lighting accents the ceiling, leading to a blue-tinted glass door at the end. 这种形式对张图片进行描述,一定要对图片进行准确描述,100-150个单词左右"
 
-# 初始全局答案变量
-answer = ""
-text = []
 
+def state_file(name):
+    """返回BASE_DIR下的本地状态文件路径；工作进程模式下每个工作进程使用自己的文件"""
+    if WORKER_MODE:
+        base, ext = os.path.splitext(name)
+        name = f"{base}.{WORKER_ID}{ext}"
+    return os.path.join(BASE_DIR, name)
 
-class Ws_Param(object):
-    # 初始化
-    def __init__(self, APPID, APIKey, APISecret, imageunderstanding_url):
-        self.APPID = APPID
-        self.APIKey = APIKey
-        self.APISecret = APISecret
-        self.host = urlparse(imageunderstanding_url).netloc
-        self.path = urlparse(imageunderstanding_url).path
-        self.ImageUnderstanding_url = imageunderstanding_url
 
-    # 生成url
-    def create_url(self):
-        # 生成RFC1123格式的时间戳
-        now = datetime.now()
-        date = format_date_time(mktime(now.timetuple()))
+# 本次运行的请求指标，设置METRICS_PORT时由start_metrics_server()创建
+_metrics = None
 
-        # 拼接字符串
-        signature_origin = "host: " + self.host + "\n"
-        signature_origin += "date: " + date + "\n"
-        signature_origin += "GET " + self.path + " HTTP/1.1"
 
-        # 进行hmac-sha256进行加密
-        signature_sha = hmac.new(self.APISecret.encode('utf-8'), signature_origin.encode('utf-8'),
-                                 digestmod=hashlib.sha256).digest()
+def start_metrics_server():
+    """设置了METRICS_PORT时启动指标端点，返回MetricsServer，否则返回None"""
+    global _metrics
+    if METRICS_PORT is None:
+        return None
+    _metrics = DescribeMetrics()
+    server = MetricsServer(_metrics, METRICS_HOST, METRICS_PORT).start()
+    print(f"指标端点: http://{METRICS_HOST}:{server.port}/metrics")
+    return server
 
-        signature_sha_base64 = base64.b64encode(signature_sha).decode(encoding='utf-8')
 
-        authorization_origin = f'api_key="{self.APIKey}", algorithm="hmac-sha256", headers="host date request-line", signature="{signature_sha_base64}"'
+# 本次运行的阶段耗时追踪，设置TRACE_FILE时由start_tracing()创建
+_tracer = None
 
-        authorization = base64.b64encode(authorization_origin.encode('utf-8')).decode(encoding='utf-8')
 
-        # 将请求的鉴权参数组合为字典
-        v = {
-            "authorization": authorization,
-            "date": date,
-            "host": self.host
-        }
-        # 拼接鉴权参数,生成url
-        url = self.ImageUnderstanding_url + '?' + urlencode(v)
-        # print(url)
-        # 此处打印出建立连接时候的url,参考本demo的时候可取消上方打印的注释,比对相同参数时生成的url与自己代码生成的url是否一致
-        return url
+def start_tracing():
+    """设置了TRACE_FILE时开始记录各阶段的耗时"""
+    global _tracer
+    if TRACE_FILE:
+        _tracer = TraceRecorder(profile_slowest=PROFILE_SLOWEST, memory_slowest=MEMORY_SLOWEST)
 
 
-# 收到websocket错误的处理
-def on_error(ws, error):
-    print("### error:", error)
+def save_trace():
+    """保存trace文件（未启用追踪时不做任何事）"""
+    if _tracer is None:
+        return
+    path = os.path.join(BASE_DIR, TRACE_FILE)
+    slowest_dir = _tracer.save(path)
+    print(f"追踪文件已保存: {path}（可在 https://ui.perfetto.dev 中打开）")
+    if slowest_dir:
+        print(f"最慢图片的分析结果: {slowest_dir}")
 
 
-# 收到websocket关闭的处理
-def on_close(ws, one, two):
-    print(" ")
+def trace_span(name, **args):
+    """记录一个阶段的耗时区间，未启用追踪时返回空的上下文"""
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name, "describe", **args)
 
 
-# 收到websocket连接建立的处理
-def on_open(ws):
-    thread.start_new_thread(run, (ws,))
+# 本次运行的融合转换器，设置FUSED_CONVERT时由start_converter()创建
+_converter = None
 
 
-def run(ws, *args):
-    data = json.dumps(gen_params(appid=ws.appid, question=ws.question))
-    ws.send(data)
+def start_converter():
+    """设置了FUSED_CONVERT时创建融合转换器"""
+    global _converter
+    if FUSED_CONVERT:
+        from fused_convert import FusedConverter  # 仅在启用融合转换时需要Pillow
 
+        _converter = FusedConverter(write_png=FUSED_WRITE_PNG, delete_original=FUSED_DELETE_ORIGINAL,
+                                    profile=FUSED_ENCODE_PROFILE, max_dimension=FUSED_MAX_DIMENSION)
 
-# 收到websocket消息的处理
-def on_message(ws, message):
-    # print(message)
-    data = json.loads(message)
-    code = data['header']['code']
-    if code != 0:
-        print(f'请求错误: {code}, {data}')
-        ws.close()
-    else:
-        choices = data["payload"]["choices"]
-        status = choices["status"]
-        content = choices["text"][0]["content"]
-        print(content, end="")
-        global answer
-        answer += content
-        # print(1)
-        if status == 2:
-            ws.close()
-
-
-def gen_params(appid, question):
-    """
-    通过appid和用户的提问来生成请参数
-    """
 
-    data = {
-        "header": {
-            "app_id": appid
-        },
-        "parameter": {
-            "chat": {
-                "domain": "image",
-                "temperature": 0.5,
-                "top_k": 4,
-                "max_tokens": 2028,
-                "auditing": "default"
-            }
-        },
-        "payload": {
-            "message": {
-                "text": question
-            }
-        }
-    }
-
-    return data
-
-
-def main(appid, api_key, api_secret, imageunderstanding_url, question):
-    global answer
-    answer = ""
-    wsParam = Ws_Param(appid, api_key, api_secret, imageunderstanding_url)
-    websocket.enableTrace(False)
-    wsUrl = wsParam.create_url()
-    ws = websocket.WebSocketApp(wsUrl, on_message=on_message, on_error=on_error, on_close=on_close, on_open=on_open)
-    ws.appid = appid
-    # ws.imagedata = imagedata
-    ws.question = question
-    ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
-    return answer
-
-
-def getText(role, content):
-    jsoncon = {}
-    jsoncon["role"] = role
-    jsoncon["content"] = content
-    text.append(jsoncon)
-    return text
-
-
-def getlength(text):
-    length = 0
-    for content in text:
-        temp = content["content"]
-        leng = len(temp)
-        length += leng
-    return length
-
-
-def checklen(text):
-    # print("text-content-tokens:", getlength(text[1:]))
-    while (getlength(text[1:]) > 8000):  # 如果长度大于8000,则删除text[1]
-        del text[1]
-    return text
-
-
-def get_progress_file(folder_path):
-    """返回进度文件的路径"""
-    return os.path.join(folder_path, "progress.txt")
-
-
-def read_progress(progress_file):
-    """读取已处理的图片记录"""
-    if not os.path.exists(progress_file):
-        return set()
-
-    with open(progress_file, 'r') as f:
-        processed = set(line.strip() for line in f if line.strip())
-    return processed
-
-
-def update_progress(progress_file, filename):
-    """更新已处理的图片记录"""
-    with open(progress_file, 'a') as f:
-        f.write(f"{filename}\n")
-
-
-def read_folders_progress():
-    """读取已处理的文件夹记录"""
-    progress_file = os.path.join(BASE_DIR, FOLDERS_PROGRESS_FILE)
-    if not os.path.exists(progress_file):
-        return set()
-
-    with open(progress_file, 'r') as f:
-        processed = set(line.strip() for line in f if line.strip())
-    return processed
-
-
-def update_folders_progress(folder_name):
-    """更新已处理的文件夹记录"""
-    progress_file = os.path.join(BASE_DIR, FOLDERS_PROGRESS_FILE)
-    with open(progress_file, 'a') as f:
-        f.write(f"{folder_name}\n")
-
-
-def get_sorted_image_files(folder_path):
-    """获取文件夹中的所有图片文件(支持png, webp, jpeg, jpg)并排序
-    排序规则：纯数字的文件名按照数字从小到大排序，非纯数字的文件名按照字母表顺序排序，在排序后纯数字名称排在前面。"""
-    valid_ext = ('.png', '.webp', '.jpeg', '.jpg')
-    image_files = [f for f in os.listdir(folder_path) if f.lower().endswith(valid_ext)]
+def close_converter():
+    """等待后台的PNG写出完成（未启用融合转换时不做任何事）"""
+    if _converter is None:
+        return
+    _converter.close()
+    if FUSED_WRITE_PNG:
+        print(f"已写出PNG文件: {_converter.written} 个，失败 {_converter.failed} 个"
+              + (f"（最近的错误: {_converter.last_error}）" if _converter.last_error else ""))
 
-    # 按规则排序: 纯数字文件名按数值排序，非纯数字按字母排序，纯数字排在前面
-    image_files.sort(key=lambda x: (0, int(os.path.splitext(x)[0])) if os.path.splitext(x)[0].isdigit() else (1, os.path.splitext(x)[0].lower()))
 
-    return image_files
+def image_extensions():
+    """作为图片处理的扩展名；融合转换时包括convert_to_png.py支持的所有格式"""
+    if FUSED_CONVERT:
+        from fused_convert import FUSED_EXTENSIONS
 
+        return FUSED_EXTENSIONS
+    return IMAGE_EXTENSIONS
 
-def is_txt_file_valid(txt_path):
-    """检查txt文件是否存在且非空"""
-    if not os.path.exists(txt_path):
-        return False
 
-    with open(txt_path, 'r') as f:
-        content = f.read().strip()
+def open_lease_manager():
+    """在"lease"模式下创建并启动租约管理器，其它模式返回None"""
+    if WORKER_MODE != "lease":
+        return None
+    return LeaseManager(os.path.join(BASE_DIR, LEASE_DIR), WORKER_ID, ttl=LEASE_TTL,
+                        heartbeat_interval=LEASE_HEARTBEAT).start()
+
+
+def create_client():
+    """根据全局配置创建星火图片理解客户端"""
+    return SparkImageClient(appid, api_key, api_secret, imageunderstanding_url,
+                            connect_timeout=CONNECT_TIMEOUT, first_token_timeout=FIRST_TOKEN_TIMEOUT,
+                            total_timeout=TOTAL_TIMEOUT)
 
-    return len(content) > 0
 
+def create_cache():
+    """根据全局配置打开描述缓存，未启用时返回None"""
+    if not USE_DESCRIPTION_CACHE:
+        return None
+    return DescriptionCache(state_file(DESCRIPTION_CACHE_FILE),
+                            max_entries=CACHE_MAX_ENTRIES, max_age=CACHE_MAX_AGE_DAYS * 86400)
 
-def get_last_processed_image(folder_path):
-    """获取最后一个已处理的图片文件名（不带扩展名）"""
-    image_files = get_sorted_image_files(folder_path)
 
-    if not image_files:
+def create_compressor():
+    """根据全局配置创建上传压缩器，未启用时返回None"""
+    if not COMPRESS_PAYLOAD:
         return None
+    from image_payload import PayloadCompressor  # 仅在启用压缩时需要Pillow
+
+    return PayloadCompressor(max_bytes=PAYLOAD_MAX_BYTES, max_edge=PAYLOAD_MAX_EDGE, formats=PAYLOAD_FORMATS)
 
-    # 检查是否所有图片都有对应的有效txt文件
-    for img_file in reversed(image_files):
-        base_name = os.path.splitext(img_file)[0]
-        txt_file = base_name + ".txt"
-        txt_path = os.path.join(folder_path, txt_file)
 
-        if is_txt_file_valid(txt_path):
-            return base_name
+def create_hedge_policy():
+    """根据全局配置创建对冲请求策略，未启用时返回None"""
+    if HEDGE_PERCENTILE is None:
+        return None
+    return HedgePolicy(percentile=HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES, max_ratio=HEDGE_MAX_RATIO)
 
-    return None
 
+def create_answer_budget():
+    """根据全局配置创建描述字数预算，未启用时返回None"""
+    return AnswerBudget(margin=ANSWER_MARGIN) if ANSWER_BUDGET else None
 
-def is_folder_completed(folder_path):
-    """检查文件夹是否已完成处理（所有png文件都有对应的非空txt）"""
-    image_files = get_sorted_image_files(folder_path)
 
-    if not image_files:
-        return True  # 没有图片的文件夹视为已完成
+def create_rate_controller():
+    """根据全局配置创建自适应并发控制器"""
+    breaker = CircuitBreaker(failure_threshold=BREAKER_FAILURE_THRESHOLD, open_seconds=BREAKER_OPEN_SECONDS)
+    return AdaptiveRateController(initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY,
+                                  maximum=MAX_CONCURRENCY, breaker=breaker, quota_pause=QUOTA_PAUSE_SECONDS)
+
+
+def create_retry_policy():
+    """根据全局配置创建重试策略"""
+    return RetryPolicy(max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY)
+
+
+def open_dead_letter_log():
+    """打开BASE_DIR下的死信文件"""
+    return DeadLetterLog(state_file(DEAD_LETTER_FILE))
+
+
+def open_description_store():
+    """OUTPUT_MODE为"jsonl"或"sqlite"时打开分片存储，"txt"模式返回None"""
+    if OUTPUT_MODE == OUTPUT_TXT:
+        return None
+    # 工作进程模式下每个工作进程写自己的分片文件
+    writer_id = WORKER_ID if WORKER_MODE else "local"
+    return open_output_store(os.path.join(BASE_DIR, OUTPUT_STORE_DIR), OUTPUT_MODE, shards=OUTPUT_STORE_SHARDS,
+                             writer_id=writer_id, fsync_every=OUTPUT_FSYNC_EVERY)
+
+
+def create_engine(cache=None, lease=None, output_store=None, dead_letter=True, max_pending=None):
+    """根据全局配置创建描述引擎
+
+    参数:
+        dead_letter: 是否把最终失败的图片写入死信文件
+        max_pending: 已取出但尚未结束的任务数上限，参见DescribeEngine
+    """
+    return DescribeEngine(create_client(), create_rate_controller(), create_retry_policy(), cache=cache,
+                          compressor=create_compressor(), dead_letter=open_dead_letter_log() if dead_letter else None,
+                          lease=lease, job_key=relative_path, store=output_store,
+                          prefetch_bytes=PREFETCH_BYTES, prefetch_workers=PREFETCH_WORKERS,
+                          writer_workers=WRITER_WORKERS, metrics=_metrics, max_pending=max_pending,
+                          hedge=create_hedge_policy(), answer_budget=create_answer_budget(), tracer=_tracer,
+                          converter=_converter)
 
-    # 检查所有图片是否都有对应的有效txt文件
-    for img_file in image_files:
-        base_name = os.path.splitext(img_file)[0]  # 分割文件名和扩展名的函数 , 返回包含两个元素的元组 (root, ext)
-        txt_file = base_name + ".txt"
-        txt_path = os.path.join(folder_path, txt_file)
 
-        if not is_txt_file_valid(txt_path):
-            return False  # 如果有任何一张图片没有有效的txt文件，则未完成
+def relative_path(job):
+    """任务图片相对于BASE_DIR的路径，作为台账、租约和分片存储的键"""
+    return os.path.relpath(job.image_path, BASE_DIR)
 
-    return True  # 所有图片都有对应的有效txt文件
 
+def open_ledger():
+    """打开BASE_DIR下的任务台账"""
+    return JobLedger(state_file(JOB_LEDGER_FILE))
 
-def check_filename_format(folder_path):
+
+def get_sorted_image_files(folder_path, index=None):
+    """获取文件夹中的所有图片文件(支持png, webp, jpeg, jpg，融合转换时还支持tiff, bmp, gif)并排序
+    排序规则：纯数字的文件名按照数字从小到大排序，非纯数字的文件名按照字母表顺序排序，在排序后纯数字名称排在前面。
+
+    index: 已建立的FolderIndex，为空时扫描一次文件夹"""
+    if index is None:
+        index = FolderIndex.scan(folder_path, image_extensions())
+    return list(index.sorted_images())
+
+
+def get_done_paths(folder_path, index=None, output_store=None):
+    """返回文件夹中已有描述的图片相对于BASE_DIR的路径集合
+
+    output_store: 分片存储，为空时按.txt文件判断"""
+    if index is None:
+        index = FolderIndex.scan(folder_path, image_extensions())
+    folder_name = os.path.relpath(folder_path, BASE_DIR)
+    if output_store is not None:
+        return set(output_store.keys(folder_name))
+    return {os.path.join(folder_name, f) for f in index.images if index.has_valid_sidecar(f)}
+
+
+def is_folder_completed(folder_path, index=None, output_store=None):
+    """检查文件夹是否已完成处理（所有图片文件都有对应的非空txt或存储中的描述），没有图片的文件夹视为已完成"""
+    if index is None:
+        index = FolderIndex.scan(folder_path, image_extensions())
+    if output_store is None:
+        return index.is_completed()
+    done = get_done_paths(folder_path, index, output_store)
+    folder_name = os.path.relpath(folder_path, BASE_DIR)
+    return all(os.path.join(folder_name, f) in done for f in index.images)
+
+
+def check_filename_format(folder_path, index=None):
     """检查文件夹中的图片文件命名方式，判断是否使用简单的数字命名
 
     参数:
         folder_path: 文件夹路径
+        index: 已建立的FolderIndex，为空时扫描一次文件夹
 
     返回:
         bool: 是否采用数字命名
         list: 非数字命名的文件列表（最多5个）
     """
-    valid_ext = ('.png', '.webp', '.jpeg', '.jpg')
-    image_files = [f for f in os.listdir(folder_path) if f.lower().endswith(valid_ext)]
-
-    # 检查是否都是数字命名的
-    non_numeric_files = []
-    for img_file in image_files:
-        base_name = os.path.splitext(img_file)[0]
-        if not base_name.isdigit():
-            non_numeric_files.append(img_file)
-            if len(non_numeric_files) >= 5:
-                break
+    if index is None:
+        index = FolderIndex.scan(folder_path, image_extensions())
+    non_numeric_files = index.non_numeric_files(limit=5)
 
     # 如果所有文件都是数字命名的，返回True
     return len(non_numeric_files) == 0, non_numeric_files
 
 
-def process_folder(folder_name):
-    """处理单个文件夹中的所有图片"""
-    global text
+def open_index_store():
+    """根据全局配置打开文件夹索引"""
+    path = state_file(FOLDER_INDEX_FILE) if PERSIST_FOLDER_INDEX else None
+    return FolderIndexStore(path, image_extensions())
+
+
+def group_duplicate_jobs(jobs):
+    """对待处理任务进行近似重复分组
+
+    返回:
+        list: 每组代表图片的任务
+        dict: 代表任务的输出文件 -> 其它成员任务列表
+    """
+    from image_dedup import group_near_duplicates  # 仅在启用分组时需要Pillow和numpy
+
+    by_path = {job.image_path: job for job in jobs}
+    groups = group_near_duplicates([job.image_path for job in jobs], threshold=NEAR_DUPLICATE_THRESHOLD)
+    representatives = []
+    duplicates = {}
+    for group in groups:
+        representative = by_path[group[0]]
+        representatives.append(representative)
+        if len(group) > 1:
+            duplicates[representative.output_file] = [by_path[p] for p in group[1:]]
+    # 保持原有的处理顺序
+    order = {job.image_path: i for i, job in enumerate(jobs)}
+    representatives.sort(key=lambda job: order[job.image_path])
+    skipped = len(jobs) - len(representatives)
+    if skipped:
+        print(f"近似重复分组: {len(jobs)} 张图片分为 {len(representatives)} 组，节省 {skipped} 次请求")
+    return representatives, duplicates
+
+
+def process_folder(folder_name, index_store=None, ledger=None, output_store=None):
+    """处理单个文件夹中的所有图片
+
+    参数:
+        folder_name: 文件夹名称
+        index_store: FolderIndexStore，为空时打开BASE_DIR下的索引
+        ledger: JobLedger，为空时打开BASE_DIR下的任务台账
+        output_store: 分片存储，为空时按OUTPUT_MODE打开
+    """
     folder_path = os.path.join(BASE_DIR, folder_name)
 
     # 检查文件夹是否存在
@@ -397,8 +528,76 @@ def process_folder(folder_name):
             print(f"警告: 文件夹 '{folder_name}' 不存在，已跳过")
             return True  # 返回True表示处理完成（虽然是跳过）
 
+    own_store = index_store is None
+    if own_store:
+        index_store = open_index_store()
+    own_ledger = ledger is None
+    if own_ledger:
+        ledger = open_ledger()
+    own_output = output_store is None
+    if own_output:
+        output_store = open_description_store()
+    try:
+        return _process_folder(folder_name, folder_path, index_store, ledger, output_store)
+    finally:
+        if own_store:
+            index_store.save()
+        if own_ledger:
+            ledger.close()
+        if own_output and output_store is not None:
+            output_store.close()
+
+
+def _process_folder(folder_name, folder_path, index_store, ledger, output_store):
+    with trace_span("prepare_folder", folder=folder_name):
+        prepared = _prepare_folder(folder_name, folder_path, index_store, ledger, output_store)
+    if prepared is None:
+        return True
+    jobs, on_done = prepared
+
+    def on_start(job):
+        ledger.mark_started(relative_path(job))
+
+    print(f"待处理图片 {len(jobs)} 张，并发数上限 {MAX_CONCURRENCY}")
+    cache = create_cache()
+    lease = open_lease_manager()
+    try:
+        engine = create_engine(cache, lease, output_store)
+        with trace_span("describe_folder", folder=folder_name, images=len(jobs)):
+            engine.run_sync(jobs, on_done=on_done, on_start=on_start)
+        if engine.callback_errors:
+            print(f"任务结束时回调出错 {engine.callback_errors} 次，最近一次: {engine.last_callback_error}")
+    finally:
+        if lease is not None:
+            lease.stop()
+            print(f"租约: 认领 {lease.claimed} 张，接手过期租约 {lease.reclaimed} 张，被其它工作进程接手 {lease.lost} 张，"
+                  f"跳过 {sum(1 for job in jobs if job.skipped)} 张（已被其它工作进程处理）")
+        if cache is not None:
+            cache.close()
+        if output_store is not None:
+            output_store.flush()
+
+    _finish_folder(folder_name, folder_path, index_store, ledger, output_store)
+    return True  # 表示处理成功完成
+
+
+def _finish_folder(folder_name, folder_path, index_store, ledger, output_store):
+    if is_folder_completed(folder_path, index_store.get(folder_path), output_store):
+        ledger.set_folder_completed(folder_name)
+    print(f"{folder_name} 文件夹中的所有图片处理完成")
+
+
+def _prepare_folder(folder_name, folder_path, index_store, ledger, output_store):
+    """同步文件夹到任务台账并创建待处理任务
+
+    返回:
+        (任务列表, 任务完成时的回调)；文件夹已完成时返回None
+    """
+    # 扫描一次文件夹，后续的判断都查询索引
+    index = index_store.get(folder_path)
+
     # 检查文件夹中的文件命名方式
-    is_numeric_naming, non_numeric_files = check_filename_format(folder_path)
+    is_numeric_naming, non_numeric_files = check_filename_format(folder_path, index)
     if not is_numeric_naming:
         print(f"注意: 文件夹 '{folder_name}' 中存在非纯数字命名的图片文件")
         print("发现非数字命名的文件: " + ", ".join(non_numeric_files[:5]) +
@@ -410,88 +609,86 @@ def process_folder(folder_name):
         print("-" * 50)
 
     # 检查文件夹是否已完成处理
-    if is_folder_completed(folder_path):
+    if is_folder_completed(folder_path, index, output_store):
+        ledger.set_folder_completed(folder_name)
         print(f"文件夹 {folder_name} 已完全处理，跳过")
-        return True
-
-    # 获取最后一个已处理的图片文件名（不带扩展名）
-    last_processed = get_last_processed_image(folder_path)
-
-    # 获取文件夹中的所有PNG图片，并排序
-    image_files = get_sorted_image_files(folder_path)
-
-    if last_processed:
-        print(f"开始处理 {folder_name} 文件夹中的图片，从 {last_processed} 之后开始...")
-    else:
-        print(f"开始处理 {folder_name} 文件夹中的所有图片...")
-
-    # 标记是否找到上次处理的位置
-    found_last_position = last_processed is None
-
-    for image_file in image_files:
-        # 获取当前图片的基本文件名（不带扩展名）
-        current_base = os.path.splitext(image_file)[0]
-
-        # 如果还没找到上次处理的位置且当前不是上次处理的图片，继续查找
-        if not found_last_position:
-            if current_base != last_processed:
-                print(f"图片 {image_file} 已处理，跳过")
-                continue
-            else:
-                # 找到了上次处理的位置，标记已找到，但跳过这个图片（因为已处理）
-                found_last_position = True
-                print(f"图片 {image_file} 已处理，跳过")
-                continue
+        return None
 
+    # 获取文件夹中的所有图片，并排序，同步到任务台账
+    image_files = get_sorted_image_files(folder_path, index)
+    ledger.sync_folder(folder_name,
+                       [os.path.join(folder_name, f) for f in image_files],
+                       get_done_paths(folder_path, index, output_store))
+
+    # 查询所有未完成的图片（包括之前失败、排在已完成图片之前的图片）
+    pending = ledger.pending(folder_name, max_attempts=LEDGER_MAX_ATTEMPTS)
+    if WORKER_MODE == "shard":
+        pending = [p for p in pending if in_shard(p, SHARD_INDEX, SHARD_COUNT)]
+    counts = ledger.counts(folder_name)
+    print(f"开始处理 {folder_name} 文件夹中的图片: 已完成 {counts.get('done', 0)} 张，"
+          f"待处理 {len(pending)} 张（其中曾失败 {counts.get('failed', 0)} 张）")
+
+    # 设置带有文件夹名称的提示词
+    prompt = PROMPT_TEMPLATE.format(folder_name=folder_name)
+    print(f"使用提示词: {prompt[:50]}...")  # 输出部分提示词以验证文件夹名是否正确传入
+
+    jobs = []
+    for pending_path in pending:
         # 图片路径
-        image_path = os.path.join(folder_path, image_file)
+        image_path = os.path.join(BASE_DIR, pending_path)
 
         # 输出文件路径 (将.png替换为.txt)
-        output_file = os.path.join(folder_path, current_base + '.txt')
-
-        try:
-            print(f"处理图片: {image_file}")
-            # 读取图片
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
-
-            # 清除之前的对话
-            text = []
-
-            # 设置带有文件夹名称的提示词
-            prompt = PROMPT_TEMPLATE.format(folder_name=folder_name)
-            print(f"使用提示词: {prompt[:50]}...")  # 输出部分提示词以验证文件夹名是否正确传入
-
-            # 添加图片到对话
-            image_base64 = str(base64.b64encode(image_data), 'utf-8')
-            text.append({"role": "user", "content": image_base64, "content_type": "image"})
-
-            # 添加提示词
-            question = checklen(getText("user", prompt))
-
-            # 调用API获取描述
-            result = main(appid, api_key, api_secret, imageunderstanding_url, question)
-
-            # 保存结果到文件
-            with open(output_file, 'w') as f:
-                f.write(result)
-
-            print(f"已保存描述到: {output_file}")
+        output_file = os.path.splitext(image_path)[0] + '.txt'
+
+        jobs.append(DescribeJob(image_path, output_file, prompt))
+
+    # 近似重复图片只描述代表图片，其它成员在代表图片完成后复制描述
+    duplicates = {}
+    if GROUP_NEAR_DUPLICATES and len(jobs) > 1:
+        jobs, duplicates = group_duplicate_jobs(jobs)
+
+    def on_done(job):
+        image_file = os.path.basename(job.image_path)
+        if job.ok:
+            target = job.output_file if output_store is None else OUTPUT_STORE_DIR
+            if PRINT_DESCRIPTIONS:
+                print(f"图片 {image_file}: {job.result}")
+            print(f"已保存描述到: {target}" + ("（来自缓存）" if job.cached else ""))
+            ledger.mark_done(relative_path(job), job.elapsed)
+            for member in duplicates.get(job.output_file, []):
+                if output_store is not None:
+                    output_store.put(relative_path(member), job.result)
+                else:
+                    with open(member.output_file, 'w') as f:
+                        f.write(job.result)
+                    index.record_sidecar(member.output_file)
+                ledger.mark_done(relative_path(member))
+                print(f"已复制描述到近似重复图片: {member.image_path}")
+            if output_store is None:
+                index.record_sidecar(job.output_file)
+                index_store.mark_dirty()
+        else:
+            ledger.mark_failed(relative_path(job), job.error, job.elapsed)
+            print(f"处理图片 {image_file} 时出错（已尝试 {job.attempts} 次）: {job.error}")
+
+    return jobs, on_done
+
+
+def is_ignored_folder(name):
+    """租约目录等隐藏目录和分片存储目录不是图片文件夹"""
+    return name.startswith('.') or name == OUTPUT_STORE_DIR
+
+
+def process_all_folders(ledger=None, output_store=None):
+    """处理所有文件夹，按文件夹名称顺序从头开始处理
 
-            # 等待一下，避免过快请求
-            time.sleep(1)
-
-        except Exception as e:
-            print(f"处理图片 {image_file} 时出错: {e}")
-
-    print(f"{folder_name} 文件夹中的所有图片处理完成")
-    return True  # 表示处理成功完成
-
-
-def process_all_folders():
-    """处理所有文件夹，按文件夹名称顺序从头开始处理"""
+    参数:
+        ledger: JobLedger，为空时打开BASE_DIR下的任务台账
+        output_store: 分片存储，为空时按OUTPUT_MODE打开
+    """
     # 获取所有文件夹并排序
-    folders = [f for f in os.listdir(BASE_DIR) if os.path.isdir(os.path.join(BASE_DIR, f))]
+    with os.scandir(BASE_DIR) as it:
+        folders = [entry.name for entry in it if entry.is_dir() and not is_ignored_folder(entry.name)]
     folders.sort()  # 按文件夹名称排序
 
     if not folders:
@@ -500,20 +697,224 @@ def process_all_folders():
 
     print(f"开始处理所有文件夹，共 {len(folders)} 个文件夹")
 
+    index_store = open_index_store()
+    own_ledger = ledger is None
+    if own_ledger:
+        ledger = open_ledger()
+    own_output = output_store is None
+    if own_output:
+        output_store = open_description_store()
+    try:
+        if SCHEDULER == "fair":
+            _process_folders_fair(folders, index_store, ledger, output_store)
+            folders = []
+        for folder in folders:
+            # 检查文件夹是否已完成处理
+            folder_path = os.path.join(BASE_DIR, folder)
+            if is_folder_completed(folder_path, index_store.get(folder_path), output_store):
+                ledger.set_folder_completed(folder)
+                print(f"文件夹 {folder} 已完全处理，跳过")
+                continue
+
+            # 处理文件夹
+            print(f"开始处理文件夹: {folder}")
+            try:
+                process_folder(folder, index_store, ledger, output_store)
+            finally:
+                index_store.save()
+
+            print(f"已完成处理文件夹: {folder}")
+    finally:
+        index_store.save()
+        if own_ledger:
+            ledger.close()
+        if own_output and output_store is not None:
+            output_store.close()
+
+    print("所有文件夹处理完成")
+
+
+def _process_folders_fair(folders, index_store, ledger, output_store):
+    """所有文件夹共享一个描述引擎，由FairScheduler按优先级、前N张和权重交替取出图片"""
+    scheduler = FairScheduler(first_n=FIRST_N_PER_FOLDER)
+    handlers = {}  # 文件夹名称 -> 任务完成时的回调
     for folder in folders:
-        # 检查文件夹是否已完成处理
         folder_path = os.path.join(BASE_DIR, folder)
-        if is_folder_completed(folder_path):
+        if is_folder_completed(folder_path, index_store.get(folder_path), output_store):
+            ledger.set_folder_completed(folder)
             print(f"文件夹 {folder} 已完全处理，跳过")
             continue
+        with trace_span("prepare_folder", folder=folder):
+            prepared = _prepare_folder(folder, folder_path, index_store, ledger, output_store)
+        if prepared is None:
+            continue
+        jobs, handlers[folder] = prepared
+        scheduler.add_folder(folder, jobs, weight=FOLDER_WEIGHTS.get(folder, 1),
+                             priority=FOLDER_PRIORITIES.get(folder, 0),
+                             max_in_flight=FOLDER_MAX_CONCURRENCY.get(folder, DEFAULT_FOLDER_MAX_CONCURRENCY))
+        if not jobs:
+            _finish_folder(folder, folder_path, index_store, ledger, output_store)
+    scheduler.close()
+    index_store.save()
+
+    total = sum(remaining for _, _, remaining in scheduler.stats().values())
+    print(f"公平调度: {len(handlers)} 个文件夹共 {total} 张待处理图片，并发数上限 {MAX_CONCURRENCY}")
+
+    def on_start(job):
+        ledger.mark_started(relative_path(job))
+
+    def on_done(job):
+        handlers[scheduler.folder_of(job)](job)
+
+    def on_finish(job):
+        folder = scheduler.folder_of(job)
+        if scheduler.done(job):
+            if output_store is not None:
+                output_store.flush()
+            _finish_folder(folder, os.path.join(BASE_DIR, folder), index_store, ledger, output_store)
+
+    cache = create_cache()
+    lease = open_lease_manager()
+    try:
+        # 只比并发数多取出少量任务，由调度器在最后时刻决定下一张图片
+        engine = create_engine(cache, lease, output_store, max_pending=MAX_CONCURRENCY * 2)
+        engine.run_stream_sync(scheduler, on_done=on_done, on_start=on_start, on_finish=on_finish)
+        if engine.callback_errors:
+            print(f"任务结束时回调出错 {engine.callback_errors} 次，最近一次: {engine.last_callback_error}")
+    finally:
+        scheduler.stop()
+        if lease is not None:
+            lease.stop()
+            print(f"租约: 认领 {lease.claimed} 张，接手过期租约 {lease.reclaimed} 张，被其它工作进程接手 {lease.lost} 张")
+        if cache is not None:
+            cache.close()
+        if output_store is not None:
+            output_store.flush()
+
+
+def needs_description(image_path, output_store=None):
+    """图片没有描述，或在描述生成之后被修改过"""
+    try:
+        image_mtime = os.stat(image_path).st_mtime
+    except FileNotFoundError:
+        return False
+    if output_store is not None:
+        described = output_store.modified(os.path.relpath(image_path, BASE_DIR))
+    else:
+        txt_path = os.path.splitext(image_path)[0] + '.txt'
+        try:
+            st = os.stat(txt_path)
+            described = st.st_mtime if st.st_size > 0 else None
+        except FileNotFoundError:
+            described = None
+    return described is None or described < image_mtime
+
+
+def watch_folders():
+    """监视模式：先处理所有文件夹中已有的未完成图片，之后只描述新建或被修改的图片，直到按Ctrl+C"""
+    ledger = open_ledger()
+    output_store = open_description_store()
+    # 先开始监视再处理已有图片，处理期间新增的图片不会遗漏
+    watcher = ImageWatcher(BASE_DIR, settle_seconds=WATCH_SETTLE_SECONDS, poll_interval=WATCH_POLL_INTERVAL,
+                           use_inotify=WATCH_USE_INOTIFY, ignore=is_ignored_folder,
+                           extensions=image_extensions()).start()
+    print(f"监视模式: 使用{watcher.backend.name}监视 {BASE_DIR} 中的图片文件夹")
+    cache = create_cache()
+    lease = open_lease_manager()
+    try:
+        process_all_folders(ledger, output_store)
+
+        def jobs():
+            for image_path in watcher:
+                rel = os.path.relpath(image_path, BASE_DIR)
+                if WORKER_MODE == "shard" and not in_shard(rel, SHARD_INDEX, SHARD_COUNT):
+                    continue
+                if _converter is not None and _converter.is_output(image_path):
+                    continue  # 融合转换写出的PNG已经随原图描述过
+                if not needs_description(image_path, output_store):
+                    continue
+                folder_name = os.path.dirname(rel)
+                ledger.enqueue(rel, folder_name)
+                print(f"发现新图片: {rel}")
+                yield DescribeJob(image_path, os.path.splitext(image_path)[0] + '.txt',
+                                  PROMPT_TEMPLATE.format(folder_name=folder_name))
+
+        def on_start(job):
+            ledger.mark_started(relative_path(job))
+
+        def on_done(job):
+            if job.ok:
+                if PRINT_DESCRIPTIONS:
+                    print(f"图片 {relative_path(job)}: {job.result}")
+                print(f"已保存描述到: {job.output_file if output_store is None else OUTPUT_STORE_DIR}"
+                      + ("（来自缓存）" if job.cached else ""))
+                ledger.mark_done(relative_path(job), job.elapsed)
+                if output_store is not None:
+                    output_store.flush()  # 新图片较少，描述尽快落盘
+            else:
+                ledger.mark_failed(relative_path(job), job.error, job.elapsed)
+                print(f"处理图片 {relative_path(job)} 时出错（已尝试 {job.attempts} 次）: {job.error}")
+
+        engine = create_engine(cache, lease, output_store)
+        print("已有图片处理完成，等待新图片...")
+        engine.run_stream_sync(jobs(), on_done=on_done, on_start=on_start)
+    except KeyboardInterrupt:
+        print("监视已停止")
+    finally:
+        watcher.close()
+        if lease is not None:
+            lease.stop()
+        if cache is not None:
+            cache.close()
+        if output_store is not None:
+            output_store.close()
+        ledger.close()
+
+
+def replay_dead_letters():
+    """重新处理死信文件中的图片，处理后死信文件中只保留仍然失败的图片"""
+    dead_letter = open_dead_letter_log()
+    records = dead_letter.load()
+    if not records:
+        print("死信文件中没有需要重放的图片")
+        return
 
-        # 处理文件夹
-        print(f"开始处理文件夹: {folder}")
-        process_folder(folder)
-
-        print(f"已完成处理文件夹: {folder}")
-
-    print("所有文件夹处理完成")
+    jobs = [DescribeJob(r["image_path"], r["output_file"], r["prompt"])
+            for r in records if os.path.exists(r["image_path"])]
+    print(f"重放死信: {len(jobs)} 张图片（{len(records) - len(jobs)} 张图片已不存在）")
+
+    ledger = open_ledger()
+    output_store = open_description_store()
+    failed = []
+
+    def on_start(job):
+        ledger.mark_started(relative_path(job))
+
+    def on_done(job):
+        if job.ok:
+            ledger.mark_done(relative_path(job), job.elapsed)
+            print(f"已保存描述到: {job.output_file if output_store is None else OUTPUT_STORE_DIR}")
+        else:
+            ledger.mark_failed(relative_path(job), job.error, job.elapsed)
+            failed.append(DeadLetterLog.make_record(job))
+            print(f"图片 {job.image_path} 仍然失败（已尝试 {job.attempts} 次）: {job.error}")
+
+    cache = create_cache()
+    try:
+        engine = create_engine(cache, output_store=output_store, dead_letter=False)
+        engine.run_sync(jobs, on_done=on_done, on_start=on_start)
+    finally:
+        if cache is not None:
+            cache.close()
+        if output_store is not None:
+            output_store.close()
+        ledger.close()
+        # 未能处理完的记录（如程序被中断）继续保留
+        finished = {job.image_path for job in jobs if job.ok} | {r["image_path"] for r in failed}
+        remaining = [r for r in records if r["image_path"] not in finished and os.path.exists(r["image_path"])]
+        dead_letter.rewrite(failed + remaining)
+
+    print(f"重放完成: 成功 {len(jobs) - len(failed)} 张，仍失败 {len(failed)} 张")
 
 
 if __name__ == '__main__':
@@ -522,15 +923,28 @@ if __name__ == '__main__':
         print(f"错误: 基础目录 '{BASE_DIR}' 不存在，请检查 BASE_DIR 变量设置")
         exit(1)
 
-    # 根据PROCESS_ALL_FOLDERS变量决定处理模式
-    if PROCESS_ALL_FOLDERS:
-        # 处理所有文件夹模式，不受CURRENT_FOLDER影响
-        process_all_folders()
-    else:
-        # 单文件夹模式，只处理CURRENT_FOLDER指定的文件夹
-        print(f"单文件夹模式，处理: {CURRENT_FOLDER}")
-        success = process_folder(CURRENT_FOLDER)
-        if not success:
-            print("处理中止：请检查并修改设置后重试")
-            exit(1)
+    metrics_server = start_metrics_server()
+    start_tracing()
+    start_converter()
+    try:
+        # 根据PROCESS_ALL_FOLDERS变量决定处理模式
+        if REPLAY_DEAD_LETTERS:
+            replay_dead_letters()
+        elif WATCH_MODE:
+            watch_folders()
+        elif PROCESS_ALL_FOLDERS:
+            # 处理所有文件夹模式，不受CURRENT_FOLDER影响
+            process_all_folders()
+        else:
+            # 单文件夹模式，只处理CURRENT_FOLDER指定的文件夹
+            print(f"单文件夹模式，处理: {CURRENT_FOLDER}")
+            success = process_folder(CURRENT_FOLDER)
+            if not success:
+                print("处理中止：请检查并修改设置后重试")
+                exit(1)
+    finally:
+        close_converter()
+        save_trace()
+        if metrics_server is not None:
+            metrics_server.stop()
 
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+对冲请求策略 / Hedged Request Policy
+========================================================
+
+【功能说明 / Function Description】
+少数描述请求的流式返回比中位数慢得多。请求进行的时间超过最近成功请求耗时的某个分位数（如P95）时，
+再发送一个相同的请求，采用先成功的一个，较慢的一个立即取消。
+对冲请求会重复消耗上传图片的token，因此按比例限制：对冲的请求数不超过全部请求的max_ratio。
+
+A few describe requests stream far slower than the median. When a request has
+been running longer than a percentile (such as P95) of recent successful
+latencies, a duplicate is sent, the first success is kept and the slower one
+is cancelled. A hedge spends the image upload tokens a second time, so hedges
+are capped at max_ratio of all requests.
+
+【使用方法 / Usage】
+    engine = DescribeEngine(client, controller, hedge=HedgePolicy(percentile=0.95))
+"""
+
+import collections
+import statistics
+import threading
+
+
+class HedgePolicy(object):
+    """对冲请求的延迟阈值和比例上限，可以在多个线程中同时使用
+
+    参数:
+        percentile: 延迟阈值取最近成功请求耗时的哪个分位数（0到1之间）
+        min_samples: 至少记录多少个成功请求的耗时后才开始对冲
+        window: 计算分位数使用的最近请求数
+        max_ratio: 对冲请求数占全部请求数的比例上限
+        min_delay: 延迟阈值的下限（秒）
+    """
+
+    def __init__(self, percentile=0.95, min_samples=20, window=500, max_ratio=0.05, min_delay=1.0):
+        if not 0 < percentile < 1:
+            raise ValueError("percentile 必须在0和1之间")
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.min_delay = min_delay
+        self.requests = 0  # 发送的首个请求数
+        self.hedged = 0  # 发送的对冲请求数
+        self.won = 0  # 对冲请求先成功的次数
+        self._latencies = collections.deque(maxlen=window)
+        self._threshold = None
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        """记录一个成功请求的耗时"""
+        with self._lock:
+            self._latencies.append(seconds)
+            self._threshold = None
+
+    def delay(self):
+        """返回首个请求发出后多久发送对冲请求，样本不足时返回None"""
+        with self._lock:
+            self.requests += 1
+            if len(self._latencies) < self.min_samples:
+                return None
+            if self._threshold is None:
+                cuts = statistics.quantiles(self._latencies, n=1000, method='inclusive')
+                self._threshold = cuts[min(int(self.percentile * 1000), 999) - 1]
+            return max(self._threshold, self.min_delay)
+
+    def try_hedge(self):
+        """占用一个对冲名额，超过比例上限时返回False"""
+        with self._lock:
+            if self.hedged + 1 > self.requests * self.max_ratio:
+                return False
+            self.hedged += 1
+            return True
+
+    def record_win(self):
+        with self._lock:
+            self.won += 1
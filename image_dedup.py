@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+近似重复图片分组 / Near-Duplicate Image Grouping
+========================================================
+
+【功能说明 / Function Description】
+在调用接口之前，为待处理的图片计算感知哈希（DCT pHash），
+把汉明距离不超过阈值的图片归为一组，每组只描述一张代表图片，
+其它成员直接复制代表图片的描述。适用于缩放副本、JPEG/PNG重复编码、轻微裁剪等情况。
+
+Before calling the API, computes perceptual hashes (DCT pHash) for the pending
+images and groups images whose Hamming distance is within a threshold. Only one
+representative per group is described; the other members copy its
+description. Covers resized copies, JPEG/PNG re-encodes and slight crops.
+
+【实现 / Implementation】
+- 图片解码使用线程池，JPEG使用draft()在DCT域直接缩小 / Decoding runs in a thread
+  pool; JPEG uses draft() to downscale in the DCT domain
+- 哈希计算对所有图片一次性做矩阵运算（NumPy） / Hashes of all images are computed at
+  once with matrix operations (NumPy)
+- 分组使用分段索引：阈值为t时把64位哈希分为t+1段，距离不超过t的两张图片至少有一段完全相同，
+  只需比较同一段取值相同的候选 / Grouping uses multi-index hashing: with threshold t the
+  64-bit hash is split into t+1 bands, two hashes within distance t share at least
+  one identical band, so only candidates sharing a band value are compared
+
+【依赖 / Dependencies】
+- Pillow
+- numpy
+"""
+
+import concurrent.futures
+import os
+
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8  # 哈希为 HASH_SIZE x HASH_SIZE = 64 位
+SAMPLE_SIZE = 32  # 计算DCT前把图片缩小到的边长
+
+
+def _dct_matrix(n):
+    """返回n阶正交DCT-II变换矩阵"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0, :] = np.sqrt(1.0 / n)
+    return m
+
+
+def load_grayscale(path, size=SAMPLE_SIZE):
+    """读取图片并缩小为size x size的灰度数组，失败时返回None"""
+    try:
+        with Image.open(path) as img:
+            # JPEG在解码时直接缩小，避免按原始分辨率解码
+            img.draft('L', (size * 4, size * 4))
+            img = img.convert('L').resize((size, size), Image.BILINEAR)
+            return np.asarray(img, dtype=np.float32)
+    except Exception:
+        return None
+
+
+def phash_array(pixels):
+    """批量计算感知哈希
+
+    参数:
+        pixels: 形状为(N, SAMPLE_SIZE, SAMPLE_SIZE)的灰度数组
+
+    返回:
+        numpy.ndarray: 形状为(N,)的uint64哈希
+    """
+    n = pixels.shape[-1]
+    d = _dct_matrix(n).astype(np.float32)
+    # 对每张图片做二维DCT: D @ X @ D^T，批量矩阵乘法一次完成
+    coeffs = d @ pixels @ d.T
+    low = coeffs[:, :HASH_SIZE, :HASH_SIZE].reshape(len(pixels), -1)
+    # 与中值比较（排除直流分量），得到64个比特
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    bits = (low > median).astype(np.uint8)
+    packed = np.packbits(bits, axis=1)  # (N, 8) 字节，高位在前
+    return packed.view('>u8').reshape(-1).astype(np.uint64)
+
+
+def compute_hashes(paths, max_workers=None):
+    """计算一组图片的感知哈希
+
+    参数:
+        paths: 图片路径列表
+        max_workers: 解码线程数
+
+    返回:
+        tuple: (哈希数组, 有效索引列表)，无法解码的图片不会出现在有效索引中
+    """
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) * 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        arrays = list(executor.map(load_grayscale, paths))
+    valid = [i for i, a in enumerate(arrays) if a is not None]
+    if not valid:
+        return np.zeros(0, dtype=np.uint64), valid
+    stacked = np.stack([arrays[i] for i in valid])
+    return phash_array(stacked), valid
+
+
+def hamming_distance(a, b):
+    """逐元素计算两个uint64数组之间的汉明距离"""
+    x = np.bitwise_xor(a, b)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).astype(np.int32)
+    return np.unpackbits(x.view(np.uint8).reshape(x.shape + (8,)), axis=-1).sum(axis=-1)
+
+
+class _UnionFind(object):
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, x):
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            # 保留较小的下标作为根，使代表图片为排序最靠前的图片
+            if ra < rb:
+                self.parent[rb] = ra
+            else:
+                self.parent[ra] = rb
+
+
+def group_hashes(hashes, threshold=4):
+    """把汉明距离不超过threshold的哈希分为一组
+
+    参数:
+        hashes: uint64哈希数组
+        threshold: 汉明距离阈值
+
+    返回:
+        list: 每组为下标列表，按下标排序，组内第一个为代表
+    """
+    n = len(hashes)
+    uf = _UnionFind(n)
+    bands = threshold + 1
+    width = 64 // bands
+    mask = np.uint64((1 << width) - 1)
+    for band in range(bands):
+        keys = (hashes >> np.uint64(band * width)) & mask
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        # 找出取值相同的连续区间
+        boundaries = np.flatnonzero(np.diff(sorted_keys)) + 1
+        for bucket in np.split(order, boundaries):
+            if len(bucket) < 2:
+                continue
+            bucket_hashes = hashes[bucket]
+            dist = hamming_distance(bucket_hashes[:, None], bucket_hashes[None, :])
+            rows, cols = np.nonzero(np.triu(dist <= threshold, k=1))
+            for r, c in zip(rows, cols):
+                uf.union(int(bucket[r]), int(bucket[c]))
+
+    groups = {}
+    for i in range(n):
+        groups.setdefault(uf.find(i), []).append(i)
+    return sorted(groups.values(), key=lambda g: g[0])
+
+
+def group_near_duplicates(paths, threshold=4, max_workers=None):
+    """对图片路径进行近似重复分组
+
+    参数:
+        paths: 图片路径列表（按处理顺序排列）
+        threshold: 汉明距离阈值
+        max_workers: 解码线程数
+
+    返回:
+        list: 每组为路径列表，第一个为代表图片；无法解码的图片单独成组
+    """
+    hashes, valid = compute_hashes(paths, max_workers=max_workers)
+    groups = [[paths[valid[i]] for i in g] for g in group_hashes(hashes, threshold)]
+    valid_set = set(valid)
+    groups.extend([paths[i]] for i in range(len(paths)) if i not in valid_set)
+    return groups
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+图片描述库接口 / Image Description Library API
+========================================================
+
+【功能说明 / Function Description】
+供其它程序直接导入使用的描述接口，不依赖generate_picture_describe.py的全局变量，
+导入时没有任何副作用（不读写文件、不连接网络）。结果以生成器的形式按完成顺序返回，
+调用方可以自己决定并发、批量和保存方式，不需要再按文件夹调用脚本。
+
+A description API meant to be imported by other programs. It does not depend
+on the module globals of generate_picture_describe.py and importing it has no
+side effects (no file access, no network). Results are yielded as they finish,
+so callers choose their own concurrency, batching and storage instead of
+running the script once per folder.
+
+【鉴权信息 / Credentials】
+构造参数为空时依次读取环境变量 SPARK_APPID、SPARK_API_KEY、SPARK_API_SECRET，
+服务地址可以通过 SPARK_IMAGE_URL 设置。
+When the constructor arguments are empty the credentials are read from the
+SPARK_APPID, SPARK_API_KEY and SPARK_API_SECRET environment variables; the
+service URL can be set with SPARK_IMAGE_URL.
+
+【使用方法 / Usage】
+    from image_describer import ImageDescriber
+
+    describer = ImageDescriber(concurrency=4)
+    for job in describer.describe_images(paths, prompt="Describe this room in English."):
+        if job.ok:
+            save(job.image_path, job.result)
+        else:
+            log(job.image_path, job.error)
+
+    # 或者使用模块级函数 / or the module-level function
+    for job in describe_images(paths, prompt=lambda path: f"The topic is {folder_of(path)}."):
+        ...
+"""
+
+import asyncio
+import os
+import queue
+import threading
+
+from describe_engine import DescribeEngine, DescribeJob
+from rate_control import AdaptiveRateController
+from retry_policy import RetryPolicy
+from spark_client import SparkImageClient
+
+DEFAULT_URL = "wss://spark-api.cn-huabei-1.xf-yun.com/v2.1/image"
+DEFAULT_PROMPT = ("Describe this image accurately in natural English prose, without bullet points, "
+                  "in about 100-150 words.")
+
+# 环境变量名称
+ENV_APPID = "SPARK_APPID"
+ENV_API_KEY = "SPARK_API_KEY"
+ENV_API_SECRET = "SPARK_API_SECRET"
+ENV_URL = "SPARK_IMAGE_URL"
+
+_DONE = object()
+
+
+class ImageDescriber(object):
+    """可重复使用的图片描述器，可以在多个线程中同时调用
+
+    参数:
+        appid, api_key, api_secret: 鉴权信息，为空时读取对应的环境变量
+        url: 服务地址，为空时读取SPARK_IMAGE_URL，再为空时使用DEFAULT_URL
+        concurrency: 同时进行中的请求数上限，遇到限流时自动降低
+        chat_parameters: 模型参数，为空时使用spark_client.DEFAULT_CHAT_PARAMETERS
+        connect_timeout, first_token_timeout, total_timeout: 超时时间（秒），参见SparkImageClient
+        retry_policy: RetryPolicy实例，为空时使用默认参数
+        cache: DescriptionCache实例，为空时不使用缓存
+        compressor: PayloadCompressor实例，为空时上传原始图片
+        metrics: DescribeMetrics实例，为空时不记录请求指标
+        prefetch_bytes: 预读取的图片数据总量上限（字节），为0时不预读取
+        hedge: HedgePolicy实例，为空时不发送对冲请求；每次describe_images()共用其延迟统计
+        answer_budget: AnswerBudget实例，为空时不按提示词的字数要求限制max_tokens和截断描述
+    """
+
+    def __init__(self, appid=None, api_key=None, api_secret=None, url=None, concurrency=8,
+                 chat_parameters=None, connect_timeout=10, first_token_timeout=30, total_timeout=120,
+                 retry_policy=None, cache=None, compressor=None, metrics=None, prefetch_bytes=64 * 1024 * 1024,
+                 hedge=None, answer_budget=None):
+        appid = appid or os.environ.get(ENV_APPID)
+        api_key = api_key or os.environ.get(ENV_API_KEY)
+        api_secret = api_secret or os.environ.get(ENV_API_SECRET)
+        missing = [name for name, value in ((ENV_APPID, appid), (ENV_API_KEY, api_key), (ENV_API_SECRET, api_secret))
+                   if not value]
+        if missing:
+            raise ValueError(f"缺少鉴权信息，请通过参数或环境变量设置: {', '.join(missing)}")
+        self.client = SparkImageClient(appid, api_key, api_secret, url or os.environ.get(ENV_URL) or DEFAULT_URL,
+                                       chat_parameters=chat_parameters, connect_timeout=connect_timeout,
+                                       first_token_timeout=first_token_timeout, total_timeout=total_timeout)
+        self.concurrency = concurrency
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.cache = cache
+        self.compressor = compressor
+        self.metrics = metrics
+        self.prefetch_bytes = prefetch_bytes
+        self.hedge = hedge
+        self.answer_budget = answer_budget
+
+    def _engine(self):
+        # 每次调用使用新的引擎和并发控制器，多个调用之间互不影响
+        controller = AdaptiveRateController(initial=min(2, self.concurrency), maximum=self.concurrency)
+        # 限制从paths中提前取出的数量，惰性的输入不会被一次全部展开
+        return DescribeEngine(self.client, controller, self.retry_policy, cache=self.cache,
+                              compressor=self.compressor, metrics=self.metrics, prefetch_bytes=self.prefetch_bytes,
+                              max_pending=self.concurrency * 4, hedge=self.hedge, answer_budget=self.answer_budget)
+
+    def describe(self, image, prompt=DEFAULT_PROMPT):
+        """描述一张图片并返回描述文本（不经过并发调度和重试）
+
+        参数:
+            image: 图片文件路径或图片字节
+            prompt: 提示词
+        """
+        if self.compressor is not None:
+            if not isinstance(image, (bytes, bytearray)):
+                with open(image, 'rb') as f:
+                    image = f.read()
+            image = self.compressor.prepare(image)
+        limits = self.answer_budget.limits(prompt) if self.answer_budget is not None else {}
+        return self.client.describe_image(image, prompt, **limits)
+
+    def describe_images(self, paths, prompt=DEFAULT_PROMPT, output_dir=None):
+        """并发描述多张图片，按完成顺序逐个返回DescribeJob
+
+        paths可以是惰性的可迭代对象（如os.walk的结果），在后台线程中按需读取，不会一次全部展开。
+        提前停止迭代（break或关闭生成器）时，不再发送新的请求，已经在进行中的请求结束后返回。
+
+        参数:
+            paths: 图片文件路径的可迭代对象
+            prompt: 提示词，或根据图片路径返回提示词的函数
+            output_dir: 为空时不写任何文件；否则把描述保存为该目录下与图片同名的.txt文件
+
+        返回:
+            生成器，每项为DescribeJob，成功时job.ok为True、job.result为描述，失败时job.error为异常
+        """
+        results = queue.Queue()
+        stop = threading.Event()
+        state = {}
+
+        def jobs():
+            for path in paths:
+                if stop.is_set():
+                    return
+                text = prompt(path) if callable(prompt) else prompt
+                output_file = None
+                if output_dir is not None:
+                    name = os.path.splitext(os.path.basename(path))[0] + '.txt'
+                    output_file = os.path.join(output_dir, name)
+                yield DescribeJob(path, output_file, text)
+
+        async def main():
+            state["loop"] = asyncio.get_running_loop()
+            state["task"] = asyncio.current_task()
+            if stop.is_set():
+                return
+            await self._engine().run_stream(jobs(), on_done=results.put)
+
+        def run():
+            try:
+                asyncio.run(main())
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                state["error"] = e
+            finally:
+                results.put(_DONE)
+
+        thread = threading.Thread(target=run, name="image-describer", daemon=True)
+        thread.start()
+        try:
+            while True:
+                job = results.get()
+                if job is _DONE:
+                    break
+                yield job
+            if "error" in state:
+                raise state["error"]
+        finally:
+            stop.set()
+            loop = state.get("loop")
+            if thread.is_alive() and loop is not None:
+                try:
+                    loop.call_soon_threadsafe(state["task"].cancel)
+                except RuntimeError:
+                    pass  # 事件循环已经结束
+            thread.join()
+
+
+def describe_images(paths, prompt=DEFAULT_PROMPT, output_dir=None, **options):
+    """使用环境变量中的鉴权信息描述多张图片，参数与ImageDescriber.describe_images相同
+
+    options传给ImageDescriber的构造函数（如concurrency、api_key）。
+    """
+    return ImageDescriber(**options).describe_images(paths, prompt=prompt, output_dir=output_dir)
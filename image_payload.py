@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+图片上传数据压缩 / Image Payload Compression
+========================================================
+
+【功能说明 / Function Description】
+在base64编码上传之前，在内存中缩小并重新编码图片，
+搜索合适的尺寸和JPEG/WebP质量，直到图片不超过设定的字节预算和最长边限制。
+已经满足限制的图片保持原样，不会重新编码。
+结果按源图片哈希缓存，同一张图片重试或重复出现时不再重新搜索。
+
+Before base64 encoding for upload, images are downsized and re-encoded in
+memory. Dimensions and JPEG/WebP quality are searched until the image fits the
+configured byte budget and maximum edge length. Images that already fit are
+passed through without re-encoding. Results are memoized by source hash, so
+retries or repeated images skip the search.
+
+【说明 / Notes】
+- 字节预算针对编码后的图片字节，base64之后约为其4/3 / The byte budget applies to the
+  encoded image bytes; base64 makes them about 4/3 larger
+- 带透明通道的图片编码为JPEG时会合成到白色背景上 / Images with transparency are composited
+  onto white when encoded as JPEG
+- 需要安装Pillow / Pillow is required
+"""
+
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+DEFAULT_MAX_BYTES = 1024 * 1024  # 默认字节预算: 1MB
+DEFAULT_MAX_EDGE = 1600  # 默认最长边（像素）
+
+
+def _flatten_alpha(img):
+    """把带透明通道的图片合成到白色背景上，返回RGB图片"""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+
+def _encode(img, fmt, quality):
+    buf = io.BytesIO()
+    img.save(buf, fmt, quality=quality)
+    return buf.getvalue()
+
+
+class PayloadCompressor(object):
+    """图片上传数据压缩器，可以被多个线程同时使用
+
+    参数:
+        max_bytes: 字节预算
+        max_edge: 最长边上限（像素）
+        formats: 依次尝试的编码格式，如('JPEG',)或('WEBP', 'JPEG')
+        min_quality: 最低质量，低于该质量仍超出预算时继续缩小尺寸
+        max_quality: 最高质量
+        scale_step: 每次缩小尺寸的比例
+        memo_bytes: 结果缓存占用的最大字节数
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_edge=DEFAULT_MAX_EDGE, formats=('JPEG',),
+                 min_quality=40, max_quality=90, scale_step=0.75, memo_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_edge = max_edge
+        self.formats = tuple(formats)
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.scale_step = scale_step
+        self.memo_bytes = memo_bytes
+        self._memo = OrderedDict()  # 源图片摘要 -> 压缩后的字节
+        self._memo_size = 0
+        self._lock = threading.Lock()
+
+    def signature(self):
+        """返回压缩设置的字符串表示，压缩设置会影响描述结果，因此参与缓存键的计算"""
+        return f"payload:{self.max_bytes}:{self.max_edge}:{','.join(self.formats)}:{self.min_quality}-{self.max_quality}"
+
+    def prepare_image(self, img, digest):
+        """压缩已经解码的图片（融合转换模式使用），不再重新解码；总是重新编码
+
+        参数:
+            img: 已解码的PIL图片
+            digest: 源图片的摘要，作为结果缓存的键
+
+        返回:
+            bytes: 压缩后的图片字节
+        """
+        return self._memoized(digest, lambda: self._fit(img))
+
+    def prepare(self, image_data, digest=None):
+        """返回满足预算的图片字节
+
+        参数:
+            image_data: 源图片字节
+            digest: 源图片的sha256摘要，为空时自动计算
+
+        返回:
+            bytes: 压缩后的图片字节；无法解码或已满足限制时返回原始字节
+        """
+        if digest is None:
+            digest = hashlib.sha256(image_data).hexdigest()
+        return self._memoized(digest, lambda: self._compress(image_data))
+
+    def _memoized(self, digest, compress):
+        with self._lock:
+            cached = self._memo.get(digest)
+            if cached is not None:
+                self._memo.move_to_end(digest)
+                return cached
+
+        result = compress()
+
+        with self._lock:
+            if len(result) <= self.memo_bytes and digest not in self._memo:
+                self._memo[digest] = result
+                self._memo_size += len(result)
+                while self._memo_size > self.memo_bytes:
+                    _, evicted = self._memo.popitem(last=False)
+                    self._memo_size -= len(evicted)
+        return result
+
+    def _compress(self, image_data):
+        try:
+            img = Image.open(io.BytesIO(image_data))
+            width, height = img.size
+        except Exception:
+            return image_data  # 无法识别的图片原样上传，由接口返回错误
+        if len(image_data) <= self.max_bytes and max(width, height) <= self.max_edge:
+            return image_data
+
+        # JPEG在解码时直接缩小到接近目标尺寸
+        img.draft('RGB', (self.max_edge, self.max_edge))
+        return self._fit(ImageOps.exif_transpose(img))
+
+    def _fit(self, img):
+        """搜索不超过字节预算的尺寸和质量"""
+        img = _flatten_alpha(img)
+        scale = min(1.0, self.max_edge / max(img.size))
+        best = None
+        while True:
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            candidate = img if size == img.size else img.resize(size, Image.LANCZOS)
+            for fmt in self.formats:
+                data = self._search_quality(candidate, fmt)
+                if best is None or len(data) < len(best):
+                    best = data
+                if len(data) <= self.max_bytes:
+                    return data
+            if min(size) <= 16:
+                return best  # 已经非常小，无法继续缩小
+            scale *= self.scale_step
+
+    def _search_quality(self, img, fmt):
+        """二分搜索不超过预算的最高质量，全部超出时返回最低质量的结果"""
+        low, high = self.min_quality, self.max_quality
+        best = None
+        smallest = None
+        while low <= high:
+            quality = (low + high) // 2
+            data = _encode(img, fmt, quality)
+            if len(data) <= self.max_bytes:
+                best = data
+                low = quality + 1
+            else:
+                smallest = data
+                high = quality - 1
+        return best if best is not None else smallest
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+新图片监视 / New Image Watcher
+========================================================
+
+【功能说明 / Function Description】
+监视BASE_DIR下每个图片文件夹，逐个返回新建或被修改的图片，供常驻的描述进程增量处理，
+不需要反复扫描所有文件夹和描述文件。Linux上使用inotify（通过ctypes调用，不需要额外依赖），
+其它系统或inotify不可用时退回到定时轮询。
+
+Watches every image folder under BASE_DIR and yields images that were created
+or modified, so a long-running describer can process them incrementally
+without rescanning every folder and sidecar. inotify is used on Linux (through
+ctypes, no extra dependency); on other systems, or when inotify is unavailable,
+it falls back to periodic polling.
+
+【实现 / Implementation】
+- 防抖：文件最后一次变化后等待settle_seconds，且大小和修改时间不再变化，才认为写入完成，
+  避免描述还在复制中的图片；使用inotify时还要等到写入者关闭文件（IN_CLOSE_WRITE）
+  / Debounce: a file is reported only after it has not changed for
+  settle_seconds and its size and mtime are stable, so images that are still
+  being copied are not described; with inotify the writer must also have
+  closed the file (IN_CLOSE_WRITE)
+- 新建（或移入）的文件夹自动加入监视，并检查其中已有的图片 / Folders that are created
+  (or moved in) are watched automatically and their existing images are checked
+- inotify事件队列溢出时重新检查所有文件夹中的图片 / When the inotify event queue
+  overflows, every image in every folder is checked again
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from folder_index import IMAGE_EXTENSIONS
+
+# inotify常量，见 <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+# 阻塞等待的最长时间，保证stop()之后迭代能及时结束
+_MAX_WAIT = 0.5
+# 没有收到关闭事件（如写入者崩溃）的文件，保持不变这么多倍的settle_seconds后也认为写入完成
+_OPEN_SETTLE_FACTOR = 10
+
+
+def _load_libc():
+    """返回支持inotify的libc，不支持时返回None"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class _InotifyBackend(object):
+    """inotify事件来源"""
+
+    name = "inotify"
+
+    def __init__(self, libc):
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._dirs = {}  # 监视描述符 -> 目录
+
+    def add(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self._dirs[wd] = directory
+
+    def read(self, timeout):
+        """等待最多timeout秒，返回 ([(变化的路径, 是否仍在写入), ...], 新目录列表, 是否溢出)
+
+        是否仍在写入为None表示无法判断（只是属性变化）。
+        """
+        changed, new_dirs, overflow = [], [], False
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changed, new_dirs, overflow
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed, new_dirs, overflow
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                self._dirs.pop(wd, None)
+                continue
+            if not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    new_dirs.append(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changed.append((path, False))
+            elif mask & (IN_CREATE | IN_MODIFY):
+                changed.append((path, True))
+            else:
+                changed.append((path, None))
+        return changed, new_dirs, overflow
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _PollingBackend(object):
+    """定时扫描所有文件夹，比较文件大小和修改时间"""
+
+    name = "polling"
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._dirs = []
+        self._snapshot = {}  # 路径 -> (大小, 修改时间)
+        self._next = time.monotonic() + interval
+
+    def _scan(self, directory):
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            st = entry.stat()
+                            yield entry.path, (st.st_size, st.st_mtime_ns), False
+                        elif entry.is_dir():
+                            yield entry.path, None, True
+                    except FileNotFoundError:
+                        continue
+        except FileNotFoundError:
+            return
+
+    def add(self, directory):
+        self._dirs.append(directory)
+        # 记录已有文件的状态，之后只报告变化
+        for path, state, is_dir in self._scan(directory):
+            if not is_dir:
+                self._snapshot[path] = state
+
+    def read(self, timeout):
+        changed, new_dirs = [], []
+        wait = self._next - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return changed, new_dirs, False
+        if wait > 0:
+            time.sleep(wait)
+        self._next = time.monotonic() + self.interval
+        known_dirs = set(self._dirs)
+        seen = set()
+        for directory in list(self._dirs):
+            for path, state, is_dir in self._scan(directory):
+                if is_dir:
+                    if directory == self._dirs[0] and path not in known_dirs:
+                        new_dirs.append(path)
+                    continue
+                seen.add(path)
+                if self._snapshot.get(path) != state:
+                    self._snapshot[path] = state
+                    changed.append((path, False))
+        for path in [p for p in self._snapshot if p not in seen]:
+            del self._snapshot[path]
+        return changed, new_dirs, False
+
+    def close(self):
+        pass
+
+
+class ImageWatcher(object):
+    """监视BASE_DIR下各文件夹中新建或修改的图片
+
+    迭代ImageWatcher得到写入完成的图片路径，直到调用stop()。
+
+    参数:
+        base_dir: 基础目录，其中的每个子文件夹是一个图片文件夹
+        settle_seconds: 文件最后一次变化后需要保持不变的时间（秒）
+        poll_interval: 轮询模式下的扫描间隔（秒）
+        use_inotify: 为False时总是使用轮询
+        ignore: 根据文件夹名称判断是否忽略该文件夹的函数，为空时忽略以.开头的文件夹
+        extensions: 需要报告的图片扩展名
+    """
+
+    def __init__(self, base_dir, settle_seconds=2.0, poll_interval=5.0, use_inotify=True, ignore=None,
+                 extensions=IMAGE_EXTENSIONS):
+        self.base_dir = os.path.normpath(base_dir)
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.ignore = ignore or (lambda name: name.startswith('.'))
+        self.extensions = tuple(extensions)
+        self.backend = None
+        self._pending = {}  # 路径 -> (最后一次变化的时间, 大小, 修改时间, 是否仍在写入)
+        self._folders = set()
+        self._stop = threading.Event()
+        self._iterating = threading.Lock()  # 迭代期间持有，close()等待迭代结束后再关闭inotify
+        libc = _load_libc() if use_inotify else None
+        if libc is not None:
+            try:
+                self.backend = _InotifyBackend(libc)
+            except OSError as e:
+                print(f"inotify不可用，改为轮询: {e}")
+        if self.backend is None:
+            self.backend = _PollingBackend(poll_interval)
+
+    def start(self):
+        """开始监视基础目录和其中已有的文件夹"""
+        self.backend.add(self.base_dir)
+        with os.scandir(self.base_dir) as it:
+            folders = [entry.path for entry in it if entry.is_dir() and not self.ignore(entry.name)]
+        for folder in sorted(folders):
+            self._add_folder(folder, check_existing=False)
+        return self
+
+    def stop(self):
+        """停止监视，正在进行的迭代在短时间内结束"""
+        self._stop.set()
+
+    def close(self):
+        self.stop()
+        acquired = self._iterating.acquire(timeout=_MAX_WAIT * 4)
+        try:
+            self.backend.close()
+        finally:
+            if acquired:
+                self._iterating.release()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _add_folder(self, folder, check_existing=True):
+        if folder in self._folders:
+            return
+        try:
+            self.backend.add(folder)
+        except OSError as e:
+            print(f"无法监视文件夹 {folder}: {e}")
+            return
+        self._folders.add(folder)
+        if check_existing:
+            # 文件夹可能在加入监视之前已经有图片（如整个文件夹被移入）
+            self._check_folder(folder)
+
+    def _check_folder(self, folder):
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_file():
+                        self._touch(entry.path)
+        except FileNotFoundError:
+            pass
+
+    def _is_image(self, path):
+        return path.lower().endswith(self.extensions) and not os.path.basename(path).startswith('.')
+
+    def _touch(self, path, writing=False):
+        """记录一次文件变化，重新开始等待
+
+        参数:
+            writing: 文件是否仍被打开写入，None表示保持之前的判断
+        """
+        if os.path.dirname(path) not in self._folders or not self._is_image(path):
+            return
+        entry = self._pending.get(path)
+        if entry is None:
+            # 只在第一次变化时读取文件状态，写入过程中的大量修改事件只更新时间
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return
+            entry = (None, st.st_size, st.st_mtime_ns, False)
+        if writing is None:
+            writing = entry[3]
+        self._pending[path] = (time.monotonic(), entry[1], entry[2], writing)
+
+    def _settle_time(self, writing):
+        return self.settle_seconds * (_OPEN_SETTLE_FACTOR if writing else 1)
+
+    def _settled(self, now):
+        """返回已经写入完成的文件"""
+        ready = []
+        for path, (changed, size, mtime, writing) in list(self._pending.items()):
+            if now - changed < self._settle_time(writing):
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime) or st.st_size == 0:
+                # 等待期间文件仍在变化（或还是空文件），再等待一个周期
+                self._pending[path] = (now, st.st_size, st.st_mtime_ns, writing)
+                continue
+            del self._pending[path]
+            ready.append(path)
+        return sorted(ready)
+
+    def __iter__(self):
+        with self._iterating:
+            yield from self._iterate()
+
+    def _iterate(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for path in self._settled(now):
+                yield path
+                if self._stop.is_set():
+                    return
+            if self._pending:
+                next_check = min(changed + self._settle_time(writing)
+                                 for changed, _, _, writing in self._pending.values())
+                timeout = min(max(next_check - time.monotonic(), 0.05), _MAX_WAIT)
+            else:
+                timeout = _MAX_WAIT
+            changed, new_dirs, overflow = self.backend.read(timeout)
+            for path, writing in changed:
+                self._touch(path, writing)
+            for folder in new_dirs:
+                if os.path.dirname(folder) == self.base_dir and not self.ignore(os.path.basename(folder)):
+                    self._add_folder(folder)
+            if overflow:
+                print("inotify事件队列溢出，重新检查所有文件夹")
+                for folder in sorted(self._folders):
+                    self._check_folder(folder)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+任务台账 / Job Ledger
+========================================================
+
+【功能说明 / Function Description】
+使用SQLite（WAL模式）记录每张图片的处理状态，取代progress.txt和folders_progress.txt。
+每张图片记录状态（pending / in_flight / done / failed）、尝试次数、最近的错误和耗时，
+断点续传变为一次索引查询：所有未完成的图片（包括排在已完成图片之前、曾经失败的图片）
+都会被自动重新处理。
+
+Records the state of every image in SQLite (WAL mode), replacing progress.txt
+and folders_progress.txt. Each image has a state (pending / in_flight / done /
+failed), an attempt count, the last error and timings. Resuming becomes one
+indexed query: every unfinished image, including failed images that sort before
+finished ones, is picked up again automatically.
+
+【并发 / Concurrency】
+- WAL模式允许读写并发，写事务使用BEGIN IMMEDIATE并设置busy_timeout，
+  多个进程同时写入时会排队等待而不是立即报错 / WAL mode lets readers and writers run
+  concurrently; write transactions use BEGIN IMMEDIATE with a busy_timeout so
+  concurrent writers from several processes wait instead of failing
+- 同一进程内的多个线程共享一个连接，由锁串行化 / Threads within one process share a
+  connection serialized by a lock
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+STATE_PENDING = "pending"
+STATE_IN_FLIGHT = "in_flight"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    image_path TEXT PRIMARY KEY,      -- 相对于BASE_DIR的图片路径
+    folder TEXT NOT NULL,             -- 所属文件夹
+    seq INTEGER NOT NULL,             -- 文件夹内的处理顺序
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    elapsed REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_folder_state ON jobs(folder, state, seq);
+CREATE TABLE IF NOT EXISTS folders (
+    folder TEXT PRIMARY KEY,
+    completed INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+"""
+
+
+class JobLedger(object):
+    """图片处理任务台账
+
+    参数:
+        path: 数据库文件路径
+        busy_timeout: 等待其它写入者释放锁的最长时间（秒）
+    """
+
+    def __init__(self, path, busy_timeout=60.0):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def _write(self, sql, params=()):
+        """在一个IMMEDIATE事务中执行写操作"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+                return cur.rowcount
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _read(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def sync_folder(self, folder, image_paths, done_paths):
+        """把文件夹当前的图片同步到台账
+
+        参数:
+            folder: 文件夹名称
+            image_paths: 按处理顺序排列的图片相对路径
+            done_paths: 已有有效描述文件的图片相对路径集合
+
+        新图片登记为pending；已有描述文件的图片标记为done；
+        台账中为done但描述文件已被删除的图片重新标记为pending；
+        上次运行中断时遗留的in_flight重新标记为pending。
+        """
+        now = time.time()
+        existing = {row[0]: (row[1], row[2]) for row in
+                    self._read("SELECT image_path, state, seq FROM jobs WHERE folder = ?", (folder,))}
+        inserts = []
+        updates = []
+        for seq, path in enumerate(image_paths):
+            if path not in existing:
+                inserts.append((path, folder, seq, STATE_DONE if path in done_paths else STATE_PENDING, now))
+                continue
+            old_state, old_seq = existing[path]
+            state = old_state
+            if path in done_paths:
+                state = STATE_DONE
+            elif old_state in (STATE_DONE, STATE_IN_FLIGHT):
+                state = STATE_PENDING
+            if state != old_state or seq != old_seq:
+                updates.append((state, seq, path))
+        current = set(image_paths)
+        removed = [(path,) for path in existing if path not in current]
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO jobs (image_path, folder, seq, state, created) VALUES (?, ?, ?, ?, ?)", inserts)
+                self._conn.executemany("UPDATE jobs SET state = ?, seq = ? WHERE image_path = ?", updates)
+                self._conn.executemany("DELETE FROM jobs WHERE image_path = ?", removed)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, image_path, folder):
+        """登记一张新建或被修改的图片，标记为pending（监视模式使用，不扫描整个文件夹）"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO jobs (image_path, folder, seq, state, created) VALUES "
+                    "(?, ?, (SELECT COALESCE(MAX(seq), -1) + 1 FROM jobs WHERE folder = ?), ?, ?) "
+                    "ON CONFLICT(image_path) DO UPDATE SET state = excluded.state",
+                    (image_path, folder, folder, STATE_PENDING, now))
+                self._conn.execute("UPDATE folders SET completed = 0, updated = ? WHERE folder = ?", (now, folder))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def pending(self, folder, max_attempts=None):
+        """返回文件夹中未完成的图片相对路径（按处理顺序）
+
+        参数:
+            folder: 文件夹名称
+            max_attempts: 失败次数达到该值的图片不再返回，为None时不限制
+        """
+        sql = ("SELECT image_path FROM jobs WHERE folder = ? AND state IN (?, ?, ?)")
+        params = [folder, STATE_PENDING, STATE_FAILED, STATE_IN_FLIGHT]
+        if max_attempts is not None:
+            sql += " AND attempts < ?"
+            params.append(max_attempts)
+        sql += " ORDER BY seq"
+        return [row[0] for row in self._read(sql, params)]
+
+    def mark_started(self, image_path):
+        self._write("UPDATE jobs SET state = ?, attempts = attempts + 1, started = ? WHERE image_path = ?",
+                    (STATE_IN_FLIGHT, time.time(), image_path))
+
+    def mark_done(self, image_path, elapsed=None):
+        self._write("UPDATE jobs SET state = ?, finished = ?, elapsed = ?, last_error = NULL WHERE image_path = ?",
+                    (STATE_DONE, time.time(), elapsed, image_path))
+
+    def mark_failed(self, image_path, error, elapsed=None):
+        self._write("UPDATE jobs SET state = ?, finished = ?, elapsed = ?, last_error = ? WHERE image_path = ?",
+                    (STATE_FAILED, time.time(), elapsed, str(error), image_path))
+
+    def counts(self, folder=None):
+        """返回各状态的图片数量"""
+        if folder is None:
+            rows = self._read("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+        else:
+            rows = self._read("SELECT state, COUNT(*) FROM jobs WHERE folder = ? GROUP BY state", (folder,))
+        return dict(rows)
+
+    def is_folder_completed(self, folder):
+        rows = self._read("SELECT completed FROM folders WHERE folder = ?", (folder,))
+        return bool(rows and rows[0][0])
+
+    def set_folder_completed(self, folder, completed=True):
+        self._write("INSERT INTO folders (folder, completed, updated) VALUES (?, ?, ?) "
+                    "ON CONFLICT(folder) DO UPDATE SET completed = excluded.completed, updated = excluded.updated",
+                    (folder, int(completed), time.time()))
+
+    def reset_folder(self, folder):
+        """删除文件夹的所有记录，下次运行时重新登记"""
+        self._write("DELETE FROM jobs WHERE folder = ?", (folder,))
+        self._write("DELETE FROM folders WHERE folder = ?", (folder,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+本地模拟星火图片理解服务 / Local Mock Spark Image Understanding Server
+========================================================
+
+【功能说明 / Function Description】
+在本机模拟星火图片理解的websocket接口，不消耗配额即可测试和压测描述程序。
+与真实接口使用相同的协议：接收一条（可分片的）JSON请求，按header.code、
+payload.choices.status和text[0].content逐帧流式返回结果。
+可以配置首帧延迟分布、输出速度、随机错误码、并发和QPS限流、配额上限以及中途断开。
+
+Simulates the Spark image understanding websocket API locally, so the
+describer can be tested and benchmarked without spending quota. It speaks the
+same protocol as the real service: it receives one (possibly fragmented) JSON
+request and streams the answer frame by frame with header.code,
+payload.choices.status and text[0].content. First-frame latency distribution,
+token rate, random error codes, concurrency and QPS throttling, a quota limit
+and mid-stream disconnects are configurable.
+
+【使用方法 / Usage】
+    python mock_spark_server.py [端口]
+然后把generate_picture_describe.py中的imageunderstanding_url设置为 ws://127.0.0.1:端口/v2.1/image
+Then set imageunderstanding_url in generate_picture_describe.py to ws://127.0.0.1:<port>/v2.1/image
+
+【说明 / Notes】
+- 只依赖标准库，websocket协议（握手、掩码、分片、ping、close）直接在asyncio上实现
+  / Only the standard library is used; the websocket protocol (handshake,
+  masking, fragmentation, ping, close) is implemented directly on asyncio
+- 不校验鉴权参数 / Authentication parameters are not verified
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import struct
+import threading
+import time
+import uuid
+
+_WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_OP_CONT = 0x0
+_OP_TEXT = 0x1
+_OP_BINARY = 0x2
+_OP_CLOSE = 0x8
+_OP_PING = 0x9
+_OP_PONG = 0xA
+
+_WORDS = ("a bright modern kitchen with white cabinets grey stone countertops and stainless steel appliances "
+          "natural light enters through a large window while pendant lamps hang above the island and "
+          "light oak flooring runs across the open space toward a glass door").split()
+
+
+class MockSparkConfig(object):
+    """模拟服务的行为配置
+
+    参数:
+        latency: 首帧延迟分布，"fixed"、"uniform"或"lognormal"
+        latency_median: 首帧延迟的中位数（秒）；uniform时为均值
+        latency_spread: uniform时为半宽（秒），lognormal时为sigma
+        token_rate: 输出速度（词/秒），为0时所有帧立即发送
+        answer_words: 每个回答的词数（不超过请求中的max_tokens）
+        words_per_frame: 每帧包含的词数
+        error_rate: 返回error_codes中随机错误码的概率
+        error_codes: 随机错误使用的错误码
+        max_concurrency: 同时处理的连接数上限，超过时返回10110，为None时不限制
+        qps: 每秒接受的请求数上限，超过时返回11202，为None时不限制
+        quota: 成功请求总数上限，用完后返回11201，为None时不限制
+        disconnect_rate: 在最后一帧之前断开连接的概率
+        image_tokens: usage中每张图片计入prompt_tokens的token数
+        seed: 随机数种子
+    """
+
+    def __init__(self, latency="lognormal", latency_median=1.0, latency_spread=0.4, token_rate=60.0,
+                 answer_words=120, words_per_frame=8, error_rate=0.0, error_codes=(10013,),
+                 max_concurrency=None, qps=None, quota=None, disconnect_rate=0.0, image_tokens=256, seed=None):
+        self.latency = latency
+        self.latency_median = latency_median
+        self.latency_spread = latency_spread
+        self.token_rate = token_rate
+        self.answer_words = answer_words
+        self.words_per_frame = words_per_frame
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.max_concurrency = max_concurrency
+        self.qps = qps
+        self.quota = quota
+        self.disconnect_rate = disconnect_rate
+        self.image_tokens = image_tokens
+        self.seed = seed
+
+
+class MockSparkServer(object):
+    """模拟星火图片理解服务
+
+    参数:
+        config: MockSparkConfig，为空时使用默认配置
+        host: 监听地址
+        port: 监听端口，0表示自动选择
+
+    属性:
+        stats: 请求计数（requests、按错误码统计的errors、bytes_received、peak_concurrency）
+    """
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or MockSparkConfig()
+        self.host = host
+        self.port = port
+        self.stats = {"requests": 0, "succeeded": 0, "errors": {}, "disconnects": 0,
+                      "bytes_received": 0, "peak_concurrency": 0}
+        self._rng = random.Random(self.config.seed)
+        self._active = 0
+        self._qps_tokens = float(self.config.qps or 0)
+        self._qps_updated = time.monotonic()
+        self._server = None
+        self._loop = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"ws://{self.host}:{self.port}/v2.1/image"
+
+    # ---------------- websocket协议 ----------------
+
+    async def _handshake(self, reader, writer):
+        request = await reader.readuntil(b"\r\n\r\n")
+        key = None
+        for line in request.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"sec-websocket-key":
+                key = value.strip()
+        if key is None:
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+            return False
+        accept = base64.b64encode(hashlib.sha1(key + _WS_GUID).digest())
+        writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        await writer.drain()
+        return True
+
+    async def _read_frame(self, reader):
+        head = await reader.readexactly(2)
+        fin = head[0] & 0x80
+        opcode = head[0] & 0x0F
+        length = head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await reader.readexactly(8))[0]
+        mask = await reader.readexactly(4) if head[1] & 0x80 else None
+        payload = await reader.readexactly(length)
+        if mask:
+            # 整块异或，避免逐字节循环
+            repeated = (mask * (length // 4 + 1))[:length]
+            payload = (int.from_bytes(payload, 'little') ^ int.from_bytes(repeated, 'little')).to_bytes(length, 'little')
+        return fin, opcode, payload
+
+    async def _read_message(self, reader, writer):
+        """读取一条完整消息（合并分片），连接关闭时返回None"""
+        parts = []
+        while True:
+            fin, opcode, payload = await self._read_frame(reader)
+            self.stats["bytes_received"] += len(payload)
+            if opcode == _OP_CLOSE:
+                return None
+            if opcode == _OP_PING:
+                await self._send_frame(writer, _OP_PONG, payload)
+                continue
+            if opcode in (_OP_TEXT, _OP_BINARY, _OP_CONT):
+                parts.append(payload)
+                if fin:
+                    return b"".join(parts)
+
+    async def _send_frame(self, writer, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            head = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 1 << 16:
+            head = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            head = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        writer.write(head + payload)
+        await writer.drain()
+
+    async def _send_json(self, writer, data):
+        await self._send_frame(writer, _OP_TEXT, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+    # ---------------- 模拟行为 ----------------
+
+    def _latency(self):
+        c = self.config
+        if c.latency == "fixed":
+            return c.latency_median
+        if c.latency == "uniform":
+            return max(0.0, self._rng.uniform(c.latency_median - c.latency_spread, c.latency_median + c.latency_spread))
+        return self._rng.lognormvariate(0, c.latency_spread) * c.latency_median
+
+    def _take_qps_token(self):
+        if not self.config.qps:
+            return True
+        now = time.monotonic()
+        self._qps_tokens = min(float(self.config.qps),
+                               self._qps_tokens + (now - self._qps_updated) * self.config.qps)
+        self._qps_updated = now
+        if self._qps_tokens < 1:
+            return False
+        self._qps_tokens -= 1
+        return True
+
+    def _admission_error(self):
+        """按限流和配额规则决定是否直接返回错误码"""
+        c = self.config
+        if c.max_concurrency is not None and self._active > c.max_concurrency:
+            return 10110, "server busy"
+        if not self._take_qps_token():
+            return 11202, "qps limit exceeded"
+        if c.quota is not None and self.stats["succeeded"] >= c.quota:
+            return 11201, "daily quota exceeded"
+        if c.error_rate and self._rng.random() < c.error_rate:
+            return self._rng.choice(c.error_codes), "mock error"
+        return None
+
+    @staticmethod
+    def _header(code, message, sid, status):
+        return {"code": code, "message": message, "sid": sid, "status": status}
+
+    async def _respond(self, writer, request):
+        sid = f"mock{uuid.uuid4().hex[:16]}"
+        try:
+            data = json.loads(request)
+            data["payload"]["message"]["text"]
+        except (ValueError, KeyError, TypeError):
+            await self._send_json(writer, {"header": self._header(10907, "invalid request", sid, 2)})
+            self._count_error(10907)
+            return
+
+        error = self._admission_error()
+        if error is not None:
+            code, message = error
+            self._count_error(code)
+            await self._send_json(writer, {"header": self._header(code, message, sid, 2)})
+            return
+
+        await asyncio.sleep(self._latency())
+        c = self.config
+        # 与真实接口一样，回答不超过请求中的max_tokens（模拟服务中每个单词算一个token）
+        max_tokens = data.get("parameter", {}).get("chat", {}).get("max_tokens") or c.answer_words
+        words = [self._rng.choice(_WORDS) for _ in range(min(c.answer_words, max_tokens))]
+        frames = [words[i:i + c.words_per_frame] for i in range(0, len(words), c.words_per_frame)] or [[]]
+        disconnect_at = len(frames) - 1 if c.disconnect_rate and self._rng.random() < c.disconnect_rate else None
+        for seq, frame in enumerate(frames):
+            if seq == disconnect_at:
+                self.stats["disconnects"] += 1
+                return
+            last = seq == len(frames) - 1
+            status = 2 if last else (0 if seq == 0 else 1)
+            content = " ".join(frame) + ("" if last else " ")
+            message = {
+                "header": self._header(0, "Success", sid, status),
+                "payload": {"choices": {"status": status, "seq": seq,
+                                        "text": [{"content": content, "role": "assistant", "index": 0}]}},
+            }
+            if last:
+                prompt_tokens = c.image_tokens + sum(len(str(m.get("content", "")).split())
+                                                     for m in data["payload"]["message"]["text"]
+                                                     if m.get("content_type") != "image")
+                message["payload"]["usage"] = {"text": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                                                        "total_tokens": prompt_tokens + len(words)}}
+            await self._send_json(writer, message)
+            if c.token_rate and not last:
+                await asyncio.sleep(len(frame) / c.token_rate)
+        self.stats["succeeded"] += 1
+
+    def _count_error(self, code):
+        errors = self.stats["errors"]
+        errors[code] = errors.get(code, 0) + 1
+
+    async def _handle(self, reader, writer):
+        self._active += 1
+        self.stats["peak_concurrency"] = max(self.stats["peak_concurrency"], self._active)
+        try:
+            if not await self._handshake(reader, writer):
+                return
+            request = await self._read_message(reader, writer)
+            if request is None:
+                return
+            self.stats["requests"] += 1
+            await self._respond(writer, request)
+            try:
+                await self._send_frame(writer, _OP_CLOSE, struct.pack("!H", 1000))
+            except ConnectionError:
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._active -= 1
+            writer.close()
+
+    # ---------------- 启动与停止 ----------------
+
+    async def start_async(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start_async()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start(self):
+        """在后台线程中启动服务，返回self；url属性为服务地址"""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start_async())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="mock-spark-server", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import sys
+
+    server = MockSparkServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
+    print(f"模拟星火服务已启动: {server.url}")
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print(f"已停止，统计: {server.stats}")
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+集中式描述存储 / Consolidated Output Store
+========================================================
+
+【功能说明 / Function Description】
+把图片描述追加写入少量分片文件（JSON Lines或SQLite），以图片相对于BASE_DIR的路径为键，
+代替每张图片一个.txt文件。断点续传时只需顺序读取这些分片文件，不再逐个打开数百万个小文件；
+需要.txt文件时可以用export_sidecars()（或export_descriptions.py）导出。
+
+Appends image descriptions to a small number of shard files (JSON Lines or
+SQLite), keyed by the image path relative to BASE_DIR, instead of one .txt file
+per image. Resume checks read these shards sequentially instead of opening
+millions of small files; export_sidecars() (or export_descriptions.py)
+materializes the classic .txt sidecars when they are needed.
+
+【实现 / Implementation】
+- 只追加：更新和删除都追加新记录，同一个键以时间最新的记录为准 / Append-only: updates and
+  deletions append new records; the newest record of a key wins
+- 每条JSONL记录用一次write()追加，中断时最多留下一行不完整的记录，读取时被忽略
+  / Each JSONL record is appended with a single write(); an interruption leaves at
+  most one incomplete line, which is ignored when reading
+- 批量fsync：累计fsync_every条记录或距离上次fsync超过fsync_interval秒时同步到磁盘，
+  SQLite每批记录提交一次事务 / Batched fsync: data is synced after fsync_every records
+  or fsync_interval seconds; SQLite commits one transaction per batch
+- 每个写入者只写自己的分片文件（文件名包含writer_id），多台机器可以共享同一个存储目录，
+  读取时合并所有写入者的文件 / Every writer only writes its own shard files (the file
+  name contains writer_id), so several machines can share one store directory;
+  reading merges the files of all writers
+- refresh()只读取其它写入者在上次读取之后追加的记录，认领租约后用它确认图片没有被其它机器完成
+  / refresh() reads only the records other writers appended since the last read;
+  it is used after claiming a lease to check that no other host finished the image
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from work_lease import shard_of
+
+OUTPUT_TXT = "txt"
+OUTPUT_JSONL = "jsonl"
+OUTPUT_SQLITE = "sqlite"
+FILE_PREFIX = "descriptions-"
+
+
+class _ShardedStore(object):
+    """分片存储的公共部分：内存索引、写入批次和并发控制"""
+
+    extension = None
+
+    def __init__(self, directory, shards=16, writer_id="local", fsync_every=100, fsync_interval=1.0):
+        self.directory = directory
+        self.shards = shards
+        self.writer_id = writer_id
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._index = {}  # 键 -> (时间, 定位信息)，已删除的键定位信息为None
+        self._folders = {}  # 顶层文件夹 -> 有描述的键的集合，按文件夹查询时不需要遍历整个索引
+        self._positions = {}  # 分片文件 -> 已读取到的位置（JSONL为字节偏移，SQLite为记录时间）
+        self._pending = 0  # 上次同步以来写入的记录数
+        self._last_sync = time.monotonic()
+        self._load()
+
+    def _shard_path(self, shard):
+        return os.path.join(self.directory, f"{FILE_PREFIX}{self.writer_id}-{shard:02d}{self.extension}")
+
+    def _load(self, others_only=False, shard=None):
+        """顺序读取目录中所有写入者的分片文件，建立索引；已经读取过的文件只读取新追加的记录
+
+        参数:
+            others_only: 只读取其它写入者的文件（自己写入的记录已经在索引中）
+            shard: 只读取该分片编号的文件
+        """
+        own = f"{FILE_PREFIX}{self.writer_id}-"
+        suffix = self.extension if shard is None else f"-{shard:02d}{self.extension}"
+        for name in sorted(os.listdir(self.directory)):
+            if not name.startswith(FILE_PREFIX) or not name.endswith(suffix):
+                continue
+            if others_only and name.startswith(own) and name[len(own):-len(self.extension)].isdigit():
+                continue
+            for key, timestamp, locator in self._scan(os.path.join(self.directory, name)):
+                self._apply(key, timestamp, locator)
+
+    def refresh(self, key=None):
+        """读取其它写入者在上次读取之后追加的记录
+
+        参数:
+            key: 只读取该键所在分片的文件，为None时读取全部
+        """
+        with self._lock:
+            self._load(others_only=True, shard=None if key is None else shard_of(key, self.shards))
+
+    def _apply(self, key, timestamp, locator):
+        current = self._index.get(key)
+        if current is None or timestamp >= current[0]:
+            self._index[key] = (timestamp, locator)
+            folder = key.split(os.sep, 1)[0] if os.sep in key else ""
+            if locator is not None:
+                self._folders.setdefault(folder, set()).add(key)
+            elif folder in self._folders:
+                self._folders[folder].discard(key)
+
+    def put(self, key, text):
+        """写入一张图片的描述"""
+        self._write(key, text)
+
+    def delete(self, keys):
+        """删除描述（追加删除记录）"""
+        for key in keys:
+            if key in self:
+                self._write(key, None)
+
+    def _write(self, key, text):
+        timestamp = time.time()
+        with self._lock:
+            locator = self._append(shard_of(key, self.shards), key, text, timestamp)
+            self._apply(key, timestamp, locator if text is not None else None)
+            self._pending += 1
+            if self._pending >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self.flush()
+
+    def get(self, key):
+        """返回描述，不存在时返回None"""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None or entry[1] is None:
+                return None
+            return self._read(key, entry[1])
+
+    def modified(self, key):
+        """返回描述的写入时间（time.time()），不存在时返回None"""
+        entry = self._index.get(key)
+        if entry is None or entry[1] is None:
+            return None
+        return entry[0]
+
+    def __contains__(self, key):
+        entry = self._index.get(key)
+        return entry is not None and entry[1] is not None
+
+    def __len__(self):
+        return sum(1 for entry in self._index.values() if entry[1] is not None)
+
+    def keys(self, folder=None):
+        """返回有描述的键；指定folder时只返回该文件夹中的图片"""
+        with self._lock:
+            if folder is None:
+                return [key for key, entry in self._index.items() if entry[1] is not None]
+            prefix = folder.rstrip("/" + os.sep) + os.sep
+            keys = self._folders.get(prefix.split(os.sep, 1)[0], ())
+            return [key for key in keys if key.startswith(prefix)]
+
+    def items(self, folder=None):
+        for key in self.keys(folder):
+            text = self.get(key)
+            if text is not None:
+                yield key, text
+
+    def flush(self):
+        """把尚未同步的记录写入磁盘"""
+        with self._lock:
+            self._sync()
+            self._pending = 0
+            self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class JsonlOutputStore(_ShardedStore):
+    """JSON Lines分片存储，每行为 {"path": 键, "text": 描述, "time": 时间}，删除记录的text为null
+
+    参数:
+        directory: 存储目录
+        shards: 每个写入者的分片文件数量
+        writer_id: 写入者标识，多个进程或多台机器写入同一目录时必须不同
+        fsync_every: 累计写入多少条记录后fsync
+        fsync_interval: 距离上次fsync超过该秒数时，下一次写入后fsync
+    """
+
+    extension = ".jsonl"
+
+    def __init__(self, directory, shards=16, writer_id="local", fsync_every=100, fsync_interval=1.0):
+        self._fds = {}  # 分片 -> (文件描述符, 当前大小)
+        self._dirty = set()
+        super().__init__(directory, shards, writer_id, fsync_every, fsync_interval)
+
+    def _scan(self, path):
+        offset = self._positions.get(path, 0)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                start = offset
+                if not line.endswith(b'\n'):
+                    break  # 写入中断（或正在写入）的不完整记录，下次从这里继续读取
+                offset += len(line)
+                self._positions[path] = offset
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                yield record["path"], record["time"], (path, start) if record.get("text") is not None else None
+
+    def _open(self, shard):
+        entry = self._fds.get(shard)
+        if entry is None:
+            path = self._shard_path(shard)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            size = os.fstat(fd).st_size
+            if size:
+                with open(path, 'rb') as f:
+                    f.seek(size - 1)
+                    if f.read(1) != b'\n':
+                        size += os.write(fd, b'\n')  # 隔开上次中断留下的不完整记录
+            entry = self._fds[shard] = (fd, size)
+        return entry
+
+    def _append(self, shard, key, text, timestamp):
+        fd, size = self._open(shard)
+        data = (json.dumps({"path": key, "text": text, "time": timestamp}, ensure_ascii=False) + "\n").encode('utf-8')
+        os.write(fd, data)
+        self._fds[shard] = (fd, size + len(data))
+        self._dirty.add(shard)
+        return self._shard_path(shard), size
+
+    def _read(self, key, locator):
+        path, offset = locator
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())["text"]
+
+    def _sync(self):
+        for shard in self._dirty:
+            os.fsync(self._fds[shard][0])
+        self._dirty.clear()
+
+    def _close(self):
+        for fd, _ in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+
+class SqliteOutputStore(_ShardedStore):
+    """SQLite分片存储，每个分片一个数据库文件，每批记录提交一次事务
+
+    参数与JsonlOutputStore相同，fsync_every为每个事务包含的记录数。
+    """
+
+    extension = ".db"
+
+    def __init__(self, directory, shards=16, writer_id="local", fsync_every=100, fsync_interval=1.0):
+        self._conns = {}  # 数据库文件 -> 连接（自己的分片可写，其它写入者的分片只读取）
+        super().__init__(directory, shards, writer_id, fsync_every, fsync_interval)
+
+    def _scan(self, path):
+        # 同一时间的记录可能分两批提交，因此从上次读到的最大时间（含）开始重新读取
+        since = self._positions.get(path)
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute("SELECT path, time, text IS NULL FROM descriptions WHERE ? IS NULL OR time >= ?",
+                                (since, since)).fetchall()
+            for key, timestamp, deleted in rows:
+                if since is None or timestamp > since:
+                    self._positions[path] = since = timestamp
+                yield key, timestamp, None if deleted else path
+        except sqlite3.OperationalError:
+            return  # 还没有建表的空文件
+        finally:
+            conn.close()
+
+    def _conn(self, path, writable=False):
+        conn = self._conns.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            if writable:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=FULL")
+                conn.execute("CREATE TABLE IF NOT EXISTS descriptions "
+                             "(path TEXT PRIMARY KEY, text TEXT, time REAL NOT NULL)")
+            self._conns[path] = conn
+        return conn
+
+    def _append(self, shard, key, text, timestamp):
+        path = self._shard_path(shard)
+        conn = self._conn(path, writable=True)
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        conn.execute("INSERT INTO descriptions (path, text, time) VALUES (?, ?, ?) "
+                     "ON CONFLICT(path) DO UPDATE SET text = excluded.text, time = excluded.time",
+                     (key, text, timestamp))
+        return path
+
+    def _read(self, key, path):
+        row = self._conn(path).execute("SELECT text FROM descriptions WHERE path = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _sync(self):
+        for conn in self._conns.values():
+            if conn.in_transaction:
+                conn.execute("COMMIT")
+
+    def _close(self):
+        for conn in self._conns.values():
+            conn.close()
+        self._conns.clear()
+
+
+def open_output_store(directory, output_format, **kwargs):
+    """按格式打开存储，output_format为OUTPUT_JSONL或OUTPUT_SQLITE"""
+    if output_format == OUTPUT_JSONL:
+        return JsonlOutputStore(directory, **kwargs)
+    if output_format == OUTPUT_SQLITE:
+        return SqliteOutputStore(directory, **kwargs)
+    raise ValueError(f"不支持的存储格式: {output_format}")
+
+
+def sidecar_path(base_dir, key):
+    """图片对应的.txt文件路径"""
+    return os.path.splitext(os.path.join(base_dir, key))[0] + '.txt'
+
+
+def export_sidecars(store, base_dir, folder=None, overwrite=False):
+    """把存储中的描述导出为与图片同名的.txt文件
+
+    参数:
+        store: JsonlOutputStore或SqliteOutputStore
+        base_dir: 图片的基础目录（存储中的键相对于该目录）
+        folder: 只导出该文件夹，为None时导出全部
+        overwrite: 是否覆盖已存在的.txt文件
+
+    返回:
+        tuple: (导出数量, 跳过数量)
+    """
+    written = 0
+    skipped = 0
+    for key, text in store.items(folder):
+        path = sidecar_path(base_dir, key)
+        if not overwrite and os.path.exists(path):
+            skipped += 1
+            continue
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        written += 1
+    return written, skipped
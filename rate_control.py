@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+自适应限流 / Adaptive Rate Control
+========================================================
+
+【功能说明 / Function Description】
+根据接口返回结果动态调整并发数（AIMD：加性增、乘性减）：
+请求持续成功时逐步增加并发，遇到限流或配额错误码时成倍降低并发。
+持续失败时打开熔断器，暂停所有worker，等待一段时间后只放行一个探测请求，
+探测成功再恢复。这样可以贴着真实的配额上限运行，而不会浪费请求。
+
+Adjusts concurrency based on API results (AIMD: additive increase,
+multiplicative decrease): concurrency grows while requests succeed and is cut
+multiplicatively on throttling or quota error codes. Sustained failures open a
+circuit breaker that pauses every worker; after a cool-down a single probe
+request is let through and normal operation resumes once it succeeds.
+"""
+
+import asyncio
+import time
+
+from spark_client import SparkAPIError, QUOTA_ERROR_CODES, THROTTLE_ERROR_CODES, REJECTED_ERROR_CODES
+
+# 请求结果分类
+OUTCOME_SUCCESS = "success"  # 成功
+OUTCOME_THROTTLE = "throttle"  # 被限流（秒级/并发流控、服务忙）
+OUTCOME_QUOTA = "quota"  # 配额耗尽（日流控等）
+OUTCOME_FAILURE = "failure"  # 网络等临时错误
+OUTCOME_REJECTED = "rejected"  # 与单个请求内容有关的错误（如审核不通过），不影响限流
+
+
+def classify_outcome(error):
+    """根据异常判断请求结果类别
+
+    参数:
+        error: 请求抛出的异常，成功时为None
+
+    返回:
+        str: OUTCOME_* 之一
+    """
+    if error is None:
+        return OUTCOME_SUCCESS
+    if isinstance(error, SparkAPIError):
+        if error.code in THROTTLE_ERROR_CODES:
+            return OUTCOME_THROTTLE
+        if error.code in QUOTA_ERROR_CODES:
+            return OUTCOME_QUOTA
+        if error.code in REJECTED_ERROR_CODES:
+            return OUTCOME_REJECTED
+    return OUTCOME_FAILURE
+
+
+class CircuitBreaker(object):
+    """熔断器
+
+    连续失败达到阈值后进入打开状态，打开期间不放行任何请求；
+    到期后进入半开状态，只放行一个探测请求。探测失败则重新打开，且打开时间翻倍。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, open_seconds=30.0, max_open_seconds=600.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.clock = clock
+        self.consecutive_failures = 0
+        self._state = self.CLOSED
+        self._current_open_seconds = open_seconds
+        self._open_until = 0.0
+
+    @property
+    def state(self):
+        if self._state == self.OPEN and self.clock() >= self._open_until:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def remaining(self):
+        """距离熔断器允许探测还需等待的秒数，未打开时为0"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self._open_until - self.clock())
+
+    def open(self, seconds=None):
+        """打开熔断器，seconds为空时使用当前的打开时长"""
+        if seconds is None:
+            seconds = self._current_open_seconds
+            self._current_open_seconds = min(self._current_open_seconds * 2, self.max_open_seconds)
+        self._state = self.OPEN
+        self._open_until = max(self._open_until, self.clock() + seconds)
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self._state = self.CLOSED
+        self._current_open_seconds = self.open_seconds
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        state = self.state
+        if state == self.OPEN:
+            return  # 打开之前发出的请求陆续失败，不再延长打开时间
+        if state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.open()
+
+
+class AdaptiveRateController(object):
+    """AIMD并发控制器
+
+    参数:
+        initial: 初始并发数
+        minimum: 并发下限
+        maximum: 并发上限
+        increase: 每经过一轮（约等于当前并发数个）成功请求增加的并发数
+        decrease_factor: 遇到限流时并发数乘以的系数
+        breaker: CircuitBreaker实例
+        quota_pause: 遇到配额错误时熔断器的暂停时间（秒）
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=16, increase=1.0, decrease_factor=0.5,
+                 breaker=None, quota_pause=300.0):
+        if not 1 <= minimum <= maximum:
+            raise ValueError("需要满足 1 <= minimum <= maximum")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.breaker = breaker or CircuitBreaker()
+        self.quota_pause = quota_pause
+        self.in_flight = 0
+        self._limit = float(min(max(initial, minimum), maximum))
+        # 每次降低并发时epoch加一，降低之前发出的请求再遇到限流不会重复降低
+        self._epoch = 0
+        self._cond = None
+
+    @property
+    def limit(self):
+        """当前允许的并发数"""
+        if self.breaker.state == CircuitBreaker.HALF_OPEN:
+            return 1
+        return int(self._limit)
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self):
+        """等待一个并发名额，返回本次请求的epoch，需要传给release()"""
+        cond = self._condition()
+        async with cond:
+            while True:
+                wait = self.breaker.remaining()
+                if wait > 0:
+                    try:
+                        await asyncio.wait_for(cond.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return self._epoch
+                await cond.wait()
+
+    def try_acquire(self):
+        """不等待地取得一个并发名额，没有空闲名额（或熔断器打开）时返回None，否则返回epoch"""
+        if self.breaker.remaining() > 0 or self.in_flight >= self.limit:
+            return None
+        self.in_flight += 1
+        return self._epoch
+
+    async def release(self, epoch, outcome):
+        """归还名额并根据请求结果调整并发数
+
+        参数:
+            epoch: acquire()或try_acquire()返回的值
+            outcome: OUTCOME_* 之一，为None时只归还名额（如请求被主动取消）
+        """
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            self.record(epoch, outcome)
+            cond.notify_all()
+
+    def record(self, epoch, outcome):
+        """根据请求结果更新并发数和熔断器状态（不涉及名额计数）"""
+        if outcome == OUTCOME_SUCCESS:
+            if self.breaker.state == CircuitBreaker.HALF_OPEN:
+                # 熔断恢复后从最低并发重新开始增长
+                self._limit = float(self.minimum)
+            self.breaker.record_success()
+            self._limit = min(self.maximum, self._limit + self.increase / max(self._limit, 1.0))
+        elif outcome in (OUTCOME_THROTTLE, OUTCOME_QUOTA):
+            if epoch == self._epoch:
+                self._epoch += 1
+                self._limit = max(float(self.minimum), self._limit * self.decrease_factor)
+            self.breaker.record_failure()
+            if outcome == OUTCOME_QUOTA:
+                self.breaker.open(self.quota_pause)
+        elif outcome == OUTCOME_FAILURE:
+            self.breaker.record_failure()
+        # OUTCOME_REJECTED 只与请求内容有关，不调整并发
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+重试策略与死信记录 / Retry Policy and Dead-Letter Log
+========================================================
+
+【功能说明 / Function Description】
+失败的描述请求按指数退避（带随机抖动、有上限）重新排队；
+与请求内容有关的错误或重试次数用尽的请求写入死信文件（JSON Lines），
+死信文件可以在之后重新加载并重放。
+
+Failed describe requests are queued again with jittered, capped exponential
+backoff. Requests that fail because of their content, or that run out of
+attempts, are appended to a dead-letter file (JSON Lines) that can be loaded
+and replayed later.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+
+from rate_control import OUTCOME_FAILURE, OUTCOME_QUOTA, OUTCOME_THROTTLE
+from spark_client import SparkAPIError
+
+# 可以重试的请求结果类别
+RETRYABLE_OUTCOMES = (OUTCOME_THROTTLE, OUTCOME_QUOTA, OUTCOME_FAILURE)
+
+
+class RetryPolicy(object):
+    """指数退避重试策略
+
+    参数:
+        max_attempts: 每个任务在一次运行中的最大尝试次数
+        base_delay: 第一次重试前的基础等待时间（秒）
+        max_delay: 等待时间上限（秒）
+        jitter: 抖动比例，0表示不抖动，1表示在[0, delay]之间均匀随机（full jitter）
+    """
+
+    def __init__(self, max_attempts=5, base_delay=2.0, max_delay=120.0, jitter=1.0, rng=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self._rng = rng or random.Random()
+
+    def should_retry(self, outcome, attempts):
+        """根据结果类别和已尝试次数判断是否重试"""
+        return outcome in RETRYABLE_OUTCOMES and attempts < self.max_attempts
+
+    def delay(self, attempts):
+        """第attempts次失败后重新排队前的等待时间"""
+        delay = min(self.max_delay, self.base_delay * (2 ** max(attempts - 1, 0)))
+        if self.jitter:
+            delay -= self._rng.uniform(0, delay * self.jitter)
+        return delay
+
+
+class DeadLetterLog(object):
+    """死信文件，每行记录一个最终失败的任务（JSON Lines）
+
+    参数:
+        path: 死信文件路径
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_record(job):
+        """把失败的DescribeJob转换为死信记录"""
+        error = job.error
+        return {
+            "image_path": job.image_path,
+            "output_file": job.output_file,
+            "prompt": job.prompt,
+            "attempts": job.attempts,
+            "outcome": job.outcome,
+            "code": error.code if isinstance(error, SparkAPIError) else None,
+            "error": str(error),
+            "error_type": type(error).__name__,
+            "time": time.time(),
+        }
+
+    def append(self, job):
+        """记录一个最终失败的任务"""
+        line = json.dumps(self.make_record(job), ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    def load(self):
+        """读取所有死信记录，同一张图片只保留最后一条"""
+        if not os.path.exists(self.path):
+            return []
+        records = {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 写入中断造成的不完整行
+                records[record["image_path"]] = record
+        return list(records.values())
+
+    def rewrite(self, records):
+        """用给定的记录替换死信文件（先写临时文件再替换）"""
+        with self._lock:
+            if not records:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
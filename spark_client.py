@@ -0,0 +1,599 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+星火图片理解客户端 / Spark Image Understanding Client
+========================================================
+
+【功能说明 / Function Description】
+封装讯飞星火图片理解接口的websocket协议：鉴权URL生成、请求参数构造、
+流式结果的接收与拼接。每次请求的状态（已收到的内容、错误码）都保存在
+请求自身内部，不再使用模块级全局变量，因此可以在多个线程中同时发起请求。
+
+Wraps the websocket protocol of the Xunfei Spark image understanding API:
+authentication URL generation, request parameter construction, and receiving
+and joining streamed results. The state of each request (received content,
+error code) is kept inside the request itself instead of module-level globals,
+so requests can be issued from several threads at the same time.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import re
+import socket
+import ssl
+import threading
+import time
+import uuid
+from datetime import datetime
+from time import mktime
+from urllib.parse import urlencode, urlparse
+from wsgiref.handlers import format_date_time
+
+import websocket  # 使用websocket_client
+from websocket import ABNF
+
+
+# 错误码分类，参考星火接口文档的错误码说明
+THROTTLE_ERROR_CODES = {10110, 11202, 11203}  # 服务忙、秒级流控超限、并发流控超限
+QUOTA_ERROR_CODES = {11201}  # 日流控超限（配额耗尽）
+REJECTED_ERROR_CODES = {10013, 10014, 10019, 10907}  # 内容审核不通过、token数超限等，重试也不会成功
+EMPTY_ANSWER_CODE = -2  # 接口正常结束但没有返回任何内容
+CONNECTION_CLOSED_CODE = -1  # 连接在返回完整结果前被关闭
+TIMEOUT_CODE = -3  # 连接、首个结果或整个请求超时
+CANCELLED_CODE = -4  # 请求被调用方取消（如对冲请求中较慢的一个）
+
+# 流式发送请求时每次base64编码的原始字节数（必须是3的倍数），编码后为64KB
+STREAM_CHUNK_SIZE = 48 * 1024
+# 每个websocket分片的目标大小
+STREAM_FRAME_SIZE = 64 * 1024
+
+# 根据字数要求估算max_tokens使用的比例
+TOKENS_PER_WORD = 1.4  # 每个英文单词
+TOKENS_PER_CHAR = 1.0  # 每个中文字
+
+
+class SparkAPIError(Exception):
+    """星火接口返回的错误（header.code != 0）"""
+
+    def __init__(self, code, message="", data=None):
+        super().__init__(f"请求错误: {code}, {message}")
+        self.code = code
+        self.message = message
+        self.data = data
+
+
+class SparkTimeoutError(SparkAPIError):
+    """请求超时，stage为connect（连接）、first_token（首个结果）或total（整个请求）"""
+
+    def __init__(self, stage, seconds):
+        super().__init__(TIMEOUT_CODE, f"{stage} 超时（{seconds:.1f}秒）")
+        self.stage = stage
+
+
+class SparkCancelledError(SparkAPIError):
+    """请求被CancelToken取消"""
+
+    def __init__(self):
+        super().__init__(CANCELLED_CODE, "请求已取消")
+
+
+class RequestMetrics(object):
+    """一次请求的测量值，由SparkImageClient在请求过程中填写
+
+    属性:
+        connect_seconds: 建立连接（含TLS和websocket握手）的耗时
+        upload_seconds: 从开始请求到请求（含base64编码的图片）发送完毕的耗时
+        first_token_seconds: 从开始请求到收到第一条结果的耗时
+        total_seconds: 整个请求的耗时
+        bytes_sent: 上传的请求字节数
+        chars_received: 收到的描述字符数
+        error_code: 失败时的错误码（SparkAPIError.code），其它异常为None
+        error_type: 失败时的异常类型名称
+        prompt_tokens, completion_tokens: 接口在最后一条结果中返回的token用量，没有收到时为None
+        early_closed: 是否因为达到字数上限而在结果结束前关闭了连接
+        discarded_chars: 超出字数上限而被截掉的字符数
+    """
+
+    def __init__(self):
+        self.connect_seconds = None
+        self.upload_seconds = None
+        self.first_token_seconds = None
+        self.total_seconds = None
+        self.bytes_sent = 0
+        self.chars_received = 0
+        self.error_code = None
+        self.error_type = None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.early_closed = False
+        self.discarded_chars = 0
+
+    @property
+    def ok(self):
+        return self.error_type is None
+
+    def completion_token_cost(self):
+        """本次请求消耗的输出token数，接口没有返回用量时按收到的字数估算"""
+        if self.completion_tokens is not None:
+            return self.completion_tokens
+        return estimate_tokens(self.chars_received)
+
+
+class CancelToken(object):
+    """在其它线程中取消进行中的请求
+
+    cancel()关闭请求的socket，阻塞在接收上的线程会立即返回并抛出SparkCancelledError。
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._ws = None
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            ws = self._ws
+        if ws is not None and ws.sock is not None:
+            try:
+                ws.sock.shutdown(socket.SHUT_RDWR)  # close()不能唤醒阻塞在recv上的线程
+            except OSError:
+                pass
+
+    def _attach(self, ws):
+        with self._lock:
+            self._ws = ws
+            return not self.cancelled
+
+
+def estimate_tokens(chars):
+    """按英文平均每个token约4个字符估算token数"""
+    return (chars + 3) // 4
+
+
+# 提示词中的字数要求，如 "100-150个单词"、"about 120 words"、"200字以内"
+_LENGTH_PATTERN = re.compile(r"(\d+)(?:\s*(?:-|–|~|～|到|至|to)\s*(\d+))?\s*(?:个)?\s*(单词|words?|字)",
+                             re.IGNORECASE)
+# 截断时优先停在这些句末标点之后
+_SENTENCE_END = re.compile(r"[.!?。！？](?=\s|$)")
+
+
+def truncate_answer(text, max_words=None, max_chars=None):
+    """把描述截断到max_words个单词（或max_chars个非空白字符）以内，尽量停在句末
+
+    返回:
+        str: 没有超出时为原文
+    """
+    if max_words is not None:
+        words = list(re.finditer(r"\S+", text))
+        if len(words) <= max_words:
+            return text
+        cut = words[max_words - 1].end()
+    elif max_chars is not None:
+        positions = [m.start() for m in re.finditer(r"\S", text)]
+        if len(positions) <= max_chars:
+            return text
+        cut = positions[max_chars - 1] + 1
+    else:
+        return text
+    head = text[:cut]
+    # 最后一个完整句子不短于预算的一半时停在句末，否则直接在预算处截断
+    ends = [m.end() for m in _SENTENCE_END.finditer(head)]
+    if ends and ends[-1] >= cut // 2:
+        return head[:ends[-1]]
+    return head.rstrip()
+
+
+class AnswerBudget(object):
+    """根据提示词中的字数要求决定每次请求的max_tokens和提前关闭连接的字数
+
+    提示词要求 "100-150个单词" 时，描述最多保留 150 * margin 个单词，达到后客户端在句末截断并关闭连接；
+    max_tokens按同样的字数估算并再留出余量，作为服务端的上限。提示词中没有字数要求时使用default_max_tokens。
+
+    参数:
+        margin: 允许超出提示词要求的比例
+        default_max_tokens: 提示词中没有字数要求时的max_tokens，为None时使用模型参数中的值
+    """
+
+    def __init__(self, margin=1.3, default_max_tokens=None):
+        self.margin = margin
+        self.default_max_tokens = default_max_tokens
+
+    def limits(self, prompt):
+        """返回传给SparkImageClient.describe_image的参数：max_tokens、max_words或max_chars"""
+        match = None
+        for match in _LENGTH_PATTERN.finditer(prompt):
+            pass  # 使用最后一个字数要求
+        if match is None:
+            return {"max_tokens": self.default_max_tokens} if self.default_max_tokens else {}
+        count = int(match.group(2) or match.group(1))
+        limit = max(int(count * self.margin), 1)
+        if match.group(3) == "字":
+            return {"max_chars": limit, "max_tokens": int(limit * TOKENS_PER_CHAR * 1.2) + 16}
+        return {"max_words": limit, "max_tokens": int(limit * TOKENS_PER_WORD * 1.2) + 16}
+
+    def signature(self):
+        """描述缓存使用的参数签名，参数改变时缓存自动失效"""
+        return json.dumps({"margin": self.margin, "default_max_tokens": self.default_max_tokens}, sort_keys=True)
+
+
+class Ws_Param(object):
+    # 初始化
+    def __init__(self, APPID, APIKey, APISecret, imageunderstanding_url):
+        self.APPID = APPID
+        self.APIKey = APIKey
+        self.APISecret = APISecret
+        self.host = urlparse(imageunderstanding_url).netloc
+        self.path = urlparse(imageunderstanding_url).path
+        self.ImageUnderstanding_url = imageunderstanding_url
+
+    # 生成url
+    def create_url(self):
+        # 生成RFC1123格式的时间戳
+        now = datetime.now()
+        date = format_date_time(mktime(now.timetuple()))
+
+        # 拼接字符串
+        signature_origin = "host: " + self.host + "\n"
+        signature_origin += "date: " + date + "\n"
+        signature_origin += "GET " + self.path + " HTTP/1.1"
+
+        # 进行hmac-sha256进行加密
+        signature_sha = hmac.new(self.APISecret.encode('utf-8'), signature_origin.encode('utf-8'),
+                                 digestmod=hashlib.sha256).digest()
+
+        signature_sha_base64 = base64.b64encode(signature_sha).decode(encoding='utf-8')
+
+        authorization_origin = f'api_key="{self.APIKey}", algorithm="hmac-sha256", headers="host date request-line", signature="{signature_sha_base64}"'
+
+        authorization = base64.b64encode(authorization_origin.encode('utf-8')).decode(encoding='utf-8')
+
+        # 将请求的鉴权参数组合为字典
+        v = {
+            "authorization": authorization,
+            "date": date,
+            "host": self.host
+        }
+        # 拼接鉴权参数,生成url
+        url = self.ImageUnderstanding_url + '?' + urlencode(v)
+        # print(url)
+        # 此处打印出建立连接时候的url,参考本demo的时候可取消上方打印的注释,比对相同参数时生成的url与自己代码生成的url是否一致
+        return url
+
+
+# 模型参数（请求中的parameter.chat部分）
+DEFAULT_CHAT_PARAMETERS = {
+    "domain": "image",
+    "temperature": 0.5,
+    "top_k": 4,
+    "max_tokens": 2028,
+    "auditing": "default"
+}
+
+
+def gen_params(appid, question, chat_parameters=None):
+    """
+    通过appid和用户的提问来生成请参数
+    """
+
+    data = {
+        "header": {
+            "app_id": appid
+        },
+        "parameter": {
+            "chat": dict(chat_parameters or DEFAULT_CHAT_PARAMETERS)
+        },
+        "payload": {
+            "message": {
+                "text": question
+            }
+        }
+    }
+
+    return data
+
+
+def getText(text, role, content):
+    """向对话列表追加一条消息"""
+    jsoncon = {}
+    jsoncon["role"] = role
+    jsoncon["content"] = content
+    text.append(jsoncon)
+    return text
+
+
+def getlength(text):
+    length = 0
+    for content in text:
+        temp = content["content"]
+        leng = len(temp)
+        length += leng
+    return length
+
+
+def checklen(text):
+    # print("text-content-tokens:", getlength(text[1:]))
+    while (getlength(text[1:]) > 8000):  # 如果长度大于8000,则删除text[1]
+        del text[1]
+    return text
+
+
+def build_question(image_base64, prompt):
+    """构造一次图片描述请求的对话内容：第一条为图片，第二条为提示词
+
+    每次调用都返回新的列表，请求之间互不影响。
+    """
+    text = [{"role": "user", "content": image_base64, "content_type": "image"}]
+    return checklen(getText(text, "user", prompt))
+
+
+def _iter_image_base64(image, chunk_size=STREAM_CHUNK_SIZE):
+    """逐段输出图片的base64编码
+
+    参数:
+        image: 图片字节，或图片文件路径（通过mmap读取，不把整个文件读入内存）
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        for i in range(0, len(image), chunk_size):
+            yield base64.b64encode(image[i:i + chunk_size])
+        return
+    with open(image, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for i in range(0, size, chunk_size):
+                yield base64.b64encode(mm[i:i + chunk_size])
+
+
+def iter_request_chunks(appid, image, prompt, chat_parameters=None, chunk_size=STREAM_CHUNK_SIZE):
+    """逐段生成请求JSON的utf-8字节，拼接后与json.dumps(gen_params(...))的结果完全相同
+
+    图片的base64内容分段编码输出，内存中同时只存在一段，
+    而不是同时持有原始字节、base64字节、字符串和完整JSON多份拷贝。
+
+    参数:
+        appid: 应用ID
+        image: 图片字节或图片文件路径
+        prompt: 提示词
+        chat_parameters: 模型参数
+        chunk_size: 每段编码的原始字节数，必须是3的倍数
+    """
+    if chunk_size % 3:
+        raise ValueError("chunk_size 必须是3的倍数")
+    # 先用占位符生成完整JSON，再在占位符处插入分段编码的图片内容
+    placeholder = "IMAGE_" + uuid.uuid4().hex
+    question = build_question(placeholder, prompt)
+    prefix, suffix = json.dumps(gen_params(appid, question, chat_parameters)).split(placeholder, 1)
+    yield prefix.encode('utf-8')
+    yield from _iter_image_base64(image, chunk_size)
+    yield suffix.encode('utf-8')
+
+
+def send_chunks(ws, chunks, frame_size=STREAM_FRAME_SIZE):
+    """把分段数据作为一条分片的websocket文本消息发送
+
+    参数:
+        ws: websocket.WebSocket连接
+        chunks: 字节段的可迭代对象（内容需为ASCII，分片边界不会截断多字节字符）
+        frame_size: 每个分片的目标大小
+
+    返回:
+        int: 发送的负载字节数
+    """
+    opcode = ABNF.OPCODE_TEXT
+    pending = []
+    pending_size = 0
+    total = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= frame_size:
+            ws.send_frame(ABNF.create_frame(b"".join(pending), opcode, fin=0))
+            opcode = ABNF.OPCODE_CONT
+            total += pending_size
+            pending = []
+            pending_size = 0
+    ws.send_frame(ABNF.create_frame(b"".join(pending), opcode, fin=1))
+    return total + pending_size
+
+
+class SparkImageClient(object):
+    """星火图片理解客户端
+
+    一个客户端可以被多个线程同时使用，每次describe()都会建立独立的websocket连接，
+    收到的内容只保存在本次调用的局部变量中。
+
+    参数:
+        connect_timeout: 建立连接（含TLS和websocket握手）的超时时间（秒）
+        first_token_timeout: 发送请求后等待第一条结果的超时时间（秒）
+        total_timeout: 整个请求的超时时间（秒）
+        超时参数为None时不限制
+    """
+
+    def __init__(self, appid, api_key, api_secret, imageunderstanding_url, chat_parameters=None,
+                 connect_timeout=None, first_token_timeout=None, total_timeout=None):
+        self.appid = appid
+        self.ws_param = Ws_Param(appid, api_key, api_secret, imageunderstanding_url)
+        self.chat_parameters = dict(chat_parameters or DEFAULT_CHAT_PARAMETERS)
+        self.connect_timeout = connect_timeout
+        self.first_token_timeout = first_token_timeout
+        self.total_timeout = total_timeout
+
+    def model_signature(self):
+        """返回描述模型及其参数的稳定字符串，参数改变时描述缓存自动失效"""
+        return json.dumps({"chat": self.chat_parameters, "path": self.ws_param.path},
+                          sort_keys=True, ensure_ascii=False)
+
+    def _deadline(self):
+        return None if self.total_timeout is None else time.monotonic() + self.total_timeout
+
+    def _remaining(self, deadline):
+        """距离总截止时间的剩余秒数，已超时时抛出SparkTimeoutError"""
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise SparkTimeoutError("total", self.total_timeout)
+        return remaining
+
+    def _connect(self, deadline=None):
+        timeout = self.connect_timeout
+        remaining = self._remaining(deadline)
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        try:
+            ws = websocket.create_connection(self.ws_param.create_url(), sslopt={"cert_reqs": ssl.CERT_NONE},
+                                             timeout=timeout)
+        except (websocket.WebSocketTimeoutException, TimeoutError):
+            raise SparkTimeoutError("connect", timeout)
+        # 发送阶段只受总超时限制
+        ws.settimeout(self._remaining(deadline))
+        return ws
+
+    def _recv(self, ws, deadline, first):
+        """在首个结果超时和总超时的限制下接收一条消息"""
+        timeout = self._remaining(deadline)
+        stage = "total"
+        if first and self.first_token_timeout is not None and (timeout is None or self.first_token_timeout < timeout):
+            timeout = self.first_token_timeout
+            stage = "first_token"
+        ws.settimeout(timeout)
+        try:
+            return ws.recv()
+        except (websocket.WebSocketTimeoutException, TimeoutError):
+            raise SparkTimeoutError(stage, timeout)
+
+    def _receive(self, ws, deadline=None, metrics=None, start=None, max_words=None, max_chars=None):
+        """接收流式结果直到status为2，返回 (描述, 是否提前结束)
+
+        设置了max_words或max_chars时，收到的内容超出上限后立即截断返回，不再等待剩余的结果。
+        """
+        answer = []
+        received = 0
+        while True:
+            message = self._recv(ws, deadline, first=not answer)
+            if metrics is not None and metrics.first_token_seconds is None:
+                metrics.first_token_seconds = time.monotonic() - start
+            if not message:
+                raise SparkAPIError(CONNECTION_CLOSED_CODE, "连接在返回完整结果前被关闭")
+            data = json.loads(message)
+            code = data['header']['code']
+            if code != 0:
+                raise SparkAPIError(code, data['header'].get('message', ''), data)
+            choices = data["payload"]["choices"]
+            content = choices["text"][0]["content"]
+            answer.append(content)
+            received += len(content)
+            if metrics is not None:
+                metrics.chars_received = received
+            final = choices["status"] == 2
+            if final and metrics is not None:
+                usage = data["payload"].get("usage", {}).get("text", {})
+                metrics.prompt_tokens = usage.get("prompt_tokens")
+                metrics.completion_tokens = usage.get("completion_tokens")
+            if not final and max_words is None and max_chars is None:
+                continue
+            result = "".join(answer)
+            # 完整的结果也按同样的规则截断，保存的描述与结果何时结束无关
+            truncated = truncate_answer(result, max_words, max_chars)
+            if not final and truncated is result:
+                continue
+            if metrics is not None:
+                metrics.early_closed = not final
+                metrics.discarded_chars = len(result) - len(truncated)
+            if not truncated.strip():
+                raise SparkAPIError(EMPTY_ANSWER_CODE, "返回内容为空")
+            return truncated, not final
+
+    def _request(self, send, metrics, cancel=None, max_words=None, max_chars=None):
+        """建立连接、调用send(ws)发送请求并接收结果，同时把各阶段耗时记录到metrics"""
+        start = time.monotonic()
+        deadline = self._deadline()
+        try:
+            if cancel is not None and cancel.cancelled:
+                raise SparkCancelledError()
+            ws = self._connect(deadline)
+            if metrics is not None:
+                metrics.connect_seconds = time.monotonic() - start
+            try:
+                if cancel is not None and not cancel._attach(ws):
+                    raise SparkCancelledError()
+                sent = send(ws)
+                if metrics is not None:
+                    metrics.bytes_sent = sent
+                    metrics.upload_seconds = time.monotonic() - start
+                result, early = self._receive(ws, deadline, metrics, start, max_words, max_chars)
+                if early:
+                    ws.shutdown()  # 提前结束时不再等待剩余的结果和服务端的关闭帧
+                return result
+            except SparkTimeoutError:
+                ws.shutdown()  # 超时后不再等待服务端的关闭帧
+                raise
+            except Exception:
+                if cancel is not None and cancel.cancelled:
+                    ws.shutdown()
+                    raise SparkCancelledError()
+                raise
+            finally:
+                ws.close()
+        except Exception as e:
+            if metrics is not None:
+                metrics.error_code = e.code if isinstance(e, SparkAPIError) else None
+                metrics.error_type = type(e).__name__
+            raise
+        finally:
+            if metrics is not None:
+                metrics.total_seconds = time.monotonic() - start
+
+    def _chat_parameters(self, max_tokens):
+        if max_tokens is None:
+            return self.chat_parameters
+        return dict(self.chat_parameters, max_tokens=min(max_tokens, self.chat_parameters.get("max_tokens", max_tokens)))
+
+    def describe(self, question, metrics=None, max_tokens=None, max_words=None, max_chars=None, cancel=None):
+        """发送一次图片描述请求并阻塞等待完整结果
+
+        参数:
+            question: build_question()返回的对话内容
+            metrics: RequestMetrics实例，为空时不记录测量值
+            max_tokens: 本次请求的max_tokens，不超过模型参数中的值，为None时使用模型参数
+            max_words, max_chars: 描述的单词数（或非空白字符数）上限，超出后在句末截断并提前关闭连接
+            cancel: CancelToken实例，用于在其它线程中取消本次请求
+
+        返回:
+            str: 模型返回的完整描述
+
+        异常:
+            SparkAPIError: 接口返回错误码时抛出
+        """
+        def send(ws):
+            data = json.dumps(gen_params(appid=self.appid, question=question,
+                                         chat_parameters=self._chat_parameters(max_tokens)))
+            ws.send(data)
+            return len(data)
+
+        return self._request(send, metrics, cancel, max_words, max_chars)
+
+    def describe_image(self, image, prompt, metrics=None, max_tokens=None, max_words=None, max_chars=None,
+                       cancel=None):
+        """流式发送图片并阻塞等待完整结果，内存中只保留一段base64编码
+
+        参数:
+            image: 图片字节或图片文件路径
+            prompt: 提示词
+            其它参数与describe()相同
+
+        返回:
+            str: 模型返回的完整描述
+        """
+        chat_parameters = self._chat_parameters(max_tokens)
+        return self._request(
+            lambda ws: send_chunks(ws, iter_request_chunks(self.appid, image, prompt, chat_parameters)), metrics,
+            cancel, max_words, max_chars)
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+# 模块位于仓库根目录 / The modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
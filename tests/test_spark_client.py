@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""流式请求序列化的测试 / Tests for streaming request serialization"""
+
+import base64
+import json
+import os
+import tracemalloc
+
+from spark_client import build_question, gen_params, iter_request_chunks
+
+IMAGE_BYTES = 8 * 1024 * 1024  # 序列化不关心图片内容，使用随机数据
+
+
+def _sample_image(tmp_path):
+    path = tmp_path / "sample.png"
+    path.write_bytes(os.urandom(IMAGE_BYTES))
+    return str(path)
+
+
+def test_streamed_request_matches_whole_payload(tmp_path):
+    image_path = _sample_image(tmp_path)
+    with open(image_path, 'rb') as f:
+        expected = json.dumps(gen_params("appid", build_question(str(base64.b64encode(f.read()), 'utf-8'), "describe")))
+    streamed = b"".join(iter_request_chunks("appid", image_path, "describe"))
+    assert streamed == expected.encode('utf-8')
+
+
+def test_streaming_peak_is_far_below_whole_payload(tmp_path):
+    image_path = _sample_image(tmp_path)
+    tracemalloc.start()
+    try:
+        with open(image_path, 'rb') as f:
+            image_data = f.read()
+        question = build_question(str(base64.b64encode(image_data), 'utf-8'), "describe")
+        data = json.dumps(gen_params("appid", question)).encode('utf-8')
+        del image_data, question, data
+        _, whole_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+
+        for _ in iter_request_chunks("appid", image_path, "describe"):
+            pass
+        _, stream_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # 流式序列化只保留一段base64编码，峰值应不到一次性序列化的四分之一
+    assert stream_peak * 4 < whole_peak, (stream_peak, whole_peak)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+阶段耗时追踪 / Stage Trace Recorder
+========================================================
+
+【功能说明 / Function Description】
+记录转换和描述流水线中每个阶段、每张图片的耗时区间（目录扫描、解码、编码、base64、网络、写文件等），
+保存为Chrome trace格式的JSON文件，可以直接在 https://ui.perfetto.dev 或 chrome://tracing 中打开，
+按线程查看每个阶段的时间线。
+
+Records spans per stage and per image in the convert and describe pipelines
+(directory scan, decode, encode, base64, network, file writes and so on) and
+saves them as a Chrome trace JSON file that opens directly in
+https://ui.perfetto.dev or chrome://tracing, with one timeline per thread.
+
+可选地对每个阶段最慢的N张图片附加cProfile结果（.prof文件，可用snakeviz或pstats查看）
+和tracemalloc内存快照（该图片结束时整个进程中分配最多的代码行）。
+cProfile在Python 3.12之前按线程记录；3.12及以后同时只能有一个分析器，并行的图片只分析其中一张。
+
+Optionally attaches cProfile results (.prof files for snakeviz or pstats) and
+tracemalloc snapshots (the process-wide top allocation sites when the image
+finished) to the slowest N images of each stage. Before Python 3.12 cProfile
+is per thread; from 3.12 on only one profiler can be active, so only one of
+the images processed in parallel is profiled at a time.
+
+【使用方法 / Usage】
+    tracer = TraceRecorder(profile_slowest=5, memory_slowest=5)
+    with tracer.span("decode", "convert", image=path, profile=True):
+        ...
+    tracer.save("convert_trace.json")
+"""
+
+import contextlib
+import cProfile
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+# 内存快照中保留的代码行数
+MEMORY_TOP_LINES = 10
+
+
+class _Slowest(object):
+    """某个阶段中最慢的一张图片"""
+
+    def __init__(self, seconds, image, event, profiler, memory):
+        self.seconds = seconds
+        self.image = image
+        self.event = event
+        self.profiler = profiler
+        self.memory = memory
+
+
+class TraceRecorder(object):
+    """记录Chrome trace事件，可以在多个线程中同时使用
+
+    参数:
+        profile_slowest: 为每个阶段最慢的多少张图片保存cProfile结果，0表示不分析
+        memory_slowest: 为每个阶段最慢的多少张图片保存tracemalloc快照，0表示不记录（会启动tracemalloc）
+        origin: 时间起点（perf_counter值），在工作进程中使用主进程的origin，事件可以合并到同一个trace中
+    """
+
+    def __init__(self, profile_slowest=0, memory_slowest=0, origin=None):
+        self.profile_slowest = profile_slowest
+        self.memory_slowest = memory_slowest
+        self.origin = time.perf_counter() if origin is None else origin
+        self._pid = os.getpid()
+        self._events = []
+        self._threads = {}  # 线程标识 -> 轨道编号
+        self._slowest = {}  # 阶段名称 -> [(秒, 序号, _Slowest)] 小顶堆
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        if memory_slowest and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _timestamp(self, seconds):
+        """perf_counter时间转换为trace中的微秒时间戳"""
+        return round((seconds - self.origin) * 1e6, 3)
+
+    def _tid(self):
+        ident = threading.get_ident()
+        tid = self._threads.get(ident)
+        if tid is None:
+            with self._lock:
+                tid = self._threads.setdefault(ident, len(self._threads) + 1)
+                self._events.append({"ph": "M", "name": "thread_name", "pid": self._pid, "tid": tid,
+                                     "args": {"name": threading.current_thread().name}})
+        return tid
+
+    def add_span(self, name, category, start, end, image=None, **args):
+        """添加一个已经结束的区间，start和end为time.perf_counter()的值，返回事件"""
+        if image is not None:
+            args["image"] = image
+        event = {"ph": "X", "name": name, "cat": category, "pid": self._pid, "tid": self._tid(),
+                 "ts": self._timestamp(start), "dur": round((end - start) * 1e6, 3), "args": args}
+        with self._lock:
+            self._events.append(event)
+        return event
+
+    def add_async_span(self, name, category, key, start, end, image=None, **args):
+        """添加一个跨线程的区间（如一张图片从取出到完成），在Perfetto中按key显示为单独的轨道"""
+        if image is not None:
+            args["image"] = image
+        common = {"name": name, "cat": category, "pid": self._pid, "tid": self._tid(), "id": str(key)}
+        with self._lock:
+            self._events.append(dict(common, ph="b", ts=self._timestamp(start), args=args))
+            self._events.append(dict(common, ph="e", ts=self._timestamp(end)))
+
+    @contextlib.contextmanager
+    def span(self, name, category, image=None, profile=False, **args):
+        """记录with块的耗时区间
+
+        参数:
+            name: 阶段名称
+            category: 类别（如convert、describe）
+            image: 图片路径，写入事件参数
+            profile: 是否参与最慢图片的cProfile分析和内存快照
+        """
+        profiler = None
+        if profile and self.profile_slowest:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                profiler = None  # Python 3.12及以后已有其它线程在分析
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            if profiler is not None:
+                profiler.disable()
+            event = self.add_span(name, category, start, end, image, **args)
+            if profile:
+                self._rank(name, end - start, image, event, profiler)
+
+    def _rank(self, name, seconds, image, event, profiler):
+        """保留每个阶段最慢的图片"""
+        keep = max(self.profile_slowest, self.memory_slowest)
+        if not keep:
+            return
+        with self._lock:
+            heap = self._slowest.setdefault(name, [])
+            if len(heap) >= keep and seconds <= heap[0][0]:
+                return
+        memory = None
+        if self.memory_slowest and tracemalloc.is_tracing():
+            # 快照比较慢，只在可能进入最慢名单时记录
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>")))
+            memory = [str(stat) for stat in snapshot.statistics('lineno')[:MEMORY_TOP_LINES]]
+        entry = _Slowest(seconds, image, event, profiler, memory)
+        with self._lock:
+            item = (seconds, next(self._seq), entry)
+            if len(heap) < keep:
+                heapq.heappush(heap, item)
+            elif seconds > heap[0][0]:
+                heapq.heapreplace(heap, item)
+
+    def instant(self, name, category, **args):
+        """记录一个时间点事件（如文件夹开始处理）"""
+        event = {"ph": "i", "s": "t", "name": name, "cat": category, "pid": self._pid, "tid": self._tid(),
+                 "ts": self._timestamp(time.perf_counter()), "args": args}
+        with self._lock:
+            self._events.append(event)
+
+    def counter(self, name, **values):
+        """记录计数器的当前值（如队列长度），在Perfetto中显示为折线"""
+        event = {"ph": "C", "name": name, "pid": self._pid, "ts": self._timestamp(time.perf_counter()),
+                 "args": values}
+        with self._lock:
+            self._events.append(event)
+
+    def events(self):
+        """返回已记录的事件（可以传给其它进程中的merge()）"""
+        with self._lock:
+            return list(self._events)
+
+    def merge(self, events):
+        """合并其它进程中记录的事件（进程号不同，在Perfetto中显示为单独的进程）"""
+        with self._lock:
+            self._events.extend(events)
+
+    def save(self, path):
+        """保存trace文件；启用了分析时，最慢图片的结果保存在同名的 _slowest 目录中
+
+        返回:
+            str: 最慢图片结果的目录，没有时为None
+        """
+        slowest_dir = self._save_slowest(os.path.splitext(path)[0] + "_slowest")
+        with self._lock:
+            data = {"traceEvents": list(self._events), "displayTimeUnit": "ms"}
+        tmp = path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        return slowest_dir
+
+    def _save_slowest(self, directory):
+        with self._lock:
+            stages = {name: sorted(heap, reverse=True) for name, heap in self._slowest.items() if heap}
+        if not stages:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        lines = []
+        for name, heap in sorted(stages.items()):
+            lines.append(f"== {name} ==")
+            for rank, (seconds, _, entry) in enumerate(heap, 1):
+                lines.append(f"{rank}. {seconds * 1000:.1f} ms  {entry.image}")
+                if entry.profiler is not None and rank <= self.profile_slowest:
+                    profile_name = f"{name}_{rank:02d}.prof"
+                    entry.profiler.dump_stats(os.path.join(directory, profile_name))
+                    entry.event["args"]["profile"] = profile_name
+                    lines.append(f"   cProfile: {profile_name}")
+                if entry.memory is not None and rank <= self.memory_slowest:
+                    entry.event["args"]["memory_top"] = entry.memory
+                    lines.append("   tracemalloc:")
+                    lines.extend("     " + line for line in entry.memory)
+            lines.append("")
+        with open(os.path.join(directory, "slowest.txt"), 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines))
+        return directory
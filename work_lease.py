@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+========================================================
+多机协作：分片与租约 / Multi-Host Sharding and Leases
+========================================================
+
+【功能说明 / Function Description】
+多台机器（或同一台机器上的多个进程）通过共享文件系统（如NFS）处理同一个BASE_DIR时，
+用下面两种方式之一分配图片，避免重复请求：
+
+- 固定分片：按图片相对路径的哈希分配给 SHARD_COUNT 个工作进程之一，不需要任何协调
+- 租约：处理一张图片前在租约目录中原子地创建租约文件，持有期间定期刷新（心跳）；
+  工作进程崩溃后租约过期，其它工作进程自动接手
+
+When several machines (or several processes on one machine) process the same
+BASE_DIR over a shared filesystem such as NFS, images are split in one of two
+ways so no request is sent twice:
+
+- Fixed shards: images are assigned to one of SHARD_COUNT workers by a hash of
+  their relative path, without any coordination
+- Leases: before describing an image a worker atomically creates a lease file
+  in the lease directory and refreshes it periodically (heartbeat) while it
+  holds it; when a worker crashes its leases expire and other workers take over
+
+【实现 / Implementation】
+- 租约文件使用O_CREAT|O_EXCL创建，NFSv3及以上保证原子性 / Lease files are created with
+  O_CREAT|O_EXCL, which is atomic on NFSv3 and later
+- 过期的租约先被重命名为唯一的墓碑文件，确认仍是检查过的那个文件（inode、修改时间、持有者）后再删除，
+  否则恢复原位；多个工作进程同时接手时只有一个成功
+  / An expired lease is first renamed to a unique tombstone and only removed
+  after checking it is still the file that was found expired (inode, mtime,
+  owner), otherwise it is put back; when several workers race for it only one
+  takes over
+- 租约是否过期按文件修改时间与文件服务器的时间比较，不依赖各台机器的时钟同步
+  / Expiry compares the lease's mtime with the file server's clock (read from a
+  probe file), so hosts do not need synchronized clocks
+
+【测试 / Testing】
+    python work_lease.py
+在本机启动多个进程争抢同一组任务，其中一个进程中途崩溃，检查每个任务恰好完成一次；
+再按固定的交错顺序让两个工作进程同时接手同一个过期租约，检查只有一个持有；
+最后让工作进程把完成记录写入各自的分片存储，检查每个任务只有一条记录。
+Starts several local processes that compete for the same items, crashes one of
+them halfway and checks that every item is completed exactly once. Then two
+workers take over the same expired lease in a fixed interleaving and the check
+is that only one of them holds it. Finally the workers record completions in
+their own output store shards and the check is one record per item.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+LEASE_SUFFIX = ".lease"
+
+
+def default_worker_id():
+    """默认的工作进程标识: 主机名-进程号"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def shard_of(relative_path, shard_count):
+    """返回相对路径所属的分片编号（0到shard_count-1），与机器、进程和Python版本无关"""
+    normalized = relative_path.replace(os.sep, '/')
+    digest = hashlib.sha1(normalized.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+def in_shard(relative_path, shard_index, shard_count):
+    return shard_count <= 1 or shard_of(relative_path, shard_count) == shard_index
+
+
+class LeaseManager(object):
+    """基于共享目录中租约文件的任务认领
+
+    参数:
+        lease_dir: 所有工作进程共享的租约目录
+        worker_id: 工作进程标识，为空时使用 主机名-进程号
+        ttl: 租约有效期（秒），超过该时间没有刷新的租约视为过期
+        heartbeat_interval: 刷新持有的租约的间隔（秒），应明显小于ttl
+    """
+
+    def __init__(self, lease_dir, worker_id=None, ttl=120.0, heartbeat_interval=30.0):
+        self.lease_dir = lease_dir
+        self.worker_id = worker_id or default_worker_id()
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        os.makedirs(lease_dir, exist_ok=True)
+        self._held = {}  # 键 -> 租约文件路径
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._clock_path = os.path.join(lease_dir, f".clock-{uuid.uuid4().hex}")
+        self.claimed = 0  # 成功认领的次数
+        self.reclaimed = 0  # 接手过期租约的次数
+        self.lost = 0  # 心跳或写出结果前发现已被其它工作进程接手的租约数
+
+    def _lease_path(self, key):
+        name = hashlib.sha1(key.replace(os.sep, '/').encode('utf-8')).hexdigest()
+        return os.path.join(self.lease_dir, name + LEASE_SUFFIX)
+
+    def _server_now(self):
+        """通过刷新探测文件读取文件服务器的当前时间"""
+        with open(self._clock_path, 'a'):
+            pass
+        os.utime(self._clock_path)
+        return os.stat(self._clock_path).st_mtime
+
+    def _create(self, key, path):
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({"worker": self.worker_id, "key": key, "claimed": time.time()}, f, ensure_ascii=False)
+        return True
+
+    def _owner(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f).get("worker")
+        except (OSError, ValueError):
+            return None  # 不存在或正在被写入
+
+    def _take_over(self, path, stale, stale_owner):
+        """把过期的租约重命名为墓碑文件并删除，成功时返回True
+
+        从检查过期到重命名之间，其它工作进程可能已经接手并创建了新的租约，
+        因此重命名后确认墓碑文件仍是检查过的那个文件（inode、修改时间和持有者都相同），
+        否则把它恢复原位并放弃。
+        """
+        tombstone = f"{path}.{uuid.uuid4().hex}.expired"
+        try:
+            os.rename(path, tombstone)
+        except FileNotFoundError:
+            return False  # 其它工作进程已经接手
+        try:
+            current = os.stat(tombstone)
+            same = (current.st_ino == stale.st_ino and current.st_mtime == stale.st_mtime
+                    and self._owner(tombstone) == stale_owner)
+        except FileNotFoundError:
+            return False
+        if same:
+            os.remove(tombstone)
+            return True
+        # 拿到的是别人刚创建的新租约：恢复原位，但不覆盖此后创建的租约；
+        # 已经有更新的租约时原持有者失去租约，它在写出结果前通过holds()发现
+        try:
+            os.link(tombstone, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            self._restore(tombstone, path, current)  # 不支持硬链接的文件系统
+        os.remove(tombstone)
+        return False
+
+    def _restore(self, tombstone, path, stat):
+        """用O_EXCL重新创建租约文件并复制内容和修改时间，已存在时不覆盖"""
+        with open(tombstone, 'rb') as f:
+            data = f.read()
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+
+    def try_claim(self, key):
+        """尝试认领一个任务，成功时返回True
+
+        参数:
+            key: 任务标识（图片相对于BASE_DIR的路径，各工作进程必须一致）
+        """
+        path = self._lease_path(key)
+        with self._lock:
+            if key in self._held:
+                return True
+        if not self._create(key, path):
+            try:
+                stale = os.stat(path)
+            except FileNotFoundError:
+                stale = None  # 持有者刚刚释放
+            if stale is not None:
+                if self._server_now() - stale.st_mtime < self.ttl:
+                    return False
+                if not self._take_over(path, stale, self._owner(path)):
+                    return False
+                self.reclaimed += 1
+            if not self._create(key, path):
+                return False
+        with self._lock:
+            self._held[key] = path
+        self.claimed += 1
+        return True
+
+    def holds(self, key):
+        """是否仍持有租约（租约文件仍属于本工作进程）；已被其它工作进程接手时不再持有"""
+        with self._lock:
+            path = self._held.get(key)
+        if path is None:
+            return False
+        if self._owner(path) == self.worker_id:
+            return True
+        with self._lock:
+            self._held.pop(key, None)
+        self.lost += 1
+        return False
+
+    def release(self, key):
+        """释放持有的租约"""
+        with self._lock:
+            path = self._held.pop(key, None)
+        if path is None:
+            return
+        if self._owner(path) == self.worker_id:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def heartbeat(self):
+        """刷新所有持有的租约；已被其它工作进程接手的租约不再持有"""
+        with self._lock:
+            held = list(self._held.items())
+        for key, path in held:
+            try:
+                if self._owner(path) != self.worker_id:
+                    raise FileNotFoundError(path)
+                os.utime(path)
+            except FileNotFoundError:
+                with self._lock:
+                    self._held.pop(key, None)
+                self.lost += 1
+
+    def held(self):
+        with self._lock:
+            return list(self._held)
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except OSError as e:
+                print(f"刷新租约失败: {e}")
+
+    def start(self):
+        """启动心跳线程"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._heartbeat_loop, name="lease-heartbeat", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """停止心跳线程并释放所有租约"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for key in self.held():
+            self.release(key)
+        try:
+            os.remove(self._clock_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+class _PausedLeaseManager(LeaseManager):
+    """测试用：判断租约过期之后、重命名之前暂停，用于复现两个工作进程同时接手"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checked = threading.Event()
+        self.resume = threading.Event()
+
+    def _server_now(self):
+        now = super()._server_now()
+        self.checked.set()
+        self.resume.wait()
+        return now
+
+
+def _race_takeover(lease_dir, ttl):
+    """两个工作进程同时接手同一个过期租约：B判断过期后暂停，A接手并创建新租约，然后B继续"""
+    dead = LeaseManager(lease_dir, "dead", ttl=ttl)
+    dead.try_claim("k")
+    past = time.time() - 10 * ttl
+    os.utime(dead._lease_path("k"), (past, past))  # 模拟崩溃后过期的租约
+
+    a = LeaseManager(lease_dir, "A", ttl=ttl)
+    b = _PausedLeaseManager(lease_dir, "B", ttl=ttl)
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("B", b.try_claim("k")))
+    thread.start()
+    b.checked.wait()
+    result["A"] = a.try_claim("k")
+    b.resume.set()
+    thread.join()
+    a.heartbeat()
+    b.heartbeat()
+    holders = [m.worker_id for m in (a, b) if "k" in m.held()]
+    owner = a._owner(a._lease_path("k"))
+    for manager in (dead, a, b):
+        manager.stop()
+    return holders, owner
+
+
+def _store_worker(lease_dir, store_dir, keys, worker_id, ttl):
+    """测试用工作进程：与描述引擎相同，完成记录写入各自的分片存储，认领后读取其它工作进程的新记录"""
+    from output_store import JsonlOutputStore
+
+    manager = LeaseManager(lease_dir, worker_id, ttl=ttl).start()
+    store = JsonlOutputStore(store_dir, shards=4, writer_id=worker_id)  # 打开时的索引很快就会过时
+    for key in keys:
+        if key in store or not manager.try_claim(key):
+            continue
+        store.refresh(key)
+        if key in store:
+            manager.release(key)
+            continue
+        time.sleep(0.01)  # 模拟请求
+        if manager.holds(key):
+            store.put(key, worker_id)
+            store.flush()
+        manager.release(key)
+    store.close()
+    manager.stop()
+
+
+def _demo_worker(lease_dir, done_dir, keys, worker_id, crash_after, ttl, heartbeat):
+    """测试用工作进程：依次认领任务，完成时在done_dir中追加记录"""
+    manager = LeaseManager(lease_dir, worker_id, ttl=ttl, heartbeat_interval=heartbeat).start()
+    completed = 0
+    for key in keys:
+        if os.path.exists(os.path.join(done_dir, key)):
+            continue
+        if not manager.try_claim(key):
+            continue
+        if os.path.exists(os.path.join(done_dir, key)):
+            manager.release(key)
+            continue
+        time.sleep(0.02)  # 模拟请求
+        if crash_after is not None and completed >= crash_after:
+            os._exit(1)  # 模拟崩溃：不释放租约
+        with open(os.path.join(done_dir, key), 'a') as f:
+            f.write(worker_id + "\n")
+        completed += 1
+        manager.release(key)
+    manager.stop()
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    import tempfile
+
+    ITEMS = 200
+    WORKERS = 4
+    TTL = 1.0
+
+    with tempfile.TemporaryDirectory() as root:
+        lease_dir = os.path.join(root, "leases")
+        done_dir = os.path.join(root, "done")
+        os.makedirs(done_dir)
+        keys = [f"item-{i:04d}" for i in range(ITEMS)]
+
+        # 第一轮：一个工作进程在完成5个任务后崩溃，留下未释放的租约
+        procs = [multiprocessing.Process(target=_demo_worker,
+                                         args=(lease_dir, done_dir, keys, f"w{i}", 5 if i == 0 else None, TTL, 0.2))
+                 for i in range(WORKERS)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        orphaned = len([n for n in os.listdir(lease_dir) if n.endswith(LEASE_SUFFIX)])
+        print(f"第一轮: {len(os.listdir(done_dir))}/{ITEMS} 完成，崩溃进程留下 {orphaned} 个租约")
+
+        # 第二轮：租约过期后由新的工作进程接手
+        time.sleep(TTL + 0.5)
+        procs = [multiprocessing.Process(target=_demo_worker,
+                                         args=(lease_dir, done_dir, keys, f"r{i}", None, TTL, 0.2))
+                 for i in range(2)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+
+        counts = {}
+        for key in keys:
+            path = os.path.join(done_dir, key)
+            counts[key] = len(open(path).read().split()) if os.path.exists(path) else 0
+        duplicates = [k for k, c in counts.items() if c > 1]
+        missing = [k for k, c in counts.items() if c == 0]
+        print(f"第二轮后: 完成 {ITEMS - len(missing)}/{ITEMS}，重复 {len(duplicates)}，遗漏 {len(missing)}")
+        print("分片示例:", [shard_of(k, WORKERS) for k in keys[:10]])
+
+        # 第三轮：两个工作进程同时接手同一个过期租约
+        holders, owner = _race_takeover(os.path.join(root, "race"), TTL)
+        print(f"同时接手: 持有者 {holders}，租约文件属于 {owner}")
+
+        # 第四轮：完成记录保存在各工作进程自己的分片存储中（OUTPUT_MODE为jsonl时）
+        store_dir = os.path.join(root, "store")
+        procs = [multiprocessing.Process(target=_store_worker,
+                                         args=(os.path.join(root, "store-leases"), store_dir, keys, f"s{i}", TTL))
+                 for i in range(WORKERS)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        records = {}
+        for name in os.listdir(store_dir):
+            with open(os.path.join(store_dir, name), encoding='utf-8') as f:
+                for line in f:
+                    key = json.loads(line)["path"]
+                    records[key] = records.get(key, 0) + 1
+        store_duplicates = sum(1 for c in records.values() if c > 1)
+        store_missing = ITEMS - len(records)
+        print(f"分片存储: 完成 {len(records)}/{ITEMS}，重复 {store_duplicates}，遗漏 {store_missing}")
+
+        if (duplicates or missing or holders != ["A"] or owner != "A"
+                or store_duplicates or store_missing):
+            raise SystemExit(1)